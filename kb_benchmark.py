@@ -0,0 +1,1094 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+知识库检索性能测试脚本
+按 knowledge_base.json 的结构合成不同规模的知识库，比较各检索方案的耗时
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from kb_shards import ShardedKnowledgeBaseQA, split_by_prefix
+from main import ANALYZERS, INDEX_PRECISIONS, SEARCH_ENGINES, LocalKnowledgeBaseQA, normalize_query
+
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge_base.json")
+
+
+def load_source(file_path: str = DEFAULT_SOURCE) -> Dict:
+    """读取作为合成素材的知识库"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def synthesize_entries(source: Dict, n_evidences: int, seed: int = 0) -> Iterator[Tuple[str, Dict]]:
+    """
+    按源知识库的结构逐条生成指定证据数量的知识库条目
+
+    每条证据由源知识库中随机抽取的若干分句拼接而成，问题ID沿用源知识库的领域前缀，
+    这样词频分布和条目形状都接近真实数据。
+    """
+    rng = random.Random(seed)
+    clauses = []
+    prefixes = []
+    answers = []
+    for question_id, question_data in source.items():
+        prefixes.append(re.sub(r'\d+$', '', question_id))
+        for evidence_data in question_data.get('evidences', {}).values():
+            clauses.extend(c for c in re.split(r'[，。；！？]', evidence_data.get('evidence', '')) if c)
+            answers.append(evidence_data.get('answer', []))
+    questions = [q.get('question', '') for q in source.values()]
+
+    for i in range(n_evidences):
+        question_id = f"{rng.choice(prefixes)}{i:07d}"
+        evidence_text = "，".join(rng.sample(clauses, rng.randint(2, 4))) + "。"
+        yield question_id, {
+            "question": rng.choice(questions),
+            "evidences": {
+                f"{question_id}#00": {
+                    "answer": rng.choice(answers),
+                    "evidence": evidence_text
+                }
+            }
+        }
+
+
+def synthesize_knowledge_base(source: Dict, n_evidences: int, seed: int = 0) -> Dict:
+    """按源知识库的结构合成指定证据数量的知识库"""
+    return dict(synthesize_entries(source, n_evidences, seed))
+
+
+def write_knowledge_base(source: Dict, n_evidences: int, file_path: str, seed: int = 0) -> None:
+    """合成知识库并逐条写入JSON文件，不在内存中保留整个知识库"""
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write('{')
+        for i, (question_id, question_data) in enumerate(synthesize_entries(source, n_evidences, seed)):
+            if i:
+                f.write(',')
+            f.write(f"\n{json.dumps(question_id)}: {json.dumps(question_data, ensure_ascii=False)}")
+        f.write('\n}')
+
+
+def sample_queries(source: Dict, n_queries: int, seed: int = 0) -> List[str]:
+    """从源知识库的问题字段中抽取查询"""
+    rng = random.Random(seed)
+    questions = [q.get('question', '') for q in source.values() if q.get('question')]
+    return [rng.choice(questions) for _ in range(n_queries)]
+
+
+def time_queries(qa_system: LocalKnowledgeBaseQA, queries: List[str], top_n: int) -> np.ndarray:
+    """逐条查询并返回每条的耗时（毫秒）"""
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        qa_system.search_knowledge(query, top_n)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def bench_engines(sizes: List[int], n_queries: int, top_n: int) -> None:
+    """比较matrix和inverted两种检索引擎在不同规模下的单条查询耗时"""
+    source = load_source()
+    queries = sample_queries(source, n_queries)
+
+    print(f"{'证据数':>10} {'引擎':>10} {'p50(ms)':>10} {'p95(ms)':>10} {'平均(ms)':>10}")
+    for size in sizes:
+        qa_system = LocalKnowledgeBaseQA(knowledge_dict=synthesize_knowledge_base(source, size))
+
+        # 两种引擎共享同一份索引，只比较检索部分
+        for name in ('matrix', 'inverted'):
+            qa_system.set_engine(name)
+            time_queries(qa_system, queries[:10], top_n)  # 预热
+            latencies = time_queries(qa_system, queries, top_n)
+            print(f"{size:>10} {name:>10} {np.percentile(latencies, 50):>10.3f} "
+                  f"{np.percentile(latencies, 95):>10.3f} {latencies.mean():>10.3f}")
+
+
+def sparse_nbytes(matrix) -> int:
+    """CSR矩阵三个数组占用的字节数"""
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def bench_lsa(sizes: List[int], components: List[int], n_queries: int, top_n: int) -> None:
+    """比较稀疏TF-IDF（matrix引擎）与LSA稠密向量的查询耗时、索引内存和召回率"""
+    source = load_source()
+    queries = sample_queries(source, n_queries)
+
+    print(f"{'证据数':>10} {'引擎':>10} {'拟合(s)':>8} {'索引(MB)':>9} {'p50(ms)':>9} "
+          f"{'p95(ms)':>9} {f'召回@{top_n}':>8}")
+    for size in sizes:
+        qa_system = LocalKnowledgeBaseQA(knowledge_dict=synthesize_knowledge_base(source, size),
+                                         token_cache_size=0, result_cache_size=0)
+        time_queries(qa_system, queries[:10], top_n)  # 预热
+        latencies = time_queries(qa_system, queries, top_n)
+        exact = [{r['id'] for r in qa_system.search_knowledge(query, top_n)} for query in queries]
+        index_mb = (sparse_nbytes(qa_system.kb_vectors) + sparse_nbytes(qa_system._kb_vectors_t)) / 2 ** 20
+        print(f"{size:>10} {'matrix':>10} {'-':>8} {index_mb:>9.1f} {np.percentile(latencies, 50):>9.3f} "
+              f"{np.percentile(latencies, 95):>9.3f} {1:>8.1%}")
+
+        for n_components in components:
+            qa_system.lsa_components = n_components
+            qa_system._lsa_projection = qa_system._lsa_vectors = None
+            start = time.perf_counter()
+            qa_system.set_engine('lsa')
+            fit_seconds = time.perf_counter() - start
+
+            time_queries(qa_system, queries[:10], top_n)
+            latencies = time_queries(qa_system, queries, top_n)
+            hits = sum(len(expected & {r['id'] for r in qa_system.search_knowledge(query, top_n)})
+                       for query, expected in zip(queries, exact))
+            recall = hits / max(sum(len(expected) for expected in exact), 1)
+            index_mb = (qa_system._lsa_vectors.nbytes + qa_system._lsa_projection.nbytes) / 2 ** 20
+            print(f"{size:>10} {f'lsa-{n_components}':>10} {fit_seconds:>8.2f} {index_mb:>9.1f} "
+                  f"{np.percentile(latencies, 50):>9.3f} {np.percentile(latencies, 95):>9.3f} "
+                  f"{recall:>8.1%}")
+            qa_system.set_engine('matrix')
+
+
+def index_nbytes(qa_system: LocalKnowledgeBaseQA) -> int:
+    """检索用的索引（行向量、转置矩阵和uint8存储的行缩放系数）占用的字节数"""
+    nbytes = sparse_nbytes(qa_system.kb_vectors) + sparse_nbytes(qa_system._kb_vectors_t)
+    if qa_system._row_scales is not None:
+        nbytes += qa_system._row_scales.nbytes
+    return nbytes
+
+
+def bench_precision(sizes: List[int], n_queries: int, top_n: int) -> None:
+    """
+    比较索引各存储精度的内存、查询耗时和与float64结果的一致程度
+
+    先用自带的知识库，再用合成的大知识库；Top-1一致率和召回率都以float64的结果为准。
+    """
+    source = load_source()
+    queries = noisy_queries(source, n_queries)
+
+    print(f"{'知识库':>10} {'精度':>8} {'索引(MB)':>9} {'p50(ms)':>9} {'p95(ms)':>9} {'批量每条(ms)':>12} "
+          f"{'Top-1一致':>9} {f'召回@{top_n}':>8} {'最大误差':>9}")
+    for size in [None] + sizes:
+        knowledge_base = source if size is None else synthesize_knowledge_base(source, size)
+        label = "自带" if size is None else str(size)
+        expected = None
+        for precision in INDEX_PRECISIONS:
+            qa_system = LocalKnowledgeBaseQA(knowledge_dict=knowledge_base, precision=precision,
+                                             token_cache_size=0, result_cache_size=0)
+            time_queries(qa_system, queries[:10], top_n)  # 预热
+            latencies = time_queries(qa_system, queries, top_n)
+            start = time.perf_counter()
+            results = qa_system.search_knowledge_batch(queries, top_n)
+            batch_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            if expected is None:
+                expected = results
+
+            agree = sum(bool(a) == bool(b) and (not a or a[0]['id'] == b[0]['id'])
+                        for a, b in zip(expected, results))
+            hits = sum(len({r['id'] for r in a} & {r['id'] for r in b}) for a, b in zip(expected, results))
+            recall = hits / max(sum(len(a) for a in expected), 1)
+            max_error = max((abs(x['score'] - y['score']) for a, b in zip(expected, results)
+                             for x, y in zip(a, b) if x['id'] == y['id']), default=0.0)
+            print(f"{label:>10} {precision:>8} {index_nbytes(qa_system) / 2 ** 20:>9.2f} "
+                  f"{np.percentile(latencies, 50):>9.3f} {np.percentile(latencies, 95):>9.3f} "
+                  f"{batch_ms:>12.3f} {agree / len(queries):>9.1%} {recall:>8.1%} {max_error:>9.4f}")
+            del qa_system
+
+
+def add_near_duplicates(knowledge_base: Dict, ratio: float, seed: int = 0) -> Tuple[Dict, Dict[str, str]]:
+    """
+    给一定比例的问题加上换了问题ID、证据随机删去一个字的副本，模拟合并多个来源后的知识库
+
+    Returns:
+        (加入副本后的知识库, 副本证据的ID -> 原证据的ID)
+    """
+    rng = random.Random(seed)
+    result = dict(knowledge_base)
+    origin = {}
+    for question_id, question_data in knowledge_base.items():
+        if rng.random() >= ratio:
+            continue
+        copy_id = f"{question_id}_COPY"
+        evidences = {}
+        for evidence_id, evidence_data in question_data.get('evidences', {}).items():
+            text = evidence_data.get('evidence', '')
+            if len(text) > 20:
+                position = rng.randrange(len(text))
+                text = text[:position] + text[position + 1:]
+            copy_evidence_id = f"{copy_id}#{evidence_id.rsplit('#', 1)[-1]}"
+            evidences[copy_evidence_id] = dict(evidence_data, evidence=text)
+            origin[f"{copy_id}#{copy_evidence_id}"] = f"{question_id}#{evidence_id}"
+        result[copy_id] = dict(question_data, evidences=evidences)
+    return result, origin
+
+
+def bench_dedup(sizes: List[int], ratio: float, threshold: float, n_queries: int, top_n: int,
+                show: int) -> None:
+    """
+    比较构建索引时合并近似重复证据前后的构建耗时、索引大小、查询耗时和Top-k中的重复结果
+
+    每个知识库先按ratio加入近似重复的副本；重复占位是Top-k结果中与排在前面的结果出自同一条原证据的比例。
+    最后列出自带知识库（不加副本）中合并的簇。
+    """
+    source = load_source()
+    queries = noisy_queries(source, n_queries)
+
+    print(f"{'知识库':>10} {'阈值':>6} {'构建(s)':>8} {'合并':>7} {'非零元素':>10} {'索引(MB)':>9} "
+          f"{'p50(ms)':>9} {'p95(ms)':>9} {'重复占位':>8}")
+    for size in [None] + sizes:
+        knowledge_base = source if size is None else synthesize_knowledge_base(source, size)
+        knowledge_base, origin = add_near_duplicates(knowledge_base, ratio)
+        label = "自带" if size is None else str(size)
+        for dedup_threshold in (None, threshold):
+            start = time.perf_counter()
+            qa_system = LocalKnowledgeBaseQA(knowledge_dict=knowledge_base, dedup_threshold=dedup_threshold,
+                                             token_cache_size=0, result_cache_size=0)
+            build_seconds = time.perf_counter() - start
+            time_queries(qa_system, queries[:10], top_n)  # 预热
+            latencies = time_queries(qa_system, queries, top_n)
+
+            redundant = total = 0
+            for results in qa_system.search_knowledge_batch(queries, top_n):
+                sources = [origin.get(result['id'], result['id']) for result in results]
+                redundant += len(sources) - len(set(sources))
+                total += len(sources)
+            print(f"{label:>10} {dedup_threshold or '-':>6} {build_seconds:>8.2f} "
+                  f"{qa_system.duplicate_stats()['collapsed']:>7} {qa_system.kb_vectors.nnz:>10} "
+                  f"{index_nbytes(qa_system) / 2 ** 20:>9.2f} {np.percentile(latencies, 50):>9.3f} "
+                  f"{np.percentile(latencies, 95):>9.3f} {redundant / max(total, 1):>8.1%}")
+            del qa_system
+
+    qa_system = LocalKnowledgeBaseQA(knowledge_dict=source, dedup_threshold=threshold)
+    report = qa_system.duplicate_report()
+    print(f"\n自带知识库（阈值 {threshold}）: {report['evidences']} 条证据中合并了 {report['collapsed']} 条，"
+          f"分为 {len(report['clusters'])} 簇；索引少了 {report['saved_nnz']} 个非零元素"
+          f"（占合并前的 {report['saved_nnz'] / max(report['index_nnz'] + report['saved_nnz'], 1):.1%}），"
+          f"约 {report['saved_bytes'] / 1024:.1f} KB")
+    for cluster in report['clusters'][:show]:
+        print(f"- {cluster['representative']} ← {', '.join(cluster['members'])}")
+        print(f"    {cluster['evidence'][:60]}")
+
+
+def homophone_queries(source: Dict, n_queries: int, seed: int = 0) -> List[Tuple[str, str]]:
+    """
+    从源知识库的问题中抽取查询，把其中一两个字换成读音相同的其他字，模拟语音识别的同音错字
+
+    只替换只有一个读音的字，替换后整句的拼音（按上下文取读音）与原问题相同；找不到可替换的字时跳过这个问题。
+    需要pypinyin。
+
+    Returns:
+        (替换后的查询, 原问题)
+    """
+    from pypinyin import Style, lazy_pinyin, pinyin
+
+    rng = random.Random(seed)
+    characters = set()
+    for question_data in source.values():
+        characters.update(question_data.get('question', ''))
+        for evidence_data in question_data.get('evidences', {}).values():
+            characters.update(evidence_data.get('evidence', ''))
+    reading_of = {}
+    homophones = {}
+    for character in sorted(characters):
+        if not '\u4e00' <= character <= '\u9fff':
+            continue
+        readings = pinyin(character, style=Style.NORMAL, heteronym=True)[0]
+        if len(readings) == 1:
+            reading_of[character] = readings[0]
+            homophones.setdefault(readings[0], []).append(character)
+
+    questions = [q.get('question', '') for q in source.values() if q.get('question')]
+    queries = []
+    while len(queries) < n_queries:
+        question = rng.choice(questions)
+        positions = [i for i, ch in enumerate(question) if len(homophones.get(reading_of.get(ch), ())) > 1]
+        if not positions:
+            continue
+        query = list(question)
+        for i in rng.sample(positions, min(1 if len(question) <= 8 else 2, len(positions))):
+            query[i] = rng.choice([ch for ch in homophones[reading_of[query[i]]] if ch != query[i]])
+        query = ''.join(query)
+        if lazy_pinyin(query) == lazy_pinyin(question):
+            queries.append((query, question))
+    return queries
+
+
+def bench_pinyin(sizes: List[int], n_queries: int, top_n: int) -> None:
+    """
+    比较启用拼音检索前后的构建耗时、索引大小、同音错字查询的耗时和Top-1准确率
+
+    查询见homophone_queries；结果第一条的问题文本与原问题相同即为正确。
+    """
+    source = load_source()
+    queries = homophone_queries(source, n_queries)
+    texts = [query for query, _ in queries]
+
+    print(f"{'知识库':>10} {'拼音':>4} {'构建(s)':>8} {'音节二元组':>10} {'拼音索引(MB)':>12} "
+          f"{'p50(ms)':>9} {'p95(ms)':>9} {'改用拼音':>8} {'Top-1':>7}")
+    for size in [None] + sizes:
+        knowledge_base = source if size is None else synthesize_knowledge_base(source, size)
+        label = "自带" if size is None else str(size)
+        for pinyin_fallback in (False, True):
+            start = time.perf_counter()
+            qa_system = LocalKnowledgeBaseQA(knowledge_dict=knowledge_base, pinyin_fallback=pinyin_fallback,
+                                             token_cache_size=0, result_cache_size=0)
+            build_seconds = time.perf_counter() - start
+            time_queries(qa_system, texts[:10], top_n)  # 预热
+            latencies = time_queries(qa_system, texts, top_n)
+            stats = qa_system.pinyin_stats()
+
+            correct = 0
+            for (_, question), results in zip(queries, qa_system.search_knowledge_batch(texts, top_n, slim=True)):
+                if results and normalize_query(results[0].question) == normalize_query(question):
+                    correct += 1
+            pinyin_nbytes = (sparse_nbytes(qa_system._pinyin_vectors) + sparse_nbytes(qa_system._pinyin_postings)
+                             if qa_system._pinyin_vectors is not None else 0)
+            print(f"{label:>10} {'是' if pinyin_fallback else '否':>4} {build_seconds:>8.2f} {stats['terms']:>10} "
+                  f"{pinyin_nbytes / 2 ** 20:>12.2f} {np.percentile(latencies, 50):>9.3f} "
+                  f"{np.percentile(latencies, 95):>9.3f} "
+                  f"{stats['searches'] / max(len(texts) + 10, 1):>8.1%} {correct / len(queries):>7.1%}")
+            del qa_system
+
+
+# 交互界面启动测试在子进程中运行main.main，stdin和stdout通过管道交互
+_STARTUP_SCRIPT = """
+import logging, sys
+logging.getLogger('jieba').setLevel(logging.WARNING)
+import main
+main.main(sys.argv[1], background=sys.argv[2] == 'background')
+"""
+
+
+def interactive_startup(knowledge_file: str, background: bool, question: str, think_time: float) -> Dict:
+    """
+    启动交互界面，菜单出现think_time秒后提一个问题，返回显示菜单和给出第一个回答的时间（距启动的秒数）
+
+    think_time模拟用户看菜单、说出问题的时间，后台加载可以和这段时间重叠。
+    """
+    import threading
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-u", "-c", _STARTUP_SCRIPT, knowledge_file,
+         'background' if background else 'foreground'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    output = []
+    menu_shown = threading.Event()
+    answered = threading.Event()
+
+    def read_output():
+        for line in iter(process.stdout.readline, b''):
+            text = line.decode('utf-8', errors='replace')
+            output.append(text)
+            if "显示菜单" in text:
+                menu_shown.set()
+            elif "给出第一个回答" in text:
+                answered.set()
+        menu_shown.set()
+        answered.set()
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+    menu_shown.wait()
+    wall_menu = time.perf_counter() - start
+    time.sleep(think_time)
+    process.stdin.write(f"1\n{question}\n".encode('utf-8'))
+    process.stdin.flush()
+    answered.wait()
+    wall_answer = time.perf_counter() - start
+    process.stdin.write(b"q\n")
+    process.stdin.close()
+    process.wait()
+    reader.join()
+
+    text = ''.join(output)
+    menu = re.search(r'启动后 ([\d.]+) 秒显示菜单', text)
+    answer = re.search(r'启动后 ([\d.]+) 秒给出第一个回答', text)
+    if menu is None or answer is None:
+        raise RuntimeError("交互界面没有输出启动耗时:\n" + text[-2000:])
+    return {
+        "menu": float(menu.group(1)),
+        "first_answer": float(answer.group(1)),
+        "wall_menu": wall_menu,
+        "wall_first_answer": wall_answer,
+    }
+
+
+def bench_startup(source_file: str, think_times: List[float], repeats: int) -> None:
+    """比较前台加载和后台加载时，显示菜单和给出第一个回答的耗时（有无索引快照两种情况）"""
+    import shutil
+    import tempfile
+
+    source = load_source(source_file)
+    # 删去一个字，不命中问题精确匹配，需要分词和TF-IDF检索
+    question = next(q['question'] for q in source.values() if len(q.get('question', '')) > 2)[:-1]
+
+    print(f"{'索引快照':>8} {'加载方式':>6} {'思考(s)':>8} {'显示菜单(s)':>11} {'第一个回答(s)':>13} "
+          f"{'进程内菜单(s)':>13} {'进程内回答(s)':>13}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        knowledge_file = os.path.join(temp_dir, "knowledge_base.json")
+        shutil.copy(source_file, knowledge_file)
+        index_dir = LocalKnowledgeBaseQA._index_dir(knowledge_file)
+        for snapshot in (False, True):
+            for think_time in think_times:
+                for background in (False, True):
+                    runs = []
+                    for _ in range(repeats):
+                        if snapshot:
+                            if not os.path.isdir(index_dir):
+                                LocalKnowledgeBaseQA(knowledge_file=knowledge_file)
+                        else:
+                            shutil.rmtree(index_dir, ignore_errors=True)
+                        runs.append(interactive_startup(knowledge_file, background, question, think_time))
+                    best = {key: min(run[key] for run in runs) for key in runs[0]}
+                    print(f"{'有' if snapshot else '无':>8} {'后台' if background else '前台':>6} {think_time:>8.1f} "
+                          f"{best['wall_menu']:>11.2f} {best['wall_first_answer']:>13.2f} "
+                          f"{best['menu']:>13.2f} {best['first_answer']:>13.2f}")
+
+
+# 压力测试给每条证据和答案加上所属的代数，一次查询的全部结果应当来自同一代索引
+_GENERATION_TAG = re.compile(r'〔第(\d+)代〕')
+
+
+def tag_generation(knowledge_base: Dict, generation: int) -> Dict:
+    """复制知识库，在每条证据和答案末尾加上代数标记"""
+    tag = f"〔第{generation}代〕"
+    return {
+        question_id: {
+            "question": question_data.get('question', ''),
+            "evidences": {
+                evidence_id: {
+                    "answer": [answer + tag for answer in evidence_data.get('answer', [])],
+                    "evidence": evidence_data.get('evidence', '') + tag,
+                }
+                for evidence_id, evidence_data in question_data.get('evidences', {}).items()
+            },
+        }
+        for question_id, question_data in knowledge_base.items()
+    }
+
+
+def generations_in(texts: Iterator[str]) -> set:
+    """文本中出现的全部代数"""
+    return {int(match) for text in texts for match in _GENERATION_TAG.findall(text)}
+
+
+def stress_concurrency(size: int, n_threads: int, duration: float, engine: str, analyzer: str,
+                       top_n: int, batch_size: int = 8) -> Dict:
+    """
+    多个线程不停查询的同时，另一个线程反复重新加载知识库文件并做增量修改
+
+    每一代知识库的证据和答案都带有代数标记，增量修改也使用当前的代数，
+    所以同一个快照里只有一种代数。检查三件事：查询不抛异常；一次调用（包括一批查询）
+    的全部结果来自同一代；每个线程看到的代数不会倒退。
+
+    Returns:
+        查询数、吞吐量、延迟分位数、重建次数和发现的问题数
+    """
+    import tempfile
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    source = load_source()
+    base = synthesize_knowledge_base(source, size)
+    queries = noisy_queries(source, 500)
+    question_ids = list(base)
+    stop = threading.Event()
+
+    def reader(seed):
+        rng = random.Random(seed)
+        stats = {"queries": 0, "errors": 0, "mixed": 0, "backwards": 0, "latencies": [],
+                 "first_error": None, "seen": set()}
+        last_generation = -1
+        while not stop.is_set():
+            operation = rng.randrange(3)
+            start = time.perf_counter()
+            try:
+                if operation == 0:
+                    texts = [text for r in qa_system.search_knowledge(rng.choice(queries), top_n)
+                             for text in [r['evidence']] + r['answer']]
+                    n_queries = 1
+                elif operation == 1:
+                    answer = qa_system.generate_answer(rng.choice(queries), top_n)
+                    texts = [answer["answer"]] + [ref["evidence"] for ref in answer["references"]]
+                    n_queries = 1
+                else:
+                    batch = [rng.choice(queries) for _ in range(batch_size)]
+                    texts = [text for results in qa_system.search_knowledge_batch(batch, top_n)
+                             for r in results for text in [r['evidence']] + r['answer']]
+                    n_queries = batch_size
+            except Exception as e:
+                stats["errors"] += 1
+                if stats["first_error"] is None:
+                    stats["first_error"] = repr(e)
+                continue
+            stats["latencies"].append((time.perf_counter() - start) * 1000 / n_queries)
+            stats["queries"] += n_queries
+            generations = generations_in(texts)
+            if len(generations) > 1:
+                stats["mixed"] += 1
+            elif generations:
+                generation = generations.pop()
+                if generation < last_generation:
+                    stats["backwards"] += 1
+                last_generation = max(last_generation, generation)
+                stats["seen"].add(generation)
+        return stats
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        knowledge_file = os.path.join(temp_dir, "knowledge_base.json")
+
+        def write_generation(generation):
+            # 先写临时文件再替换，与knowledge_renumber.py之类的工具原地改写相比更稳妥
+            with open(knowledge_file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(tag_generation(base, generation), f, ensure_ascii=False)
+            os.replace(knowledge_file + '.tmp', knowledge_file)
+
+        write_generation(0)
+        qa_system = LocalKnowledgeBaseQA(knowledge_file=knowledge_file, engine=engine, analyzer=analyzer,
+                                         result_cache_size=0)
+        qa_system.prewarm()
+        rng = random.Random(0)
+        writes = {"reloads": 0, "mutations": 0, "reload_ms": []}
+
+        def rebuild_until(deadline):
+            generation = 0
+            while time.perf_counter() < deadline:
+                generation += 1
+                write_generation(generation)
+                reloading = time.perf_counter()
+                qa_system.reload()
+                writes["reload_ms"].append((time.perf_counter() - reloading) * 1000)
+                writes["reloads"] += 1
+
+                # 在这一代上做几次增量修改，再压缩
+                tag = f"〔第{generation}代〕"
+                for i in range(5):
+                    question_id = rng.choice(question_ids)
+                    qa_system.add_evidence(question_id, f"{question_id}#stress{i}",
+                                           rng.choice(queries) + tag, ["压力测试" + tag])
+                    qa_system.update_evidence(question_id, f"{question_id}#stress{i}",
+                                              answer=["压力测试修改" + tag])
+                    writes["mutations"] += 2
+                qa_system.remove_question(rng.choice(question_ids))
+                qa_system.compact()
+                writes["mutations"] += 2
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            futures = [executor.submit(reader, seed) for seed in range(n_threads)]
+            try:
+                rebuild_until(start + duration)
+            finally:
+                # 重建出错时也要让查询线程停下来
+                stop.set()
+            readers = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+
+    latencies = [latency for stats in readers for latency in stats["latencies"]]
+    n_queries = sum(stats["queries"] for stats in readers)
+    errors = [stats["first_error"] for stats in readers if stats["first_error"]]
+    return {
+        "threads": n_threads,
+        "seconds": elapsed,
+        "queries": n_queries,
+        "qps": n_queries / elapsed,
+        "latency_ms": latency_summary(latencies) if latencies else {},
+        "reloads": writes["reloads"],
+        "reload_ms": latency_summary(writes["reload_ms"]) if writes["reload_ms"] else {},
+        "mutations": writes["mutations"],
+        "generations_seen": len(set().union(*(stats["seen"] for stats in readers))),
+        "errors": sum(stats["errors"] for stats in readers),
+        "first_error": errors[0] if errors else None,
+        "mixed": sum(stats["mixed"] for stats in readers),
+        "backwards": sum(stats["backwards"] for stats in readers),
+    }
+
+
+def bench_stress(size: int, threads: List[int], duration: float, engine: str, analyzer: str,
+                 top_n: int) -> bool:
+    """并发查询与重建的压力测试，见stress_concurrency；发现问题时返回False"""
+    print(f"{'线程':>4} {'查询数':>8} {'QPS':>8} {'p50(ms)':>9} {'p99(ms)':>9} {'重建':>5} "
+          f"{'重建p50(ms)':>11} {'增量修改':>8} {'代数':>5} {'异常':>5} {'混合':>5} {'倒退':>5}")
+    passed = True
+    for n_threads in threads:
+        result = stress_concurrency(size, n_threads, duration, engine, analyzer, top_n)
+        latency = result["latency_ms"]
+        print(f"{n_threads:>4} {result['queries']:>8} {result['qps']:>8.0f} {latency.get('p50', 0):>9.3f} "
+              f"{latency.get('p99', 0):>9.3f} {result['reloads']:>5} {result['reload_ms'].get('p50', 0):>11.1f} "
+              f"{result['mutations']:>8} {result['generations_seen']:>5} {result['errors']:>5} "
+              f"{result['mixed']:>5} {result['backwards']:>5}")
+        if result["first_error"]:
+            print(f"     第一个异常: {result['first_error']}")
+        passed = passed and not (result["errors"] or result["mixed"] or result["backwards"])
+    print("通过" if passed else "发现问题")
+    return passed
+
+
+def bench_shards(sizes: List[int], workers: List[int], n_queries: int, top_n: int) -> None:
+    """比较单一索引与按领域前缀分片的构建、单个领域重建和查询耗时"""
+    source = load_source()
+    queries = sample_queries(source, n_queries)
+
+    print(f"{'证据数':>10} {'方案':>14} {'构建(s)':>8} {'重建一个领域(s)':>15} {'p50(ms)':>9} {'p95(ms)':>9}")
+    for size in sizes:
+        knowledge_base = synthesize_knowledge_base(source, size)
+
+        start = time.perf_counter()
+        single = LocalKnowledgeBaseQA(knowledge_dict=knowledge_base, result_cache_size=0)
+        build_seconds = time.perf_counter() - start
+        time_queries(single, queries[:10], top_n)
+        latencies = time_queries(single, queries, top_n)
+        print(f"{size:>10} {'单一索引':>14} {build_seconds:>8.2f} {build_seconds:>15.2f} "
+              f"{np.percentile(latencies, 50):>9.3f} {np.percentile(latencies, 95):>9.3f}")
+
+        # 最大的领域作为被重建的分片
+        largest = max(split_by_prefix(knowledge_base).items(), key=lambda item: len(item[1]))[0]
+        for n_workers in workers:
+            start = time.perf_counter()
+            sharded = ShardedKnowledgeBaseQA.from_dict(knowledge_base, workers=n_workers,
+                                                       result_cache_size=0)
+            build_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            sharded.rebuild_shard(largest)
+            rebuild_seconds = time.perf_counter() - start
+
+            time_queries(sharded, queries[:10], top_n)
+            latencies = time_queries(sharded, queries, top_n)
+            label = f"{len(sharded.shards)}分片x{n_workers}线程"
+            print(f"{size:>10} {label:>14} {build_seconds:>8.2f} {rebuild_seconds:>15.2f} "
+                  f"{np.percentile(latencies, 50):>9.3f} {np.percentile(latencies, 95):>9.3f}")
+
+            # 只检索最大的领域，模拟路由命中单个分片
+            latencies = np.array([
+                timed_search(sharded, query, top_n, [largest]) for query in queries])
+            print(f"{size:>10} {'路由到1个分片':>14} {'-':>8} {'-':>15} "
+                  f"{np.percentile(latencies, 50):>9.3f} {np.percentile(latencies, 95):>9.3f}")
+            sharded.close()
+
+
+def timed_search(sharded: ShardedKnowledgeBaseQA, query: str, top_n: int, shards: List[str]) -> float:
+    """在指定分片中检索一次，返回耗时（毫秒）"""
+    start = time.perf_counter()
+    sharded.search_knowledge(query, top_n, shards)
+    return (time.perf_counter() - start) * 1000
+
+
+# 冷启动测试在子进程中执行：导入、构建索引并回答第一个问题，输出耗时和峰值内存
+_COLD_START_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+from main import LocalKnowledgeBaseQA
+with open(sys.argv[1], 'r', encoding='utf-8') as f:
+    knowledge_base = json.load(f)
+qa_system = LocalKnowledgeBaseQA(knowledge_dict=knowledge_base, analyzer=sys.argv[2])
+qa_system.search_knowledge(sys.argv[3])
+seconds = time.perf_counter() - start
+# fork出的子进程的ru_maxrss会继承父进程的峰值，Linux上优先读取/proc中的VmHWM
+max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+try:
+    with open('/proc/self/status') as f:
+        max_rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+except (OSError, StopIteration):
+    pass
+print(json.dumps({
+    "seconds": seconds,
+    "max_rss_kb": max_rss_kb,
+    "jieba_loaded": 'jieba' in sys.modules,
+}))
+"""
+
+
+def cold_start(analyzer: str, source_file: str, query: str) -> Dict:
+    """在新进程中测量某种文本特征从导入到回答第一个问题的耗时和峰值内存"""
+    output = subprocess.run(
+        [sys.executable, "-c", _COLD_START_SCRIPT, source_file, analyzer, query],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+    ).stdout
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def top1_accuracy(qa_system: LocalKnowledgeBaseQA, source: Dict) -> float:
+    """
+    以知识库自身的问题作为查询，检索结果第一条属于同一问题文本的比例
+
+    问题文本相同的条目视为同一答案；只看TF-IDF检索，不经过问题精确匹配的快速路径。
+    """
+    queries = [q.get('question', '') for q in source.values() if q.get('question')]
+    correct = 0
+    for query in queries:
+        results = qa_system.search_knowledge(query, top_n=1)
+        if results and normalize_query(results[0]['question']) == normalize_query(query):
+            correct += 1
+    return correct / len(queries) if queries else 0.0
+
+
+def bench_analyzers(source_file: str, repeats: int, top_n: int) -> None:
+    """比较jieba分词与字符一元/二元组的冷启动耗时、内存、查询耗时和Top-1准确率"""
+    source = load_source(source_file)
+    queries = [q.get('question', '') for q in source.values() if q.get('question')]
+
+    print(f"{'文本特征':>8} {'冷启动(s)':>10} {'峰值内存(MB)':>12} {'加载jieba':>9} "
+          f"{'词表大小':>8} {'p50(ms)':>9} {'p95(ms)':>9} {'Top-1':>7}")
+    for analyzer in ANALYZERS:
+        runs = [cold_start(analyzer, source_file, queries[0]) for _ in range(repeats)]
+        seconds = min(run["seconds"] for run in runs)
+        max_rss_mb = min(run["max_rss_kb"] for run in runs) / 1024
+
+        qa_system = LocalKnowledgeBaseQA(knowledge_dict=source, analyzer=analyzer,
+                                         token_cache_size=0, result_cache_size=0)
+        time_queries(qa_system, queries[:10], top_n)  # 预热
+        latencies = time_queries(qa_system, queries, top_n)
+        accuracy = top1_accuracy(qa_system, source)
+        print(f"{analyzer:>8} {seconds:>10.2f} {max_rss_mb:>12.1f} {str(runs[0]['jieba_loaded']):>9} "
+              f"{len(qa_system._vocabulary):>8} {np.percentile(latencies, 50):>9.3f} "
+              f"{np.percentile(latencies, 95):>9.3f} {accuracy:>7.1%}")
+
+
+def noisy_queries(source: Dict, n_queries: int, seed: int = 0) -> List[str]:
+    """
+    从源知识库的问题中抽取查询，其中一半随机删去一个字，模拟语音识别漏字
+
+    原样的问题会命中generate_answer的问题精确匹配，删字的问题需要走TF-IDF检索，两条路径都会被测到。
+    """
+    rng = random.Random(seed)
+    queries = sample_queries(source, n_queries, seed)
+    for i, query in enumerate(queries):
+        if i % 2 and len(query) > 1:
+            position = rng.randrange(len(query))
+            queries[i] = query[:position] + query[position + 1:]
+    return queries
+
+
+def latency_summary(latencies: Sequence[float]) -> Dict:
+    """耗时（毫秒）的分位数和平均值"""
+    latencies = np.asarray(latencies, dtype=np.float64)
+    return {
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "p99": float(np.percentile(latencies, 99)),
+        "mean": float(latencies.mean()),
+    }
+
+
+def time_calls(func: Callable, arguments: Sequence) -> List[float]:
+    """对每个参数调用一次func，返回每次的耗时（毫秒）"""
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        func(argument)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def memory_usage() -> Dict:
+    """当前进程的常驻内存和峰值内存（MB），Linux上读取/proc/self/status"""
+    usage = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    usage["rss_mb"] = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    usage["peak_mb"] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if "peak_mb" not in usage:
+        import resource
+        # macOS上ru_maxrss的单位是字节，Linux上是KB
+        scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+        usage["peak_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+        usage.setdefault("rss_mb", usage["peak_mb"])
+    return usage
+
+
+def measure_scale(file_path: str, n_queries: int, batch_size: int, top_n: int,
+                  analyzer: str = 'jieba', engine: str = 'matrix') -> Dict:
+    """
+    测量一个知识库文件的加载、构建索引、内存和查询耗时
+
+    在单独的进程中调用，内存数字才只反映这一个规模；rss_mb和loaded_rss_mb是加载分词器之后的增量，
+    peak_mb是整个进程的峰值。查询分词缓存和结果缓存都关闭，
+    测的是每次真正检索的耗时；批量查询的分位数按批统计，per_query为平均到每条查询的耗时。
+    """
+    from kb_store import KnowledgeStore
+
+    result = {"evidences": 0, "analyzer": analyzer, "engine": engine}
+    qa_system = LocalKnowledgeBaseQA(use_index_cache=False, token_cache_size=0, result_cache_size=0,
+                                     analyzer=analyzer)
+    # jieba词典的加载耗时与知识库规模无关，单独计时，之后的内存数字都是相对这里的增量
+    start = time.perf_counter()
+    qa_system._analyze("预热")
+    result["analyzer_s"] = time.perf_counter() - start
+    baseline = memory_usage()["rss_mb"]
+
+    start = time.perf_counter()
+    with open(file_path, 'r', encoding='utf-8') as f:
+        knowledge_base = json.load(f)
+    result["load_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    qa_system._store = KnowledgeStore.from_dict(knowledge_base)
+    result["store_s"] = time.perf_counter() - start
+    del knowledge_base
+    result["loaded_rss_mb"] = memory_usage()["rss_mb"] - baseline
+
+    start = time.perf_counter()
+    qa_system._build_index()
+    qa_system.set_engine(engine)
+    result["build_s"] = time.perf_counter() - start
+    result["evidences"] = qa_system.evidence_count
+    result["vocabulary"] = len(qa_system._vocabulary)
+    result["index_mb"] = (sparse_nbytes(qa_system.kb_vectors) + sparse_nbytes(qa_system._kb_vectors_t)) / 2 ** 20
+    memory = memory_usage()
+    result["rss_mb"] = memory["rss_mb"] - baseline
+    result["peak_mb"] = memory["peak_mb"]
+
+    queries = noisy_queries(load_source(), n_queries)
+    batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+    qa_system.search_knowledge_batch(queries[:batch_size], top_n)  # 预热
+    for query in queries[:10]:
+        qa_system.generate_answer(query, top_n)
+
+    latency = {}
+    latency["search"] = latency_summary(time_calls(
+        lambda query: qa_system.search_knowledge(query, top_n), queries))
+    latency["answer"] = latency_summary(time_calls(
+        lambda query: qa_system.generate_answer(query, top_n), queries))
+    for name, func in (("search_batch", qa_system.search_knowledge_batch),
+                       ("answer_batch", qa_system.generate_answer_batch)):
+        per_batch = time_calls(lambda batch: func(batch, top_n), batches)
+        latency[name] = latency_summary(per_batch)
+        latency[name]["per_query"] = sum(per_batch) / len(queries)
+    result["latency_ms"] = latency
+    return result
+
+
+_SCALE_WORKER_SCRIPT = """
+import json, sys
+from kb_benchmark import measure_scale
+print(json.dumps(measure_scale(sys.argv[1], *map(int, sys.argv[2:5]), *sys.argv[5:7])))
+"""
+
+
+def run_scale_worker(file_path: str, n_queries: int, batch_size: int, top_n: int,
+                     analyzer: str, engine: str) -> Dict:
+    """在新进程中调用measure_scale"""
+    output = subprocess.run(
+        [sys.executable, "-c", _SCALE_WORKER_SCRIPT, file_path, str(n_queries), str(batch_size),
+         str(top_n), analyzer, engine],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+    ).stdout
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def environment_info() -> Dict:
+    """记录在结果中的运行环境，便于对比不同时间、不同机器上的结果"""
+    import platform
+    import scipy
+    import sklearn
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "sklearn": sklearn.__version__,
+    }
+
+
+def flatten_metrics(result: Dict, prefix: str = "") -> Dict:
+    """把嵌套的测量结果展开为 "latency_ms.search.p50" 形式的键"""
+    metrics = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            metrics.update(flatten_metrics(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[prefix + key] = value
+    return metrics
+
+
+def compare_with_baseline(results: List[Dict], baseline_file: str) -> None:
+    """与之前保存的结果逐项对比，按证据数对应"""
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = {entry["evidences"]: entry for entry in json.load(f)["results"]}
+
+    print(f"\n与 {baseline_file} 对比:")
+    print(f"{'证据数':>10} {'指标':<36} {'基线':>10} {'本次':>10} {'变化':>8}")
+    for result in results:
+        previous = baseline.get(result["evidences"])
+        if previous is None:
+            continue
+        old_metrics = flatten_metrics(previous)
+        for name, value in flatten_metrics(result).items():
+            old = old_metrics.get(name)
+            if name == "evidences" or old is None:
+                continue
+            change = f"{(value - old) / old:+.1%}" if old else "-"
+            print(f"{result['evidences']:>10} {name:<36} {old:>10.3f} {value:>10.3f} {change:>8}")
+
+
+def bench_suite(sizes: List[int], n_queries: int, batch_size: int, top_n: int, analyzer: str,
+                engine: str, output: Optional[str], baseline: Optional[str]) -> List[Dict]:
+    """
+    不同规模下的加载、构建索引、内存和查询耗时
+
+    每个规模先合成知识库写入临时JSON文件，再在新进程中加载并测量；
+    结果连同运行环境保存为JSON，可以用--baseline与之前的结果对比。
+    """
+    import tempfile
+
+    source = load_source()
+    results = []
+    print(f"{'证据数':>10} {'加载(s)':>8} {'构建(s)':>8} {'增量内存(MB)':>12} {'峰值(MB)':>9} {'操作':>12} "
+          f"{'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'每条(ms)':>9}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            file_path = os.path.join(temp_dir, f"kb_{size}.json")
+            write_knowledge_base(source, size, file_path)
+            result = run_scale_worker(file_path, n_queries, batch_size, top_n, analyzer, engine)
+            os.remove(file_path)
+            results.append(result)
+
+            head = (f"{size:>10} {result['load_s'] + result['store_s']:>8.2f} {result['build_s']:>8.2f} "
+                    f"{result['rss_mb']:>12.1f} {result['peak_mb']:>9.1f}")
+            for name, latency in result["latency_ms"].items():
+                per_query = latency.get("per_query", latency["mean"])
+                print(f"{head} {name:>12} {latency['p50']:>9.3f} {latency['p95']:>9.3f} "
+                      f"{latency['p99']:>9.3f} {per_query:>9.3f}")
+                head = " " * len(head)
+
+    if output:
+        report = {
+            "environment": environment_info(),
+            "parameters": {"queries": n_queries, "batch_size": batch_size, "top_n": top_n,
+                           "analyzer": analyzer, "engine": engine},
+            "results": results,
+        }
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {output}")
+    if baseline:
+        compare_with_baseline(results, baseline)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="知识库检索性能测试")
+    subparsers = parser.add_subparsers(dest="command")
+
+    engines_parser = subparsers.add_parser("engines", help="比较matrix与inverted检索引擎")
+    engines_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    engines_parser.add_argument("--queries", type=int, default=200)
+    engines_parser.add_argument("--top-n", type=int, default=3)
+
+    analyzers_parser = subparsers.add_parser("analyzers", help="比较jieba分词与字符n-gram文本特征")
+    analyzers_parser.add_argument("--source", default=DEFAULT_SOURCE)
+    analyzers_parser.add_argument("--repeats", type=int, default=3, help="冷启动测试次数，取最小值")
+    analyzers_parser.add_argument("--top-n", type=int, default=3)
+
+    lsa_parser = subparsers.add_parser("lsa", help="比较稀疏TF-IDF与LSA稠密向量检索")
+    lsa_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    lsa_parser.add_argument("--components", type=int, nargs="+", default=[64, 128, 256])
+    lsa_parser.add_argument("--queries", type=int, default=200)
+    lsa_parser.add_argument("--top-n", type=int, default=10)
+
+    shards_parser = subparsers.add_parser("shards", help="比较单一索引与按领域前缀分片")
+    shards_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    shards_parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    shards_parser.add_argument("--queries", type=int, default=200)
+    shards_parser.add_argument("--top-n", type=int, default=3)
+
+    startup_parser = subparsers.add_parser("startup", help="比较交互界面前台加载和后台加载的启动耗时")
+    startup_parser.add_argument("--source", default=DEFAULT_SOURCE)
+    startup_parser.add_argument("--think-times", type=float, nargs="+", default=[0.0, 2.0],
+                                help="显示菜单后过多少秒提问，模拟用户看菜单、说出问题的时间")
+    startup_parser.add_argument("--repeats", type=int, default=3, help="每种情况测试次数，取最小值")
+
+    precision_parser = subparsers.add_parser("precision", help="比较索引的float64、float32和uint8存储精度")
+    precision_parser.add_argument("--sizes", type=int, nargs="+", default=[100000],
+                                  help="合成知识库的证据数，自带的知识库总会先测")
+    precision_parser.add_argument("--queries", type=int, default=500)
+    precision_parser.add_argument("--top-n", type=int, default=5)
+
+    dedup_parser = subparsers.add_parser("dedup", help="比较构建索引时合并近似重复证据的效果，并列出合并的簇")
+    dedup_parser.add_argument("--sizes", type=int, nargs="+", default=[100000],
+                              help="合成知识库的证据数，自带的知识库总会先测")
+    dedup_parser.add_argument("--ratio", type=float, default=0.2, help="加入近似重复副本的问题比例")
+    dedup_parser.add_argument("--threshold", type=float, default=0.9)
+    dedup_parser.add_argument("--queries", type=int, default=500)
+    dedup_parser.add_argument("--top-n", type=int, default=5)
+    dedup_parser.add_argument("--show", type=int, default=10, help="列出自带知识库中最大的几个簇")
+
+    pinyin_parser = subparsers.add_parser("pinyin", help="比较同音错字的查询启用拼音检索前后的准确率和耗时（需要pypinyin）")
+    pinyin_parser.add_argument("--sizes", type=int, nargs="+", default=[100000],
+                               help="合成知识库的证据数，自带的知识库总会先测")
+    pinyin_parser.add_argument("--queries", type=int, default=500)
+    pinyin_parser.add_argument("--top-n", type=int, default=5)
+
+    suite_parser = subparsers.add_parser("suite", help="不同规模下的加载、构建、内存和查询耗时，结果可保存为JSON")
+    suite_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    suite_parser.add_argument("--queries", type=int, default=500)
+    suite_parser.add_argument("--batch-size", type=int, default=32)
+    suite_parser.add_argument("--top-n", type=int, default=3)
+    suite_parser.add_argument("--analyzer", choices=ANALYZERS, default='jieba')
+    suite_parser.add_argument("--engine", choices=SEARCH_ENGINES, default='matrix')
+    suite_parser.add_argument("--output", help="保存结果的JSON文件")
+    suite_parser.add_argument("--baseline", help="之前保存的结果，与本次逐项对比")
+
+    stress_parser = subparsers.add_parser("stress", help="多线程并发查询的同时反复重建索引，检查结果是否一致")
+    stress_parser.add_argument("--size", type=int, default=2000, help="合成知识库的证据数")
+    stress_parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 8])
+    stress_parser.add_argument("--duration", type=float, default=10.0, help="每种线程数测试的秒数")
+    stress_parser.add_argument("--engine", choices=SEARCH_ENGINES, default='matrix')
+    stress_parser.add_argument("--analyzer", choices=ANALYZERS, default='jieba')
+    stress_parser.add_argument("--top-n", type=int, default=3)
+
+    args = parser.parse_args()
+    if args.command == "engines":
+        bench_engines(args.sizes, args.queries, args.top_n)
+    elif args.command == "shards":
+        bench_shards(args.sizes, args.workers, args.queries, args.top_n)
+    elif args.command == "lsa":
+        bench_lsa(args.sizes, args.components, args.queries, args.top_n)
+    elif args.command == "analyzers":
+        bench_analyzers(args.source, args.repeats, args.top_n)
+    elif args.command == "startup":
+        bench_startup(args.source, args.think_times, args.repeats)
+    elif args.command == "precision":
+        bench_precision(args.sizes, args.queries, args.top_n)
+    elif args.command == "dedup":
+        bench_dedup(args.sizes, args.ratio, args.threshold, args.queries, args.top_n, args.show)
+    elif args.command == "pinyin":
+        bench_pinyin(args.sizes, args.queries, args.top_n)
+    elif args.command == "suite":
+        bench_suite(args.sizes, args.queries, args.batch_size, args.top_n, args.analyzer,
+                    args.engine, args.output, args.baseline)
+    elif args.command == "stress":
+        if not bench_stress(args.size, args.threads, args.duration, args.engine, args.analyzer, args.top_n):
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似重复证据的检测
+每条证据取字符三元组的MinHash签名，按LSH分段把签名相同的证据放进同一个桶，
+只对同桶的候选对比较签名，不必两两比较全部证据
+"""
+
+import re
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+# MinHash签名的长度，估计的Jaccard相似度标准差约为sqrt(J(1-J)/NUM_PERM)
+NUM_PERM = 64
+
+# 字符n-gram的长度；规范化后不足该长度的文本补零字符，仍然有一个片段
+SHINGLE_SIZE = 3
+
+# 每次向量化处理的字符数上限，控制中间数组的内存
+CHUNK_CHARS = 1 << 20
+
+# 签名比较每批的候选对数
+COMPARE_CHUNK = 65536
+
+_NON_WORD = re.compile(r'[\W_]+')
+_EMPTY = np.iinfo(np.uint32).max
+
+
+def _hash_functions(num_perm: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    """乘法移位哈希族的参数：h(x) = (a * x + b) mod 2^64 的高32位，a取奇数"""
+    rng = np.random.RandomState(seed)
+    a = rng.randint(0, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.randint(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def _signature_chunk(texts: List[str], a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """一批已规范化文本的MinHash签名，空文本的签名全部为_EMPTY"""
+    lengths = np.array([len(text) for text in texts], dtype=np.int64)
+    signatures = np.full((len(texts), len(a)), _EMPTY, dtype=np.uint32)
+    total = int(lengths.sum())
+    if not total:
+        return signatures
+
+    # Unicode码位不超过21位，三个码位拼成一个63位整数即是片段本身，没有哈希冲突
+    codes = np.frombuffer((''.join(texts) + '\0' * (SHINGLE_SIZE - 1)).encode('utf-32-le'),
+                          dtype=np.uint32).astype(np.uint64)
+    ends = np.cumsum(lengths)
+    doc_of_position = np.repeat(np.arange(len(texts)), lengths)
+    positions = np.flatnonzero(np.arange(total) + SHINGLE_SIZE <= ends[doc_of_position])
+    keys = np.zeros(len(positions), dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        keys = (keys << np.uint64(21)) | codes[positions + offset]
+
+    docs = doc_of_position[positions]
+    counts = np.bincount(docs, minlength=len(texts))
+    non_empty = np.flatnonzero(counts)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+    shift = np.uint64(32)
+    for i in range(len(a)):
+        hashed = (keys * a[i] + b[i]) >> shift
+        signatures[non_empty, i] = np.minimum.reduceat(hashed, starts)
+    return signatures
+
+
+def minhash_signatures(texts: Iterable[str], num_perm: int = NUM_PERM,
+                       seed: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    计算每条文本的MinHash签名
+
+    文本先去掉空白和标点、转为小写，再取字符三元组作为集合元素；
+    文本按顺序分批处理，可以传入生成器，不必把全部文本留在内存中。
+
+    Args:
+        texts: 证据文本
+        num_perm: 签名长度
+        seed: 哈希函数的随机种子，相同种子的签名可以互相比较
+
+    Returns:
+        (签名矩阵（条数 x num_perm，uint32）, 每条文本是否有内容)
+    """
+    a, b = _hash_functions(num_perm, seed)
+    chunks = []
+    batch = []
+    batch_chars = 0
+    for text in texts:
+        text = _NON_WORD.sub('', text).lower()
+        if text and len(text) < SHINGLE_SIZE:
+            text += '\0' * (SHINGLE_SIZE - len(text))
+        batch.append(text)
+        batch_chars += len(text)
+        if batch_chars >= CHUNK_CHARS:
+            chunks.append(_signature_chunk(batch, a, b))
+            batch = []
+            batch_chars = 0
+    if batch or not chunks:
+        chunks.append(_signature_chunk(batch, a, b))
+    signatures = np.concatenate(chunks)
+    return signatures, signatures[:, 0] != _EMPTY
+
+
+def band_rows(threshold: float, num_perm: int = NUM_PERM) -> int:
+    """
+    LSH每段的签名行数
+
+    分成b段、每段r行时，相似度为s的一对文本至少有一段完全相同的概率为1-(1-s^r)^b，
+    在(1/b)^(1/r)附近陡增。取这个拐点比阈值低0.1以上的最大r，
+    召回接近全部，又尽量少产生需要比较的候选对。
+    """
+    rows = 1
+    while num_perm % (rows * 2) == 0:
+        bands = num_perm // (rows * 2)
+        if (1 / bands) ** (1 / (rows * 2)) > threshold - 0.1:
+            break
+        rows *= 2
+    return rows
+
+
+def similarity(signatures: np.ndarray, rows: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """按签名估计的Jaccard相似度，rows与others一一对应"""
+    result = np.empty(len(rows))
+    for start in range(0, len(rows), COMPARE_CHUNK):
+        end = start + COMPARE_CHUNK
+        equal = signatures[rows[start:end]] == signatures[others[start:end]]
+        result[start:end] = equal.mean(axis=1)
+    return result
+
+
+def find_near_duplicates(signatures: np.ndarray, valid: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    把估计相似度不低于threshold的文本聚成簇，每簇以行号最小的一条为代表
+
+    每一段签名相同的文本落在同一个桶里，桶内各行与行号最小的一行组成候选对。
+    按行号从小到大决定归属：候选对象已被合并时改为与它的代表比较，
+    因此每个成员都直接与代表相似，不会沿着一串相似的文本越连越远。
+
+    Args:
+        signatures: minhash_signatures返回的签名矩阵
+        valid: 有内容的文本，其余的不参与合并
+        threshold: 相似度阈值，0到1之间
+
+    Returns:
+        每行的代表行号，没有被合并的行（包括各簇的代表）为-1
+    """
+    n = len(signatures)
+    duplicate_of = np.full(n, -1, dtype=np.int64)
+    candidates = np.flatnonzero(valid)
+    if len(candidates) < 2:
+        return duplicate_of
+
+    rows_per_band = band_rows(threshold, signatures.shape[1])
+    prime = np.uint64(1099511628211)
+    pairs = []
+    for start in range(0, signatures.shape[1] - rows_per_band + 1, rows_per_band):
+        band = signatures[candidates, start:start + rows_per_band].astype(np.uint64)
+        keys = band[:, 0]
+        for column in range(1, rows_per_band):
+            keys = keys * prime + band[:, column]
+        order = np.argsort(keys, kind='stable')  # 桶内保持行号升序，桶的第一行即行号最小的一行
+        sorted_keys = keys[order]
+        first = np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])
+        leaders = candidates[order][np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))]
+        members = candidates[order]
+        shared = ~first
+        pairs.append(members[shared] * n + leaders[shared])
+    pairs = np.unique(np.concatenate(pairs))
+    rows, leaders = pairs // n, pairs % n
+    keep = similarity(signatures, rows, leaders) >= threshold
+    rows, leaders = rows[keep], leaders[keep]
+
+    # np.unique已按(行, 候选代表)排好序
+    for row, leader in zip(rows.tolist(), leaders.tolist()):
+        if duplicate_of[row] >= 0:
+            continue
+        representative = duplicate_of[leader] if duplicate_of[leader] >= 0 else leader
+        if representative != leader and similarity(
+                signatures, np.array([row]), np.array([representative]))[0] < threshold:
+            continue
+        duplicate_of[row] = representative
+    return duplicate_of
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检索各阶段的耗时统计
+每个阶段一个按2的幂分桶的直方图，记录一次只需几次整数运算；
+注册的回调会收到每一次记录，可以转发到外部的监控系统
+"""
+
+import logging
+from typing import Callable, Dict, List
+
+# 直方图的桶数：第i个桶为[2^(i-1), 2^i)微秒，最后一个桶收容所有更长的耗时（约4.2秒以上）
+NUM_BUCKETS = 24
+
+# 回调的参数：(阶段名, 耗时秒数, 本次处理的条目数)
+TimingHook = Callable[[str, float, int], None]
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    """耗时直方图，分位数在所在的桶内插值估计，误差不超过桶宽（一倍）"""
+
+    __slots__ = ('count', 'items', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.items = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * NUM_BUCKETS
+
+    def record(self, seconds: float, items: int = 1) -> None:
+        """记录一次耗时"""
+        self.count += 1
+        self.items += items
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket if bucket < NUM_BUCKETS else NUM_BUCKETS - 1] += 1
+
+    def percentile(self, q: float) -> float:
+        """
+        估计第q百分位的耗时（秒）
+
+        Args:
+            q: 0到100之间的百分位
+        """
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                # 在桶内按均匀分布线性插值
+                lower = (1 << bucket >> 1) / 1e6
+                upper = (1 << bucket) / 1e6
+                return min(lower + (upper - lower) * max(rank - seen, 0) / n, self.max)
+            seen += n
+        return self.max
+
+    def summary(self) -> Dict:
+        """次数、条目数和耗时（毫秒）的汇总"""
+        return {
+            "count": self.count,
+            "items": self.items,
+            "total_ms": self.total * 1000,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p95_ms": self.percentile(95) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class StageTimings:
+    """按阶段名记录耗时直方图，并把每次记录转发给注册的回调"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._hooks = []  # type: List[TimingHook]
+
+    def record(self, stage: str, seconds: float, items: int = 1) -> None:
+        """
+        记录某个阶段的一次耗时
+
+        Args:
+            stage: 阶段名
+            seconds: 耗时（秒）
+            items: 这一次处理的条目数，例如一批查询的数量
+        """
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms[stage] = LatencyHistogram()
+        histogram.record(seconds, items)
+        for hook in self._hooks:
+            try:
+                hook(stage, seconds, items)
+            except Exception:
+                # 导出失败不能影响问答本身
+                logger.warning("耗时统计回调出错", exc_info=True)
+
+    def add_hook(self, hook: TimingHook) -> None:
+        """注册回调，之后每次记录都会调用hook(阶段名, 耗时秒数, 条目数)"""
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: TimingHook) -> None:
+        """注销回调"""
+        self._hooks.remove(hook)
+
+    def summary(self) -> Dict[str, Dict]:
+        """各阶段的汇总，见LatencyHistogram.summary"""
+        return {stage: histogram.summary() for stage, histogram in self._histograms.items()}
+
+    def reset(self) -> None:
+        """清空已记录的数据，回调保留"""
+        self._histograms = {}
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文本到无声调拼音音节二元组的转换，供同音字容错检索使用
+语音识别结果中的同音错字会让分词或字符特征对不上，换成拼音后仍然相同；
+pypinyin是可选依赖，没有安装时拼音检索不可用
+"""
+
+import functools
+import importlib.util
+import re
+from typing import Tuple
+
+_pypinyin = None
+
+# 标点和空白处断开，音节二元组不跨越它们
+_PHRASE = re.compile(r'[^\W_]+')
+
+
+def load_pypinyin():
+    """第一次需要时才导入pypinyin，没有安装时返回None"""
+    global _pypinyin
+    if _pypinyin is None:
+        try:
+            import pypinyin
+        except ImportError:
+            return None
+        _pypinyin = pypinyin
+    return _pypinyin
+
+
+def _non_hanzi(chunk: str):
+    """字母、数字等非汉字片段整体作为一个音节"""
+    return [chunk.lower()]
+
+
+def pinyin_available() -> bool:
+    """是否安装了pypinyin，只查找模块而不导入（导入需要零点几秒）"""
+    return _pypinyin is not None or importlib.util.find_spec('pypinyin') is not None
+
+
+def _ngrams(text: str) -> Tuple[str, ...]:
+    terms = {}
+    lazy_pinyin = load_pypinyin().lazy_pinyin
+    for phrase in _PHRASE.findall(text):
+        syllables = lazy_pinyin(phrase, errors=_non_hanzi)
+        if len(syllables) == 1:
+            terms[syllables[0]] = None
+        for i in range(len(syllables) - 1):
+            terms[syllables[i] + ' ' + syllables[i + 1]] = None
+    return tuple(terms)
+
+
+def text_ngrams(text: str) -> Tuple[str, ...]:
+    """
+    文本中出现的拼音音节二元组（去重，按首次出现的顺序），音节之间以空格分隔
+
+    文本按标点和空白拆成短语，连续的汉字由pypinyin按词语取读音（多音字按上下文，
+    例如“银行”为yin hang），字母数字串整体作为一个音节；
+    只有一个音节的短语以这个音节本身作为检索词。调用前需确认pinyin_available()。
+    """
+    return _ngrams(text)
+
+
+@functools.lru_cache(maxsize=4096)
+def query_ngrams(text: str) -> Tuple[str, ...]:
+    """同text_ngrams，结果缓存在LRU中：查询和问题文本经常重复，转换拼音比查倒排表慢得多"""
+    return _ngrams(text)
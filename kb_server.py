@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+知识库问答服务
+常驻进程只加载一次知识库，通过Unix套接字（每行一个JSON请求）或本机HTTP提供search/answer，
+各语音前端不必各自加载知识库和构建索引。
+几毫秒内到达的请求合并为一次批量检索，stats请求返回队列深度和延迟统计。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from main import LocalKnowledgeBaseQA, default_knowledge_file, default_options
+
+DEFAULT_SOCKET_PATH = "/tmp/kb_server.sock"
+DEFAULT_HTTP_HOST = "127.0.0.1"
+DEFAULT_HTTP_PORT = 8765
+
+# 第一个请求到达后最多再等待这么久，收集同一批的请求
+BATCH_WINDOW = 0.005
+
+# 每批最多合并的请求数
+MAX_BATCH_SIZE = 64
+
+# 延迟统计保留最近多少个请求
+LATENCY_WINDOW = 1024
+
+# 单个请求允许的最大top_n
+MAX_TOP_N = 100
+
+_HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+class MicroBatcher:
+    """
+    请求微批处理
+
+    请求先进入队列，后台任务取出第一个请求后在batch_window内继续收集，
+    然后按(操作, top_n)分组，每组调用一次批量检索。检索在单独的线程中串行执行，
+    不阻塞事件循环，问答系统也只会被一个线程访问。
+    """
+
+    def __init__(self, qa_system: LocalKnowledgeBaseQA, batch_window: float = BATCH_WINDOW,
+                 max_batch_size: int = MAX_BATCH_SIZE):
+        """
+        Args:
+            qa_system: 已加载的问答系统
+            batch_window: 收集同一批请求的等待时间（秒），0表示只合并已经在排队的请求
+            max_batch_size: 每批最多合并的请求数
+        """
+        self.qa_system = qa_system
+        self.batch_window = batch_window
+        self.max_batch_size = max(1, max_batch_size)
+        self._queue = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+        self._in_flight = 0
+        self._requests = 0
+        self._errors = 0
+        self._batches = 0
+        self._max_batch = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)  # 请求从提交到得到结果的耗时（秒）
+        self._batch_times = deque(maxlen=LATENCY_WINDOW)  # 每批检索本身的耗时（秒）
+
+    def start(self) -> None:
+        """在当前事件循环中启动批处理任务"""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self) -> None:
+        """停止批处理任务并关闭检索线程"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown()
+
+    async def submit(self, op: str, query: str, top_n: int) -> Any:
+        """提交一个search或answer请求，等待所在批次完成后返回结果"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, query, top_n, future, time.perf_counter()))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self._in_flight = len(batch)
+            start = time.perf_counter()
+            try:
+                outcomes = await loop.run_in_executor(self._executor, self._process, batch)
+            except Exception as e:
+                outcomes = [e] * len(batch)
+            finished = time.perf_counter()
+            self._in_flight = 0
+            self._batches += 1
+            self._max_batch = max(self._max_batch, len(batch))
+            self._batch_times.append(finished - start)
+
+            for (_, _, _, future, submitted), outcome in zip(batch, outcomes):
+                self._requests += 1
+                self._latencies.append(finished - submitted)
+                if future.cancelled():
+                    continue
+                if isinstance(outcome, Exception):
+                    self._errors += 1
+                    future.set_exception(outcome)
+                else:
+                    future.set_result(outcome)
+
+    def _process(self, batch: List[Tuple]) -> List[Any]:
+        """
+        在检索线程中执行一批请求，返回与batch一一对应的结果或异常
+
+        只有一个请求的分组走search_knowledge/generate_answer，可以用上结果缓存；
+        多个请求的分组走批量接口，结果与逐条调用一致。
+        """
+        groups = {}
+        for position, (op, query, top_n, _, _) in enumerate(batch):
+            groups.setdefault((op, top_n), []).append(position)
+
+        outcomes = [None] * len(batch)
+        qa_system = self.qa_system
+        for (op, top_n), positions in groups.items():
+            queries = [batch[i][1] for i in positions]
+            try:
+                if len(queries) == 1:
+                    if op == "search":
+                        results = [qa_system.search_knowledge(queries[0], top_n)]
+                    else:
+                        results = [qa_system.generate_answer(queries[0], top_n)]
+                elif op == "search":
+                    results = qa_system.search_knowledge_batch(queries, top_n)
+                else:
+                    results = qa_system.generate_answer_batch(queries, top_n)
+            except Exception as e:
+                results = [e] * len(queries)
+            for position, result in zip(positions, results):
+                outcomes[position] = result
+        return outcomes
+
+    def stats(self) -> Dict:
+        """队列深度、批次大小和延迟统计（毫秒，基于最近LATENCY_WINDOW个请求）"""
+        latencies = np.array(self._latencies) * 1000
+        batch_times = np.array(self._batch_times) * 1000
+
+        def percentile(values, q):
+            return float(np.percentile(values, q)) if len(values) else 0.0
+
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight": self._in_flight,
+            "requests": self._requests,
+            "errors": self._errors,
+            "batches": self._batches,
+            "mean_batch_size": self._requests / self._batches if self._batches else 0.0,
+            "max_batch_size": self._max_batch,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "mean": float(latencies.mean()) if len(latencies) else 0.0,
+            },
+            "batch_ms": {
+                "p50": percentile(batch_times, 50),
+                "p95": percentile(batch_times, 95),
+            },
+        }
+
+
+class KnowledgeBaseServer:
+    def __init__(self, qa_system: LocalKnowledgeBaseQA, batch_window: float = BATCH_WINDOW,
+                 max_batch_size: int = MAX_BATCH_SIZE):
+        """
+        初始化问答服务
+
+        Args:
+            qa_system: 已加载的问答系统，服务期间只由批处理线程访问
+            batch_window: 收集同一批请求的等待时间（秒）
+            max_batch_size: 每批最多合并的请求数
+        """
+        self.batcher = MicroBatcher(qa_system, batch_window, max_batch_size)
+        self._servers = []
+        self._started_at = None
+
+    async def start(self, socket_path: Optional[str] = None, host: Optional[str] = None,
+                    port: Optional[int] = None) -> None:
+        """
+        开始监听，socket_path和port至少给出一个
+
+        Args:
+            socket_path: Unix套接字路径，每行一个JSON请求，每行一个JSON响应
+            host: HTTP监听地址
+            port: HTTP监听端口
+        """
+        if socket_path is None and port is None:
+            raise ValueError("至少需要指定Unix套接字路径或HTTP端口")
+        self.batcher.start()
+        self._started_at = time.monotonic()
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)  # 上次没有正常退出留下的套接字文件
+            self._servers.append(await asyncio.start_unix_server(self._handle_lines, path=socket_path))
+        if port is not None:
+            self._servers.append(await asyncio.start_server(self._handle_http, host or DEFAULT_HTTP_HOST, port))
+
+    async def close(self) -> None:
+        """停止监听并关闭批处理"""
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+        await self.batcher.close()
+
+    def stats(self) -> Dict:
+        """服务运行状态"""
+        stats = self.batcher.stats()
+        stats["reload"] = self.batcher.qa_system.reload_stats()
+        stats["uptime"] = time.monotonic() - self._started_at if self._started_at is not None else 0.0
+        return stats
+
+    async def dispatch(self, request: Dict) -> Dict:
+        """
+        处理一个请求
+
+        Args:
+            request: {"op": "search"|"answer"|"stats", "query": 查询文本, "top_n": 结果数量}，
+                可带任意的"id"，原样放回响应中
+
+        Returns:
+            {"result": ...}，出错时为{"error": 错误信息}
+        """
+        response = {"id": request["id"]} if "id" in request else {}
+        try:
+            op = request.get("op")
+            if op == "stats":
+                response["result"] = self.stats()
+                return response
+            if op not in ("search", "answer"):
+                raise ValueError(f"未知的操作: {op}，可选: search, answer, stats")
+            query = request.get("query")
+            if not isinstance(query, str):
+                raise ValueError("query必须是字符串")
+            top_n = int(request.get("top_n", 3))
+            if not 1 <= top_n <= MAX_TOP_N:
+                raise ValueError(f"top_n必须在1到{MAX_TOP_N}之间")
+            response["result"] = await self.batcher.submit(op, query, top_n)
+        except Exception as e:
+            response["error"] = str(e)
+        return response
+
+    async def _handle_lines(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Unix套接字连接：请求可以连续发送，各自独立处理，响应按完成顺序写回"""
+        write_lock = asyncio.Lock()
+        pending = set()
+
+        async def answer(line: bytes) -> None:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError("请求必须是JSON对象")
+            except ValueError as e:
+                response = {"error": f"请求格式错误: {e}"}
+            else:
+                response = await self.dispatch(request)
+            data = json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n'
+            async with write_lock:
+                writer.write(data)
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(answer(line))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        本机HTTP：GET /search?q=...&top_n=3、GET /answer?q=...、GET /stats，
+        也可以POST JSON请求体（字段同Unix套接字协议）；支持keep-alive
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split(None, 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = b''
+                if 'content-length' in headers:
+                    body = await reader.readexactly(int(headers['content-length']))
+
+                status, response = await self._http_response(method, target, body)
+                data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+                keep_alive = (headers.get('connection', '').lower() != 'close'
+                              and version.strip().upper() != 'HTTP/1.0')
+                head = (f"HTTP/1.1 {status} {_HTTP_REASONS[status]}\r\n"
+                        f"Content-Type: application/json; charset=utf-8\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+                writer.write(head.encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _http_response(self, method: str, target: str, body: bytes) -> Tuple[int, Dict]:
+        """把HTTP请求转换为dispatch的请求，返回(状态码, 响应)"""
+        url = urlsplit(target)
+        op = url.path.strip('/')
+        if op not in ("search", "answer", "stats"):
+            return 404, {"error": f"未知的路径: {url.path}"}
+        if method == "GET":
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            request = {"op": op, "query": params.get("q", params.get("query"))}
+            if "top_n" in params:
+                request["top_n"] = params["top_n"]
+        elif method == "POST":
+            try:
+                request = json.loads(body.decode('utf-8')) if body else {}
+                if not isinstance(request, dict):
+                    raise ValueError("请求必须是JSON对象")
+            except ValueError as e:
+                return 400, {"error": f"请求格式错误: {e}"}
+            request["op"] = op
+        else:
+            return 405, {"error": f"不支持的请求方法: {method}"}
+        response = await self.dispatch(request)
+        return (400 if "error" in response else 200), response
+
+
+class KnowledgeBaseClient:
+    """Unix套接字的同步客户端，供语音前端等非异步代码调用"""
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, timeout: Optional[float] = 10.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+
+    def _request(self, request: Dict) -> Any:
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(self.timeout)
+            self._sock.connect(self.socket_path)
+            self._file = self._sock.makefile('rb')
+        try:
+            self._sock.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b'\n')
+            line = self._file.readline()
+        except OSError:
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise ConnectionError("问答服务已断开连接")
+        response = json.loads(line.decode('utf-8'))
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def search(self, query: str, top_n: int = 3) -> List[Dict]:
+        """同LocalKnowledgeBaseQA.search_knowledge"""
+        return self._request({"op": "search", "query": query, "top_n": top_n})
+
+    def answer(self, query: str, top_n: int = 3) -> Dict:
+        """同LocalKnowledgeBaseQA.generate_answer"""
+        return self._request({"op": "answer", "query": query, "top_n": top_n})
+
+    def stats(self) -> Dict:
+        """服务的队列深度和延迟统计"""
+        return self._request({"op": "stats"})
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+async def serve(qa_system: LocalKnowledgeBaseQA, socket_path: Optional[str], host: str,
+                port: Optional[int], batch_window: float, max_batch_size: int) -> None:
+    """启动服务并一直运行，直到被取消"""
+    server = KnowledgeBaseServer(qa_system, batch_window, max_batch_size)
+    await server.start(socket_path, host, port)
+    if socket_path is not None:
+        print(f"问答服务已在Unix套接字 {socket_path} 上启动")
+    if port is not None:
+        print(f"问答服务已在 http://{host}:{port} 上启动")
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await server.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="常驻的知识库问答服务")
+    parser.add_argument("--knowledge-file", default=None, help="知识库文件，默认与main.py相同")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="Unix套接字路径，传空字符串表示不启用")
+    parser.add_argument("--host", default=DEFAULT_HTTP_HOST)
+    parser.add_argument("--port", type=int, default=None, help="HTTP端口，默认不启用HTTP")
+    parser.add_argument("--batch-window-ms", type=float, default=BATCH_WINDOW * 1000)
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--watch", action="store_true", help="JSON知识库文件修改后自动重新加载")
+    args = parser.parse_args()
+
+    # 确保中文分词正常工作（与jieba.setLogLevel相同，但不必提前导入jieba）
+    logging.getLogger('jieba').setLevel(logging.INFO)
+    knowledge_file = args.knowledge_file or default_knowledge_file()
+    print(f"正在加载知识库 {knowledge_file} ...")
+    # 与交互界面使用相同的参数，共用同一个索引快照
+    qa_system = LocalKnowledgeBaseQA(knowledge_file=knowledge_file, **default_options())
+    if args.watch:
+        try:
+            qa_system.watch()
+        except ValueError as e:
+            # SQLite知识库等不是从JSON文件加载的知识库不能监视，继续提供服务
+            print(f"警告：{e}，--watch不生效")
+
+    try:
+        asyncio.run(serve(qa_system, args.socket or None, args.host, args.port,
+                          args.batch_window_ms / 1000, args.max_batch_size))
+    except KeyboardInterrupt:
+        print("\n问答服务已停止")
+
+
+if __name__ == "__main__":
+    main()
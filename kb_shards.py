@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分片知识库
+按问题ID的领域前缀（Q_DAY_、Q_HEALTH_等）或按知识库文件把知识库拆成多个分片，
+每个分片是一个独立的LocalKnowledgeBaseQA，有自己的词表、索引和索引快照，可以单独重建。
+查询在线程池中分发到各分片，再按得分合并为全局的前top_n个结果。
+默认各分片共用按全部证据计算的IDF，合并后的排序与不分片时一致。
+也可作为命令行工具把一个JSON知识库按前缀拆分为多个文件。
+"""
+
+import argparse
+import functools
+import glob
+import json
+import os
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from kb_sqlite import SQLITE_SUFFIXES
+from main import IndexSnapshot, LocalKnowledgeBaseQA, iter_knowledge_json, normalize_query
+
+# 分片目录中识别为知识库的文件扩展名
+SHARD_SUFFIXES = ('.json',) + SQLITE_SUFFIXES
+
+# 路由函数：根据查询返回要检索的分片名，返回None表示检索全部分片
+Router = Callable[[str], Optional[Iterable[str]]]
+
+
+def question_prefix(question_id: str) -> str:
+    """问题ID的领域前缀，例如 Q_DAY_001 -> Q_DAY_"""
+    return re.sub(r'\d+$', '', question_id)
+
+
+def split_by_prefix(knowledge_base: Dict) -> Dict[str, Dict]:
+    """按问题ID的领域前缀拆分知识库字典，分片按前缀第一次出现的顺序排列"""
+    shards = {}
+    for question_id, question_data in knowledge_base.items():
+        shards.setdefault(question_prefix(question_id), {})[question_id] = question_data
+    return shards
+
+
+def split_knowledge_file(file_path: str, output_dir: str) -> Dict[str, str]:
+    """
+    把JSON知识库按领域前缀拆分为多个文件，每个前缀一个 <前缀>.json
+
+    源文件流式读取，不需要整体载入内存。
+
+    Returns:
+        前缀 -> 输出文件路径
+    """
+    shards = {}
+    for question_id, question_data, _, _ in iter_knowledge_json(file_path):
+        shards.setdefault(question_prefix(question_id), {})[question_id] = question_data
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    for prefix, knowledge_base in shards.items():
+        paths[prefix] = os.path.join(output_dir, prefix.rstrip('_') + '.json')
+        with open(paths[prefix], 'w', encoding='utf-8') as f:
+            json.dump(knowledge_base, f, ensure_ascii=False, indent=2)
+    return paths
+
+
+def _exclusive(method):
+    """修改分片和重算全局IDF的方法互相排斥，查询不加锁，只读各分片的索引快照"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._write_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class KeywordRouter:
+    """
+    关键词路由：查询包含某个分片的任一关键词时只检索这些分片，
+    一个关键词都没有命中时检索全部分片
+    """
+
+    def __init__(self, keywords: Dict[str, Iterable[str]]):
+        """
+        Args:
+            keywords: 分片名 -> 关键词列表
+        """
+        self.keywords = {name: [word.lower() for word in words] for name, words in keywords.items()}
+
+    def __call__(self, query: str) -> Optional[List[str]]:
+        text = query.lower()
+        names = [name for name, words in self.keywords.items() if any(word in text for word in words)]
+        return names or None
+
+
+class ShardedKnowledgeBaseQA:
+    def __init__(self, shards: Dict[str, LocalKnowledgeBaseQA], router: Optional[Router] = None,
+                 workers: Optional[int] = None, global_idf: bool = True,
+                 sources: Optional[Dict[str, str]] = None, shard_options: Optional[Dict] = None):
+        """
+        初始化分片知识库问答系统
+
+        一般通过from_dict、from_files或from_directory创建。
+
+        Args:
+            shards: 分片名 -> 分片，检索结果得分相同时按这里的顺序排列
+            router: 路由函数，None表示每个查询都检索全部分片
+            workers: 并行检索的线程数，None表示分片数与CPU核心数中较小的一个，1表示不使用线程池
+            global_idf: 各分片是否共用按全部证据计算的IDF；为False时每个分片完全独立，
+                得分只在分片内可比
+            sources: 分片名 -> 知识库文件路径，rebuild_shard重新加载时使用
+            shard_options: 重新加载分片时传给LocalKnowledgeBaseQA的参数
+        """
+        if not shards:
+            raise ValueError("至少需要一个分片")
+        self.shards = dict(shards)
+        self.router = router
+        self.workers = workers or min(len(self.shards), os.cpu_count() or 1)
+        self._sources = dict(sources or {})
+        self._shard_options = dict(shard_options or {})
+        self._executor = None
+        self._write_lock = threading.RLock()
+
+        # 共用IDF时由这里统一重算：分片各自的自动重算关闭，改为累计修改次数
+        self.global_idf = global_idf
+        self._idf = {}  # 词 -> 全局IDF权重
+        self.idf_refresh_interval = self._shard_options.get('idf_refresh_interval', 100)
+        self._mutations_since_idf = 0
+        self._question_match_hits = 0
+        self._question_match_misses = 0
+        if global_idf:
+            for shard in self.shards.values():
+                shard.idf_refresh_interval = None
+            self.sync_idf()
+
+        # 领域前缀 -> 分片名，新增问题时按前缀决定写入哪个分片
+        self._prefix_shards = {}
+        for name, shard in self.shards.items():
+            for question_id in shard.question_ids:
+                self._prefix_shards.setdefault(question_prefix(question_id), name)
+
+    @classmethod
+    def from_dict(cls, knowledge_base: Dict, router: Optional[Router] = None,
+                  workers: Optional[int] = None, global_idf: bool = True, **options) -> 'ShardedKnowledgeBaseQA':
+        """按领域前缀把知识库字典拆成分片，分片名即前缀；options传给每个LocalKnowledgeBaseQA"""
+        shards = {prefix: LocalKnowledgeBaseQA(knowledge_dict=part, **options)
+                  for prefix, part in split_by_prefix(knowledge_base).items()}
+        return cls(shards, router, workers, global_idf, shard_options=options)
+
+    @classmethod
+    def from_files(cls, file_paths: List[str], router: Optional[Router] = None,
+                   workers: Optional[int] = None, global_idf: bool = True, **options) -> 'ShardedKnowledgeBaseQA':
+        """
+        每个知识库文件（JSON或SQLite）一个分片，分片名为不带扩展名的文件名
+
+        每个文件有各自的索引快照，只有内容变化的文件需要重新构建索引。
+        """
+        sources = {os.path.splitext(os.path.basename(path))[0]: path for path in file_paths}
+        if len(sources) != len(file_paths):
+            raise ValueError("分片文件名（不含扩展名）不能重复")
+        shards = {name: LocalKnowledgeBaseQA(knowledge_file=path, **options)
+                  for name, path in sources.items()}
+        return cls(shards, router, workers, global_idf, sources, options)
+
+    @classmethod
+    def from_directory(cls, directory: str, router: Optional[Router] = None,
+                       workers: Optional[int] = None, global_idf: bool = True, **options) -> 'ShardedKnowledgeBaseQA':
+        """目录下的每个知识库文件一个分片，按文件名排序"""
+        file_paths = sorted(path for path in glob.glob(os.path.join(directory, '*'))
+                            if path.lower().endswith(SHARD_SUFFIXES))
+        if not file_paths:
+            raise ValueError(f"目录 {directory} 中没有知识库文件")
+        return cls.from_files(file_paths, router, workers, global_idf, **options)
+
+    @_exclusive
+    def sync_idf(self) -> None:
+        """
+        按全部分片的未删除证据重算IDF，并换到各分片上
+
+        公式与LocalKnowledgeBaseQA.refresh_idf相同，只是文档频率和证据数按所有分片合计；
+        分片内没有出现的词权重仍为0。只缩放已有的向量，不需要重新分词。
+        """
+        # document_frequencies先把待并入的新增行并入索引，之后词表与文档频率的列一一对应
+        frequencies = [(shard, shard.document_frequencies(), list(shard.term_idf()))
+                       for shard in self.shards.values()]
+        n_docs = sum(shard.evidence_count for shard in self.shards.values())
+        total = defaultdict(int)
+        for shard, doc_freq, terms in frequencies:
+            for term, count in zip(terms, doc_freq.tolist()):
+                if count:
+                    total[term] += count
+        self._idf = {term: math.log((1 + n_docs) / (1 + count)) + 1 for term, count in total.items()}
+
+        for shard, doc_freq, terms in frequencies:
+            # 新增证据的词在分片内是新词时，取全局IDF或按全部分片的证据数计算
+            shard.set_external_idf(n_docs - shard.evidence_count, self._idf)
+            if shard.kb_vectors is None:
+                continue
+            new_idf = np.array([self._idf.get(term, 0.0) for term in terms])
+            new_idf[doc_freq == 0] = 0
+            shard.apply_idf(new_idf)
+        self._mutations_since_idf = 0
+
+    def _after_mutation(self, shard: LocalKnowledgeBaseQA, n_terms: int) -> None:
+        """
+        分片内容变化后累计修改次数，共用IDF时由查询前的_ensure_idf统一重算
+
+        Args:
+            shard: 被修改的分片
+            n_terms: 修改前分片的词表大小
+        """
+        self._mutations_since_idf += 1
+        if self.global_idf:
+            # 全局范围内的新词在下次重算之前只出现在这个分片中，全局模长暂时按分片给它的权重计算
+            for term, weight in shard.term_idf(n_terms).items():
+                self._idf.setdefault(term, weight)
+
+    def _ensure_idf(self) -> None:
+        """共用IDF且修改累计到idf_refresh_interval次时重算全局IDF；多个查询线程同时发现时只重算一次"""
+        if self._idf_due():
+            with self._write_lock:
+                if self._idf_due():
+                    self.sync_idf()
+
+    def _idf_due(self) -> bool:
+        return (self.global_idf and self.idf_refresh_interval is not None
+                and self._mutations_since_idf >= self.idf_refresh_interval)
+
+    def _query_norm(self, tokens: Tuple[str, ...], snapshot: Optional[IndexSnapshot] = None) -> float:
+        """
+        查询TF-IDF向量的模长：snapshot为None时按全局IDF，否则只算分片快照词表中权重非零的词
+
+        分片的得分是按分片内模长归一化的，乘以两者之比即换算为全局归一化的余弦相似度。
+        分片的模长必须与检索读取同一个快照，快照之后追加的词不计入。
+        """
+        total = 0.0
+        for term, count in Counter(tokens).items():
+            if snapshot is None:
+                weight = self._idf.get(term, 0.0)
+            else:
+                column = snapshot.vocabulary.get(term)
+                weight = snapshot.idf[column] if column is not None and column < snapshot.n_terms else 0.0
+            total += (count * weight) ** 2
+        return math.sqrt(total)
+
+    def _search_shard(self, name: str, queries: List[str], tokens: List[Tuple[str, ...]],
+                      global_norms: List[float], top_n: int) -> List[List[Dict]]:
+        """
+        在一个分片中批量检索
+
+        分片词表中没有任何查询词（或这些词的权重都为0）时该分片不可能有得分，直接跳过；
+        共用IDF时把得分换算为全局归一化的余弦相似度。模长和检索都读取开始时取得的同一个分片快照。
+        """
+        shard = self.shards[name]
+        snapshot = shard.snapshot()
+        all_results = [[] for _ in queries]
+        norms = [self._query_norm(query_tokens, snapshot) for query_tokens in tokens]
+        positions = [i for i, norm in enumerate(norms) if norm > 0]
+        if not positions:
+            return all_results
+
+        searched = shard.search_knowledge_batch([queries[i] for i in positions], top_n, snapshot=snapshot)
+        for i, results in zip(positions, searched):
+            if self.global_idf and global_norms[i] > 0:
+                scale = norms[i] / global_norms[i]
+                for result in results:
+                    result['score'] *= scale
+            all_results[i] = results
+        return all_results
+
+    def _analyze_queries(self, queries: List[str]) -> Tuple[List[Tuple[str, ...]], List[float]]:
+        """各查询只分词一次（各分片的文本特征相同），并计算按全局IDF的模长"""
+        analyzer = next(iter(self.shards.values()))
+        tokens = [analyzer.query_terms(query) for query in queries]
+        global_norms = [self._query_norm(query_tokens) for query_tokens in tokens]
+        return tokens, global_norms
+
+    def close(self) -> None:
+        """关闭检索线程池"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _map(self, function: Callable, items: List) -> List:
+        """对各分片的任务并行执行function，结果顺序与items一致"""
+        if self.workers <= 1 or len(items) <= 1:
+            return [function(item) for item in items]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return list(self._executor.map(function, items))
+
+    def _route(self, query: str, shards: Optional[Iterable[str]] = None) -> List[str]:
+        """查询需要检索的分片名；显式指定的shards优先于路由函数"""
+        if shards is None and self.router is not None:
+            shards = self.router(query)
+        if shards is None:
+            return list(self.shards)
+        names = set(shards)
+        unknown = names - self.shards.keys()
+        if unknown:
+            raise KeyError(f"分片 {', '.join(sorted(unknown))} 不存在")
+        return [name for name in self.shards if name in names]
+
+    @staticmethod
+    def _merge(shard_results: List[List[Dict]], top_n: int) -> List[Dict]:
+        """合并各分片按得分降序的结果，得分相同时保持分片顺序和分片内的顺序"""
+        merged = [result for results in shard_results for result in results]
+        merged.sort(key=lambda result: -result['score'])
+        return merged[:top_n]
+
+    def search_knowledge(self, query: str, top_n: int = 3,
+                         shards: Optional[Iterable[str]] = None) -> List[Dict]:
+        """
+        在各分片中搜索并合并结果
+
+        默认各分片共用全局IDF，分片内的得分换算为按全局IDF归一化的余弦相似度后合并，排序与不分片时一致；
+        global_idf为False时IDF按分片各自的证据计算，直接按分片内的得分合并。
+
+        Args:
+            query: 查询文本
+            top_n: 返回的结果数量
+            shards: 只检索这些分片，None表示交给路由函数决定
+
+        Returns:
+            与LocalKnowledgeBaseQA.search_knowledge格式相同的结果列表
+        """
+        self._ensure_idf()
+        names = self._route(query, shards)
+        tokens, global_norms = self._analyze_queries([query])
+        shard_results = self._map(
+            lambda name: self._search_shard(name, [query], tokens, global_norms, top_n)[0], names)
+        return self._merge(shard_results, top_n)
+
+    def search_knowledge_batch(self, queries: List[str], top_n: int = 3) -> List[List[Dict]]:
+        """批量搜索，每个分片只处理路由到它的查询，并且只调用一次批量检索"""
+        self._ensure_idf()
+        tokens, global_norms = self._analyze_queries(queries)
+        routed = {name: [] for name in self.shards}
+        for position, query in enumerate(queries):
+            for name in self._route(query):
+                routed[name].append(position)
+        tasks = [(name, positions) for name, positions in routed.items() if positions]
+
+        def search(task):
+            name, positions = task
+            return self._search_shard(name, [queries[i] for i in positions],
+                                      [tokens[i] for i in positions],
+                                      [global_norms[i] for i in positions], top_n)
+
+        per_query = [[] for _ in queries]
+        for (name, positions), shard_results in zip(tasks, self._map(search, tasks)):
+            for position, results in zip(positions, shard_results):
+                per_query[position].append(results)
+        return [self._merge(shard_results, top_n) for shard_results in per_query]
+
+    def generate_answer(self, query: str, top_n: int = 3) -> Dict:
+        """
+        基于各分片生成问题的答案
+
+        先在路由到的分片中做问题精确匹配，都没有命中时再检索合并。
+        """
+        names = self._route(query)
+        normalized = normalize_query(query)
+        matched = []
+        for name in names:
+            shard = self.shards[name]
+            snapshot = shard.snapshot()
+            if normalized in snapshot.question_lookup:
+                matched.extend(shard.match_question(query, top_n, snapshot) or [])
+        if matched:
+            self._question_match_hits += 1
+            results = matched[:top_n]
+        else:
+            self._question_match_misses += 1
+            results = self.search_knowledge(query, top_n, names)
+        return LocalKnowledgeBaseQA.answer_from_results(results)
+
+    def shard_for(self, question_id: str) -> str:
+        """问题所在的分片；新问题按领域前缀归入已有该前缀问题的分片"""
+        for name, shard in self.shards.items():
+            if shard.has_question(question_id):
+                return name
+        name = self._prefix_shards.get(question_prefix(question_id))
+        if name is None:
+            raise KeyError(f"没有分片接收前缀为 {question_prefix(question_id)} 的问题")
+        return name
+
+    @_exclusive
+    def add_evidence(self, question_id: str, evidence_id: str, evidence: str,
+                     answer: Optional[List[str]] = None, question: Optional[str] = None) -> None:
+        """向问题所在的分片新增一条证据，参数同LocalKnowledgeBaseQA.add_evidence"""
+        shard = self.shards[self.shard_for(question_id)]
+        n_terms = shard.vocabulary_size
+        shard.add_evidence(question_id, evidence_id, evidence, answer, question)
+        self._after_mutation(shard, n_terms)
+
+    @_exclusive
+    def update_evidence(self, question_id: str, evidence_id: str, evidence: Optional[str] = None,
+                        answer: Optional[List[str]] = None) -> None:
+        """修改问题所在分片中的一条证据，参数同LocalKnowledgeBaseQA.update_evidence"""
+        shard = self.shards[self.shard_for(question_id)]
+        n_terms = shard.vocabulary_size
+        shard.update_evidence(question_id, evidence_id, evidence, answer)
+        self._after_mutation(shard, n_terms)
+
+    @_exclusive
+    def remove_question(self, question_id: str) -> None:
+        """从问题所在的分片中删除问题"""
+        shard = self.shards[self.shard_for(question_id)]
+        shard.remove_question(question_id)
+        self._after_mutation(shard, shard.vocabulary_size)
+
+    @_exclusive
+    def rebuild_shard(self, name: str) -> None:
+        """
+        单独重建一个分片，其他分片不受影响
+
+        来自文件的分片重新加载文件：内容没变时直接恢复索引快照，变了才重新构建；
+        来自字典的分片按当前内容重新构建索引。共用IDF时其余分片只按新的IDF缩放向量，不重新分词。
+        """
+        if name not in self.shards:
+            raise KeyError(f"分片 {name} 不存在")
+        if name in self._sources:
+            shard = LocalKnowledgeBaseQA(knowledge_file=self._sources[name], **self._shard_options)
+            self.shards[name] = shard
+        else:
+            shard = self.shards[name]
+            shard.rebuild_index()
+        for question_id in shard.question_ids:
+            self._prefix_shards.setdefault(question_prefix(question_id), name)
+        if self.global_idf:
+            shard.idf_refresh_interval = None
+            self.sync_idf()
+
+    @property
+    def question_count(self) -> int:
+        """全部分片的问题数量"""
+        return sum(shard.question_count for shard in self.shards.values())
+
+    @property
+    def evidence_count(self) -> int:
+        """全部分片的证据数量"""
+        return sum(shard.evidence_count for shard in self.shards.values())
+
+    def question_match_stats(self) -> Dict:
+        """generate_answer中问题精确匹配快速路径的命中情况，size为各分片索引大小之和"""
+        lookups = self._question_match_hits + self._question_match_misses
+        return {
+            "size": sum(shard.question_match_stats()["size"] for shard in self.shards.values()),
+            "hits": self._question_match_hits,
+            "misses": self._question_match_misses,
+            "hit_rate": self._question_match_hits / lookups if lookups else 0.0,
+        }
+
+    def shard_stats(self) -> Dict[str, Dict]:
+        """各分片的规模"""
+        return {
+            name: {
+                "questions": shard.question_count,
+                "evidences": shard.evidence_count,
+                "terms": shard.vocabulary_size,
+                "source": self._sources.get(name),
+            }
+            for name, shard in self.shards.items()
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="知识库分片工具")
+    subparsers = parser.add_subparsers(dest="command")
+
+    split_parser = subparsers.add_parser("split", help="把JSON知识库按领域前缀拆分为多个文件")
+    split_parser.add_argument("json_file", nargs="?", default="knowledge_base.json")
+    split_parser.add_argument("output_dir", nargs="?", default="knowledge_shards")
+
+    args = parser.parse_args()
+    if args.command == "split":
+        try:
+            paths = split_knowledge_file(args.json_file, args.output_dir)
+        except Exception as e:
+            print(f"拆分失败: {e}")
+            return
+        print(f"已将 {args.json_file} 拆分为 {len(paths)} 个分片:")
+        for prefix, path in paths.items():
+            print(f"- {prefix}: {path}")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite知识库后端
+问题和证据分别存放在带索引的表中，检索时只读取命中条目的证据和答案；
+所有修改由触发器记入changes表，加载时只需重放索引快照之后的修改。
+也可作为命令行工具在JSON知识库和SQLite知识库之间互相转换。
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from kb_store import KnowledgeStore
+
+# 识别为SQLite知识库的文件扩展名
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+
+# 数据库结构版本
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS questions (
+    id INTEGER PRIMARY KEY,
+    qid TEXT NOT NULL UNIQUE,
+    question TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS evidences (
+    id INTEGER PRIMARY KEY,
+    question_id INTEGER NOT NULL,
+    eid TEXT NOT NULL,
+    evidence TEXT NOT NULL DEFAULT '',
+    answers TEXT NOT NULL DEFAULT '[]',
+    UNIQUE (question_id, eid)
+);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    qid TEXT,
+    eid TEXT
+);
+"""
+
+# eid为NULL的记录表示整个问题都需要重新同步
+_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS questions_insert AFTER INSERT ON questions BEGIN
+    INSERT INTO changes (qid) VALUES (NEW.qid);
+END;
+CREATE TRIGGER IF NOT EXISTS questions_update AFTER UPDATE ON questions BEGIN
+    INSERT INTO changes (qid) VALUES (OLD.qid);
+    INSERT INTO changes (qid) SELECT NEW.qid WHERE NEW.qid != OLD.qid;
+END;
+CREATE TRIGGER IF NOT EXISTS questions_delete AFTER DELETE ON questions BEGIN
+    DELETE FROM evidences WHERE question_id = OLD.id;
+    INSERT INTO changes (qid) VALUES (OLD.qid);
+END;
+CREATE TRIGGER IF NOT EXISTS evidences_insert AFTER INSERT ON evidences BEGIN
+    INSERT INTO changes (qid, eid) SELECT qid, NEW.eid FROM questions WHERE id = NEW.question_id;
+END;
+CREATE TRIGGER IF NOT EXISTS evidences_update AFTER UPDATE ON evidences BEGIN
+    INSERT INTO changes (qid, eid) SELECT qid, OLD.eid FROM questions WHERE id = OLD.question_id;
+    INSERT INTO changes (qid, eid) SELECT qid, NEW.eid FROM questions WHERE id = NEW.question_id
+        AND (NEW.eid != OLD.eid OR NEW.question_id != OLD.question_id);
+END;
+CREATE TRIGGER IF NOT EXISTS evidences_delete AFTER DELETE ON evidences BEGIN
+    INSERT INTO changes (qid, eid) SELECT qid, OLD.eid FROM questions WHERE id = OLD.question_id;
+END;
+"""
+
+
+def is_sqlite_path(file_path: str) -> bool:
+    """按扩展名判断是否为SQLite知识库"""
+    return file_path.lower().endswith(SQLITE_SUFFIXES)
+
+
+class SqliteKnowledgeBase:
+    """SQLite知识库的读写封装，同一连接可在多个线程间共享"""
+
+    def __init__(self, db_path: str):
+        """
+        打开（不存在时创建）SQLite知识库
+
+        Args:
+            db_path: 数据库文件路径
+        """
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+        # 建表语句都带IF NOT EXISTS，打开已有的数据库时不会有变化
+        self._conn.executescript(_SCHEMA + _TRIGGERS)
+        with self._transaction():
+            self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('schema', ?)",
+                               (str(SCHEMA_VERSION),))
+            self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('uuid', ?)",
+                               (uuid.uuid4().hex,))
+        schema = self._meta('schema')
+        if schema != str(SCHEMA_VERSION):
+            raise ValueError(f"不支持的知识库结构版本: {schema}")
+
+    def close(self) -> None:
+        self._conn.close()
+
+    @contextmanager
+    def _transaction(self, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+        """在一个事务中执行，读操作也放在事务里以得到一致的快照"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def uuid(self) -> str:
+        """数据库创建时生成的标识，索引快照以它区分不同的数据库"""
+        return self._meta('uuid')
+
+    @staticmethod
+    def _revision(conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def revision(self) -> int:
+        """当前的修改序号，每次修改都会递增，清理修改记录后也不会回退"""
+        with self._lock:
+            return self._revision(self._conn)
+
+    def build_store(self) -> Tuple[KnowledgeStore, List[str], int]:
+        """
+        读取全部问题和需要建立索引的证据，用于整体构建索引
+
+        Returns:
+            (只含ID的存储，条目数据按需从数据库读取, 各行的证据文本, 读取时的修改序号)
+        """
+        questions = []
+        question_numbers = {}
+        rows = []
+        texts = []
+        with self._transaction() as conn:
+            revision = self._revision(conn)
+            for rowid, question_id in conn.execute("SELECT id, qid FROM questions ORDER BY id"):
+                question_numbers[rowid] = len(questions)
+                questions.append((question_id, rowid, 0))
+            for rowid, evidence_id, evidence in conn.execute(
+                    "SELECT question_id, eid, evidence FROM evidences "
+                    "WHERE evidence != '' ORDER BY id"):
+                rows.append((question_numbers[rowid], evidence_id))
+                texts.append(evidence)
+        return KnowledgeStore.from_ids(questions, rows, self.load_question), texts, revision
+
+    def store_for(self, kb_ids: List[str]) -> KnowledgeStore:
+        """
+        按索引快照中的条目顺序组装存储，不读取证据文本
+
+        快照之后被删除的问题以空问题占位，随后重放修改时会被删掉。
+        """
+        with self._lock:
+            questions = [(question_id, rowid, 0) for rowid, question_id in
+                         self._conn.execute("SELECT id, qid FROM questions ORDER BY id")]
+        question_numbers = {question_id: i for i, (question_id, _, _) in enumerate(questions)}
+
+        rows = []
+        for full_id in kb_ids:
+            question_id, evidence_id = full_id.split('#', 1)
+            question_number = question_numbers.get(question_id)
+            if question_number is None:
+                question_number = question_numbers[question_id] = len(questions)
+                questions.append((question_id, -1, 0))
+            rows.append((question_number, evidence_id))
+        return KnowledgeStore.from_ids(questions, rows, self.load_question)
+
+    def load_question(self, rowid: int, _length: int = 0) -> Dict:
+        """按问题的行号读取问题数据，格式与knowledge_base.json中的一个问题相同"""
+        with self._lock:
+            row = self._conn.execute("SELECT question FROM questions WHERE id = ?", (rowid,)).fetchone()
+            evidences = self._conn.execute(
+                "SELECT eid, evidence, answers FROM evidences WHERE question_id = ? ORDER BY id",
+                (rowid,)).fetchall()
+        return {
+            "question": row[0] if row else '',
+            "evidences": {
+                evidence_id: {"answer": json.loads(answers), "evidence": evidence}
+                for evidence_id, evidence, answers in evidences
+            }
+        }
+
+    def get_question(self, question_id: str) -> Optional[Dict]:
+        """按问题ID读取问题数据，不存在时返回None"""
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM questions WHERE qid = ?", (question_id,)).fetchone()
+            return self.load_question(row[0]) if row else None
+
+    def changes_since(self, revision: int, until: int) -> List[Tuple[str, Optional[str]]]:
+        """修改序号在(revision, until]之间被修改过的(问题ID, 证据ID)，证据ID为None表示整个问题"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT qid, eid FROM changes WHERE seq > ? AND seq <= ? AND qid IS NOT NULL "
+                "GROUP BY qid, eid ORDER BY MIN(seq)", (revision, until)).fetchall()
+
+    def prune_changes(self, revision: int) -> None:
+        """索引快照已包含的修改记录不再需要"""
+        with self._transaction(immediate=True) as conn:
+            conn.execute("DELETE FROM changes WHERE seq <= ?", (revision,))
+
+    @staticmethod
+    def _question_rowid(conn: sqlite3.Connection, question_id: str,
+                        question: Optional[str] = None) -> int:
+        """问题的行号，不存在时新建；question不为None时同时更新问题文本"""
+        row = conn.execute("SELECT id, question FROM questions WHERE qid = ?", (question_id,)).fetchone()
+        if row is None:
+            return conn.execute("INSERT INTO questions (qid, question) VALUES (?, ?)",
+                                (question_id, question or '')).lastrowid
+        if question is not None and question != row[1]:
+            conn.execute("UPDATE questions SET question = ? WHERE id = ?", (question, row[0]))
+        return row[0]
+
+    def put_evidence(self, question_id: str, evidence_id: str, evidence: str,
+                     answers: List[str], question: Optional[str] = None) -> None:
+        """新增或覆盖一条证据，问题不存在时一并新建"""
+        with self._transaction(immediate=True) as conn:
+            rowid = self._question_rowid(conn, question_id, question)
+            answers_json = json.dumps(list(answers), ensure_ascii=False)
+            updated = conn.execute(
+                "UPDATE evidences SET evidence = ?, answers = ? WHERE question_id = ? AND eid = ?",
+                (evidence, answers_json, rowid, evidence_id)).rowcount
+            if not updated:
+                conn.execute(
+                    "INSERT INTO evidences (question_id, eid, evidence, answers) VALUES (?, ?, ?, ?)",
+                    (rowid, evidence_id, evidence, answers_json))
+
+    def update_evidence(self, question_id: str, evidence_id: str, evidence: Optional[str] = None,
+                        answers: Optional[List[str]] = None) -> None:
+        """修改已有证据的文本或答案，为None的字段保持不变"""
+        with self._transaction(immediate=True) as conn:
+            rowid = self._question_rowid(conn, question_id)
+            if evidence is not None:
+                conn.execute("UPDATE evidences SET evidence = ? WHERE question_id = ? AND eid = ?",
+                             (evidence, rowid, evidence_id))
+            if answers is not None:
+                conn.execute("UPDATE evidences SET answers = ? WHERE question_id = ? AND eid = ?",
+                             (json.dumps(list(answers), ensure_ascii=False), rowid, evidence_id))
+
+    def remove_question(self, question_id: str) -> None:
+        """删除问题及其全部证据"""
+        with self._transaction(immediate=True) as conn:
+            conn.execute("DELETE FROM questions WHERE qid = ?", (question_id,))
+
+    def rename_question(self, old_id: str, new_id: str) -> None:
+        """修改问题ID，证据ID中包含的旧问题ID一并替换"""
+        with self._transaction(immediate=True) as conn:
+            row = conn.execute("SELECT id FROM questions WHERE qid = ?", (old_id,)).fetchone()
+            if row is None:
+                raise KeyError(f"问题 {old_id} 不存在")
+            conn.execute("UPDATE questions SET qid = ? WHERE id = ?", (new_id, row[0]))
+            conn.execute("UPDATE evidences SET eid = replace(eid, ?, ?) WHERE question_id = ?",
+                         (old_id, new_id, row[0]))
+
+    def has_question(self, question_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM questions WHERE qid = ?",
+                                      (question_id,)).fetchone() is not None
+
+    def question_ids(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT qid FROM questions ORDER BY id")]
+
+    def import_dict(self, knowledge_base: Dict) -> None:
+        """把knowledge_base.json格式的字典整体导入空数据库"""
+        with self._transaction(immediate=True) as conn:
+            if conn.execute("SELECT 1 FROM questions LIMIT 1").fetchone():
+                raise ValueError(f"数据库 {self.db_path} 不是空的")
+            for question_id, question_data in knowledge_base.items():
+                rowid = conn.execute("INSERT INTO questions (qid, question) VALUES (?, ?)",
+                                     (question_id, question_data.get('question', ''))).lastrowid
+                conn.executemany(
+                    "INSERT INTO evidences (question_id, eid, evidence, answers) VALUES (?, ?, ?, ?)",
+                    [(rowid, evidence_id, evidence_data.get('evidence', ''),
+                      json.dumps(evidence_data.get('answer', []), ensure_ascii=False))
+                     for evidence_id, evidence_data in question_data.get('evidences', {}).items()])
+            # 初始导入不算修改，没有快照时会整体构建索引
+            conn.execute("DELETE FROM changes")
+
+    def export_dict(self) -> Dict:
+        """导出为knowledge_base.json格式的字典，顺序与导入时一致"""
+        knowledge_base = {}
+        questions = {}
+        with self._transaction() as conn:
+            for rowid, question_id, question in conn.execute(
+                    "SELECT id, qid, question FROM questions ORDER BY id"):
+                questions[rowid] = knowledge_base[question_id] = {"question": question, "evidences": {}}
+            for rowid, evidence_id, evidence, answers in conn.execute(
+                    "SELECT question_id, eid, evidence, answers FROM evidences ORDER BY id"):
+                questions[rowid]["evidences"][evidence_id] = {
+                    "answer": json.loads(answers),
+                    "evidence": evidence
+                }
+        return knowledge_base
+
+
+def json_to_sqlite(json_path: str, db_path: str) -> None:
+    """把JSON知识库转换为SQLite知识库，目标文件必须不存在"""
+    if os.path.exists(db_path):
+        raise FileExistsError(f"目标文件 {db_path} 已存在")
+    with open(json_path, 'r', encoding='utf-8') as f:
+        knowledge_base = json.load(f)
+    db = SqliteKnowledgeBase(db_path)
+    try:
+        db.import_dict(knowledge_base)
+    finally:
+        db.close()
+
+
+def sqlite_to_json(db_path: str, json_path: str) -> None:
+    """把SQLite知识库导出为JSON知识库，格式与knowledge_base.json相同"""
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(f"文件 {db_path} 不存在")
+    db = SqliteKnowledgeBase(db_path)
+    try:
+        knowledge_base = db.export_dict()
+    finally:
+        db.close()
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(knowledge_base, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON知识库与SQLite知识库互相转换")
+    subparsers = parser.add_subparsers(dest="command")
+
+    to_sqlite = subparsers.add_parser("to-sqlite", help="JSON转换为SQLite")
+    to_sqlite.add_argument("json_file", nargs="?", default="knowledge_base.json")
+    to_sqlite.add_argument("db_file", nargs="?", default="knowledge_base.db")
+
+    to_json = subparsers.add_parser("to-json", help="SQLite导出为JSON")
+    to_json.add_argument("db_file", nargs="?", default="knowledge_base.db")
+    to_json.add_argument("json_file", nargs="?", default="knowledge_base_export.json")
+
+    args = parser.parse_args()
+    try:
+        if args.command == "to-sqlite":
+            json_to_sqlite(args.json_file, args.db_file)
+            print(f"已将 {args.json_file} 转换为 {args.db_file}")
+        elif args.command == "to-json":
+            sqlite_to_json(args.db_file, args.json_file)
+            print(f"已将 {args.db_file} 导出为 {args.json_file}")
+        else:
+            parser.print_help()
+    except Exception as e:
+        print(f"转换失败: {e}")
+
+
+if __name__ == "__main__":
+    main()
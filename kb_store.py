@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+紧凑的列式知识库存储
+问题、证据和答案文本分别拼接成连续的字符串，用整数偏移数组定位，
+问题ID和证据ID被驻留为整数编号，按行号取条目时只需数组下标访问
+"""
+
+import copy
+import json
+import re
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# 每行的证据ID、证据文本和答案用不可见的分隔符拼成一段，取一行只需一次切片
+FIELD_SEPARATOR = '\x1e'
+ANSWER_SEPARATOR = '\x1f'
+# 字段本身含分隔符时整行退回JSON编码，答案数记为该值
+_ROW_AS_JSON = -1
+
+# 答案没有另外给出时，以证据的第一段作为答案
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
+# 外部（仍在源文件中）问题数据的缓存容量
+EXTERNAL_CACHE_SIZE = 256
+
+# 问题 -> 行的分组之后追加的行超过该比例时重新分组，之前只对新增部分线性扫描
+REGROUP_RATIO = 0.125
+
+# 修改已有问题和行时会改写的列，与其他存储共用时先复制再改，见KnowledgeStore.copy
+_QUESTION_COLUMNS = ('questions', '_question_index', '_question_offsets', '_question_removed')
+_ROW_COLUMNS = ('rows', '_answer_counts', '_row_external', '_answer_starts', '_answer_ends', '_no_answer')
+
+
+class StringColumn:
+    """
+    只追加的字符串列
+
+    已固化的部分拼成一个字符串，用偏移数组切片取值；之后追加的值先放在列表里，
+    修改过的值记录在覆盖表中，take时再一起固化。
+    """
+
+    def __init__(self, values: Iterable[str] = ()):
+        values = list(values)
+        self._blob = ''.join(values)
+        self._offsets = array('q', accumulate([0] + [len(v) for v in values]))
+        self._fixed = len(values)
+        self._tail = []
+        self._overrides = {}
+
+    def __len__(self) -> int:
+        return self._fixed + len(self._tail)
+
+    def __getitem__(self, i: int) -> str:
+        if i < self._fixed and i not in self._overrides:
+            offsets = self._offsets
+            return self._blob[offsets[i]:offsets[i + 1]]
+        if i in self._overrides:
+            return self._overrides[i]
+        return self._tail[i - self._fixed]
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, value: str) -> None:
+        self._tail.append(value)
+
+    def set(self, i: int, value: str) -> None:
+        self._overrides[i] = value
+
+    def __copy__(self) -> 'StringColumn':
+        """共用已固化的部分，只复制追加和修改过的值"""
+        column = StringColumn()
+        column._blob = self._blob
+        column._offsets = self._offsets
+        column._fixed = self._fixed
+        column._tail = list(self._tail)
+        column._overrides = dict(self._overrides)
+        return column
+
+    def take(self, indices: Iterable[int]) -> 'StringColumn':
+        """按给定顺序取出部分值，组成新的固化列"""
+        return StringColumn(self[i] for i in indices)
+
+    def nbytes(self) -> int:
+        """粗略估计占用的内存字节数"""
+        n_chars = (len(self._blob) + sum(len(v) for v in self._tail)
+                   + sum(len(v) for v in self._overrides.values()))
+        # CPython按最宽的字符决定每个字符占1/2/4字节，中文通常为2字节
+        char_size = 2 if any(ord(c) > 0xff for c in self._blob[:1000]) else 1
+        return n_chars * char_size + self._offsets.itemsize * len(self._offsets)
+
+
+def _encode_row(evidence_id: str, evidence: str, answers: List[str]) -> Tuple[str, int]:
+    """把一行编码为一个字符串，返回(编码结果, 答案数)"""
+    text = evidence_id + FIELD_SEPARATOR + evidence + FIELD_SEPARATOR + ANSWER_SEPARATOR.join(answers)
+    # 分隔符的个数不对说明字段本身含有分隔符
+    if text.count(FIELD_SEPARATOR) != 2 or text.count(ANSWER_SEPARATOR) != max(len(answers) - 1, 0):
+        return json.dumps([evidence_id, evidence, answers], ensure_ascii=False), _ROW_AS_JSON
+    return text, len(answers)
+
+
+def _decode_row(text: str, count: int) -> Tuple[str, str, List[str]]:
+    """_encode_row的逆运算，返回(证据ID, 证据文本, 答案列表)"""
+    if count == _ROW_AS_JSON:
+        evidence_id, evidence, answers = json.loads(text)
+        return evidence_id, evidence, answers
+    evidence_id, evidence, answers = text.split(FIELD_SEPARATOR, 2)
+    return evidence_id, evidence, answers.split(ANSWER_SEPARATOR) if count else []
+
+
+def final_answer(evidence: str, answers: List[str]) -> str:
+    """一条证据对应的回答：有答案时取第一个答案，否则取证据的第一段"""
+    if answers:
+        return answers[0]
+    return _PARAGRAPH_BREAK.split(evidence.strip(), 1)[0]
+
+
+def _answer_span(evidence_id: str, evidence: str, answers: List[str], count: int) -> Tuple[int, int]:
+    """
+    final_answer的结果在_encode_row编码串中的位置，它总是编码串的一段连续切片
+
+    Returns:
+        (起始, 结束)；按JSON编码的行返回(-1, -1)，查询时再解码计算
+    """
+    if count == _ROW_AS_JSON:
+        return -1, -1
+    start = len(evidence_id) + 1
+    if answers:
+        start += len(evidence) + 1
+        return start, start + len(answers[0])
+    stripped = evidence.strip()
+    start += len(evidence) - len(evidence.lstrip())
+    match = _PARAGRAPH_BREAK.search(stripped)
+    return start, start + (match.start() if match else len(stripped))
+
+
+class FullIdView(Sequence):
+    """以"问题ID#证据ID"字符串的形式只读访问每一行，不常驻这些字符串"""
+
+    def __init__(self, store: 'KnowledgeStore'):
+        self._store = store
+
+    def __len__(self) -> int:
+        return self._store.row_count
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return self._store.full_id(row)
+
+
+class KnowledgeStore:
+    """
+    列式知识库存储，行号与kb_vectors的行一一对应
+
+    问题ID驻留为整数编号，每行只记录所属问题的编号；问题文本和各行内容分别
+    拼接在两个字符串列里。只保存建立了索引的证据（证据文本非空）。
+    每行的回答（见final_answer）和是否为no_answer在写入时就确定，回答只记录在行内的位置。
+    流式加载时问题数据可以留在源文件中（外部条目），只记录字节位置，由loader按需读取。
+    """
+
+    def __init__(self, loader: Optional[Callable[[int, int], Dict]] = None):
+        """
+        Args:
+            loader: 读取外部问题数据的函数，参数为(字节偏移, 字节长度)，返回问题字典
+        """
+        self.loader = loader
+
+        # 问题表
+        self.question_ids = []  # 问题编号 -> 问题ID
+        self.questions = StringColumn()
+        self._question_index = {}  # 问题ID -> 问题编号
+        self._question_offsets = array('q')  # 外部问题的字节偏移，-1表示数据在内存中
+        self._question_lengths = array('q')
+        self._question_removed = bytearray()
+        self._removed_count = 0
+        self._external_cache = OrderedDict()
+
+        # 证据行
+        self.row_question = array('i')  # 行 -> 问题编号
+        self.rows = StringColumn()  # 证据ID、证据文本和答案，见_encode_row
+        self._answer_counts = array('i')
+        self._row_external = bytearray()
+        # 每行回答在编码串中的位置，-1表示需要查询时计算（外部行和按JSON编码的行）；答案是否含no_answer
+        self._answer_starts = array('i')
+        self._answer_ends = array('i')
+        self._no_answer = bytearray()
+        self._grouped = None  # (按问题排序的行号, 各问题的起始位置, 分组时的行数)
+        self._shared = set()  # 与其他存储共用、修改前要先复制的列名
+
+    @classmethod
+    def from_dict(cls, knowledge_base: Dict) -> 'KnowledgeStore':
+        """由knowledge_base.json格式的字典构建"""
+        store = cls()
+        questions = []
+        row_question, rows, answer_counts = [], [], []
+        answer_starts, answer_ends, no_answer = [], [], []
+        for question_number, (question_id, question_data) in enumerate(knowledge_base.items()):
+            store.question_ids.append(question_id)
+            questions.append(question_data.get('question', ''))
+            for evidence_id, evidence_data in question_data.get('evidences', {}).items():
+                evidence_text = evidence_data.get('evidence', '')
+                if evidence_text:
+                    answers = list(evidence_data.get('answer', []))
+                    text, count = _encode_row(evidence_id, evidence_text, answers)
+                    start, end = _answer_span(evidence_id, evidence_text, answers, count)
+                    row_question.append(question_number)
+                    rows.append(text)
+                    answer_counts.append(count)
+                    answer_starts.append(start)
+                    answer_ends.append(end)
+                    no_answer.append("no_answer" in answers)
+
+        n_questions = len(store.question_ids)
+        store.questions = StringColumn(questions)
+        store._question_index = {question_id: i for i, question_id in enumerate(store.question_ids)}
+        store._question_offsets = array('q', [-1]) * n_questions
+        store._question_lengths = array('q', [0]) * n_questions
+        store._question_removed = bytearray(n_questions)
+
+        store.row_question = array('i', row_question)
+        store.rows = StringColumn(rows)
+        store._answer_counts = array('i', answer_counts)
+        store._row_external = bytearray(len(rows))
+        store._answer_starts = array('i', answer_starts)
+        store._answer_ends = array('i', answer_ends)
+        store._no_answer = bytearray(no_answer)
+        return store
+
+    @classmethod
+    def from_ids(cls, questions: List[Tuple[str, int, int]], rows: List[Tuple[int, str]],
+                 loader: Callable[[int, int], Dict]) -> 'KnowledgeStore':
+        """
+        只由问题和证据的ID构建存储，条目内容留在外部，由loader按需读取
+
+        Args:
+            questions: (问题ID, 位置, 长度)，位置为-1的问题作为空问题放在内存中
+            rows: (问题编号, 证据ID)
+            loader: 读取外部问题数据的函数
+        """
+        store = cls(loader)
+        store.question_ids = [question_id for question_id, _, _ in questions]
+        store.questions = StringColumn([''] * len(questions))
+        store._question_index = {question_id: i for i, question_id in enumerate(store.question_ids)}
+        store._question_offsets = array('q', (offset for _, offset, _ in questions))
+        store._question_lengths = array('q', (length for _, _, length in questions))
+        store._question_removed = bytearray(len(questions))
+
+        offsets = store._question_offsets
+        store.row_question = array('i', (question_number for question_number, _ in rows))
+        encoded = [_encode_row(evidence_id, '', []) for _, evidence_id in rows]
+        store.rows = StringColumn(text for text, _ in encoded)
+        store._answer_counts = array('i', (count for _, count in encoded))
+        store._row_external = bytearray(offsets[question_number] >= 0 for question_number, _ in rows)
+        store._answer_starts = array('i', [-1]) * len(rows)
+        store._answer_ends = array('i', [-1]) * len(rows)
+        store._no_answer = bytearray(len(rows))
+        return store
+
+    @property
+    def row_count(self) -> int:
+        return len(self.row_question)
+
+    @property
+    def question_count(self) -> int:
+        return len(self.question_ids) - self._removed_count
+
+    @property
+    def full_ids(self) -> FullIdView:
+        return FullIdView(self)
+
+    def question_index(self, question_id: str) -> Optional[int]:
+        """问题ID对应的编号，不存在或已删除时返回None"""
+        return self._question_index.get(question_id)
+
+    def add_question(self, question_id: str, question: str = '',
+                     offset: int = -1, length: int = 0) -> int:
+        """
+        增加一个问题，返回问题编号
+
+        Args:
+            question_id: 问题ID
+            question: 问题文本
+            offset: 外部问题在源文件中的字节偏移，-1表示问题数据在内存中
+            length: 外部问题数据的字节长度
+        """
+        question_number = len(self.question_ids)
+        self.question_ids.append(question_id)
+        self.questions.append(question if offset < 0 else '')
+        self._question_index[question_id] = question_number
+        self._question_offsets.append(offset)
+        self._question_lengths.append(length)
+        self._question_removed.append(0)
+        return question_number
+
+    def append_row(self, question_number: int, evidence_id: str,
+                   evidence: Optional[str] = None, answers: Optional[List[str]] = None) -> int:
+        """
+        追加一行证据，返回行号
+
+        evidence为None表示该行属于外部问题，证据文本和答案留在源文件中。
+        """
+        row = self.row_count
+        external = evidence is None
+        if not external:
+            # 内存中的行只属于内存中的问题
+            self._materialize(question_number)
+        self.row_question.append(question_number)
+        answers = list(answers or [])
+        text, count = _encode_row(evidence_id, '' if external else evidence, answers)
+        start, end = (-1, -1) if external else _answer_span(evidence_id, evidence, answers, count)
+        self.rows.append(text)
+        self._answer_counts.append(count)
+        self._row_external.append(external)
+        self._answer_starts.append(start)
+        self._answer_ends.append(end)
+        self._no_answer.append(not external and "no_answer" in answers)
+        return row
+
+    def copy(self) -> 'KnowledgeStore':
+        """
+        浅复制，与原来的存储共用全部列
+
+        之后修改已有问题或行时，被改写的列先整体复制一份（写时复制），原来的存储看不到这些修改；
+        追加的问题和行仍写入共用列的末尾，原来的存储按自己的行数只访问之前的部分。
+        已发布给查询的存储由问答系统复制后再修改，见IndexSnapshot。
+        """
+        store = copy.copy(self)
+        store._shared = set(_QUESTION_COLUMNS + _ROW_COLUMNS)
+        return store
+
+    def _writable(self, *names: str) -> None:
+        """把要改写的共用列换成自己的副本"""
+        for name in names:
+            if name in self._shared:
+                setattr(self, name, copy.copy(getattr(self, name)))
+                self._shared.discard(name)
+
+    def _set_row(self, row: int, evidence_id: str, evidence: str, answers: List[str]) -> None:
+        """改写一行内存中的证据和答案"""
+        self._writable(*_ROW_COLUMNS)
+        text, count = _encode_row(evidence_id, evidence, answers)
+        self.rows.set(row, text)
+        self._answer_counts[row] = count
+        self._answer_starts[row], self._answer_ends[row] = _answer_span(evidence_id, evidence, answers, count)
+        self._no_answer[row] = "no_answer" in answers
+
+    def _external_question(self, question_number: int) -> Dict:
+        """读取外部问题的数据，最近用过的若干个缓存在内存中"""
+        # 多个查询线程同时读取时，条目可能刚被其他线程淘汰，忽略KeyError即可
+        cache = self._external_cache
+        question_data = cache.get(question_number)
+        if question_data is not None:
+            try:
+                cache.move_to_end(question_number)
+            except KeyError:
+                pass
+            return question_data
+
+        question_data = self.loader(self._question_offsets[question_number],
+                                    self._question_lengths[question_number])
+        cache[question_number] = question_data
+        while len(cache) > EXTERNAL_CACHE_SIZE:
+            try:
+                cache.popitem(last=False)
+            except KeyError:
+                break
+        return question_data
+
+    def question_text(self, question_number: int) -> str:
+        if self._question_offsets[question_number] >= 0:
+            return self._external_question(question_number).get('question', '')
+        return self.questions[question_number]
+
+    def evidence_id(self, row: int) -> str:
+        return _decode_row(self.rows[row], self._answer_counts[row])[0]
+
+    def full_id(self, row: int) -> str:
+        return f"{self.question_ids[self.row_question[row]]}#{self.evidence_id(row)}"
+
+    def record(self, row: int) -> Tuple[str, str, str, List[str], str]:
+        """
+        按行号取出条目
+
+        Returns:
+            (问题ID, 证据ID, 问题文本, 答案列表, 证据文本)
+        """
+        question_number = self.row_question[row]
+        question_id = self.question_ids[question_number]
+        rows = self.rows
+        if (row < rows._fixed and self._answer_counts[row] > 0 and not self._row_external[row]
+                and row not in rows._overrides):
+            # 常见情况：有答案的内存行，直接在拼接串上切片，所属问题一定在内存中
+            offsets = rows._offsets
+            evidence_id, evidence, answers = rows._blob[offsets[row]:offsets[row + 1]].split(FIELD_SEPARATOR, 2)
+            questions = self.questions
+            if question_number < questions._fixed and question_number not in questions._overrides:
+                offsets = questions._offsets
+                question = questions._blob[offsets[question_number]:offsets[question_number + 1]]
+            else:
+                question = questions[question_number]
+            return question_id, evidence_id, question, answers.split(ANSWER_SEPARATOR), evidence
+
+        evidence_id, evidence, answers = _decode_row(rows[row], self._answer_counts[row])
+        if self._row_external[row]:
+            question_data = self._external_question(question_number)
+            evidence_data = question_data.get('evidences', {}).get(evidence_id, {})
+            return (question_id, evidence_id, question_data.get('question', ''),
+                    evidence_data.get('answer', []), evidence_data.get('evidence', ''))
+        return question_id, evidence_id, self.question_text(question_number), answers, evidence
+
+    def evidence_text(self, row: int) -> str:
+        return self.record(row)[4]
+
+    def answer_payload(self, row: int) -> Tuple[str, bool]:
+        """
+        行的回答（见final_answer）和答案中是否含no_answer
+
+        写入时已确定位置的行只切片一次，不解码整行；其余的行解码后再计算。
+        """
+        start = self._answer_starts[row]
+        if start < 0:
+            _, _, _, answers, evidence = self.record(row)
+            return final_answer(evidence, answers), "no_answer" in answers
+        rows = self.rows
+        end = self._answer_ends[row]
+        if row < rows._fixed and row not in rows._overrides:
+            offset = rows._offsets[row]
+            return rows._blob[offset + start:offset + end], bool(self._no_answer[row])
+        return rows[row][start:end], bool(self._no_answer[row])
+
+    def live_questions(self) -> Iterator[int]:
+        """依次产出未删除的问题编号"""
+        removed = self._question_removed
+        return (i for i in range(len(self.question_ids)) if not removed[i])
+
+    def _group_rows(self) -> None:
+        """把行号按所属问题排序分组，之后按问题取行只需切片"""
+        # tobytes在持有GIL时一次复制完；直接用np.array读取会导出缓冲区，其间其他线程追加行会引发BufferError
+        row_question = np.frombuffer(self.row_question.tobytes(), dtype=np.int32)
+        order = np.argsort(row_question, kind='stable').astype(np.int32)
+        starts = np.searchsorted(row_question[order], np.arange(len(self.question_ids) + 1))
+        self._grouped = (order, starts, len(row_question))
+
+    def rows_of_question(self, question_number: int) -> np.ndarray:
+        """问题的全部证据行，按行号升序（包括调用方已标记删除的行）"""
+        if self._grouped is None or self.row_count - self._grouped[2] > REGROUP_RATIO * self._grouped[2]:
+            self._group_rows()
+        order, starts, grouped_count = self._grouped
+
+        if question_number + 1 < len(starts):
+            rows = order[starts[question_number]:starts[question_number + 1]]
+        else:
+            rows = order[:0]
+        if grouped_count < self.row_count:
+            # 分组之后追加的行
+            tail = np.array(self.row_question[grouped_count:], dtype=np.int32)
+            rows = np.concatenate([rows, grouped_count + np.flatnonzero(tail == question_number)])
+        return rows
+
+    def _materialize(self, question_number: int) -> None:
+        """把外部问题及其证据读入内存列，之后可以修改"""
+        if self._question_offsets[question_number] < 0:
+            return
+
+        question_data = self._external_question(question_number)
+        self._writable('questions', '_question_offsets')
+        self.questions.set(question_number, question_data.get('question', ''))
+        evidences = question_data.get('evidences', {})
+        for row in self.rows_of_question(question_number):
+            if self._row_external[row]:
+                evidence_id = self.evidence_id(row)
+                evidence_data = evidences.get(evidence_id, {})
+                self._set_row(row, evidence_id, evidence_data.get('evidence', ''),
+                              list(evidence_data.get('answer', [])))
+                self._row_external[row] = 0
+        self._question_offsets[question_number] = -1
+        self._external_cache.pop(question_number, None)
+
+    def set_question(self, question_number: int, question: str) -> None:
+        self._materialize(question_number)
+        self._writable('questions')
+        self.questions.set(question_number, question)
+
+    def set_answers(self, row: int, answers: List[str]) -> None:
+        self._materialize(self.row_question[row])
+        evidence_id, evidence, _ = _decode_row(self.rows[row], self._answer_counts[row])
+        self._set_row(row, evidence_id, evidence, list(answers))
+
+    def remove_question(self, question_number: int) -> None:
+        """标记删除问题，其证据行由调用方标记删除"""
+        if not self._question_removed[question_number]:
+            self._writable('_question_removed', '_question_index')
+            self._question_removed[question_number] = 1
+            self._removed_count += 1
+            del self._question_index[self.question_ids[question_number]]
+
+    def take(self, rows: Sequence[int]) -> 'KnowledgeStore':
+        """只保留给定的行（按给定顺序），问题表共用，返回新的存储"""
+        store = KnowledgeStore(self.loader)
+        store.question_ids = self.question_ids
+        store.questions = self.questions
+        store._question_index = self._question_index
+        store._question_offsets = self._question_offsets
+        store._question_lengths = self._question_lengths
+        store._question_removed = self._question_removed
+        store._removed_count = self._removed_count
+        store._external_cache = self._external_cache
+        store._shared = set(_QUESTION_COLUMNS)
+
+        store.row_question = array('i', (self.row_question[row] for row in rows))
+        store.rows = self.rows.take(rows)
+        store._answer_counts = array('i', (self._answer_counts[row] for row in rows))
+        store._row_external = bytearray(self._row_external[row] for row in rows)
+        store._answer_starts = array('i', (self._answer_starts[row] for row in rows))
+        store._answer_ends = array('i', (self._answer_ends[row] for row in rows))
+        store._no_answer = bytearray(self._no_answer[row] for row in rows)
+        return store
+
+    def to_dict(self, rows: Optional[Iterable[int]] = None) -> Dict:
+        """导出为knowledge_base.json格式的字典，rows为要导出的证据行，默认全部"""
+        knowledge_base = {}
+        for question_number, question_id in enumerate(self.question_ids):
+            if not self._question_removed[question_number]:
+                knowledge_base[question_id] = {
+                    "question": self.question_text(question_number),
+                    "evidences": {}
+                }
+
+        for row in (range(self.row_count) if rows is None else rows):
+            question_id, evidence_id, _, answers, evidence = self.record(row)
+            if question_id in knowledge_base:
+                knowledge_base[question_id]["evidences"][evidence_id] = {
+                    "answer": answers,
+                    "evidence": evidence
+                }
+        return knowledge_base
+
+    def nbytes(self) -> int:
+        """粗略估计列数据占用的内存字节数（不含问题ID本身和问题ID索引字典）"""
+        arrays = (self._question_offsets, self._question_lengths, self.row_question,
+                  self._answer_counts, self._answer_starts, self._answer_ends)
+        return (self.questions.nbytes() + self.rows.nbytes()
+                + sum(a.itemsize * len(a) for a in arrays)
+                + len(self._question_removed) + len(self._row_external) + len(self._no_answer))
@@ -1,7 +1,11 @@
 import json
+import os
+import shutil
 import sys
 import re
 
+from kb_sqlite import SqliteKnowledgeBase, is_sqlite_path
+
 def find_existing_ids(data):
     """查找所有现有的问题ID"""
     existing_ids = []
@@ -46,6 +50,9 @@ def renumber_question(input_file, output_file, old_id, new_id=None):
     old_id (str): 要修改的旧问题ID
     new_id (str, optional): 新的问题ID，如果为None则自动生成
     """
+    if is_sqlite_path(input_file):
+        return renumber_question_sqlite(input_file, output_file, old_id, new_id)
+
     try:
         # 读取JSON文件
         with open(input_file, 'r', encoding='utf-8') as f:
@@ -94,6 +101,49 @@ def renumber_question(input_file, output_file, old_id, new_id=None):
         print(f"发生未知错误: {e}")
         return False
 
+def renumber_question_sqlite(input_file, output_file, old_id, new_id=None):
+    """
+    重新编号SQLite知识库中的特定问题条目，只改动该问题的几行记录
+
+    参数与renumber_question相同；先在输入文件中检查旧ID和新ID，
+    通过后输出文件与输入文件不同时才复制一份再修改，ID无效时不会产生或覆盖输出文件
+    """
+    if not os.path.exists(input_file):
+        print(f"错误: 文件 '{input_file}' 不存在")
+        return False
+
+    try:
+        db = SqliteKnowledgeBase(input_file)
+        try:
+            if not db.has_question(old_id):
+                print(f"错误: 找不到问题ID '{old_id}'")
+                return False
+
+            if new_id is None:
+                new_id = generate_new_id(db.question_ids())
+                print(f"自动生成新ID: {new_id}")
+
+            if db.has_question(new_id):
+                print(f"错误: 新ID '{new_id}' 已存在")
+                return False
+        finally:
+            db.close()
+
+        if os.path.abspath(output_file) != os.path.abspath(input_file):
+            shutil.copyfile(input_file, output_file)
+        db = SqliteKnowledgeBase(output_file)
+        try:
+            db.rename_question(old_id, new_id)
+        finally:
+            db.close()
+
+        print(f"成功将问题ID '{old_id}' 重命名为 '{new_id}'")
+        return True
+
+    except Exception as e:
+        print(f"发生未知错误: {e}")
+        return False
+
 def main():
     """主函数，处理命令行参数并执行重新编号操作"""
     # 如果没有提供参数，使用默认值
@@ -105,7 +155,7 @@ def main():
         sys.exit(0)
     
     input_file = sys.argv[1] if len(sys.argv) > 1 else "knowledge_base.json"
-    output_file = sys.argv[2] if len(sys.argv) > 2 else "knowledge_base_new.json"
+    output_file = sys.argv[2] if len(sys.argv) > 2 else "knowledge_base_new" + os.path.splitext(input_file)[1]
     old_id = sys.argv[3] if len(sys.argv) > 3 else "Q_HEALTH_043"
     new_id = sys.argv[4] if len(sys.argv) > 4 else None
     
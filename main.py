@@ -1,120 +1,2579 @@
+import codecs
+import functools
+import hashlib
+import itertools
 import json
+import logging
 import os
 import re
-from typing import Dict, List, Any, Optional, Tuple
-from collections import defaultdict
-import jieba
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import threading
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Any, NamedTuple, Optional, Tuple, Iterator, Sequence
+from collections import defaultdict, OrderedDict
+
+# 程序开始导入主要依赖的时间，交互界面据此报告启动耗时
+_STARTED_AT = time.perf_counter()
+
 import numpy as np
+from scipy import sparse
+# sklearn只在整体构建索引和拟合LSA时才导入（见_build_index和_fit_lsa），从索引快照启动时不必承担它的导入开销
+
+from kb_dedup import find_near_duplicates, minhash_signatures
+from kb_metrics import StageTimings, TimingHook
+from kb_pinyin import load_pypinyin, pinyin_available, query_ngrams, text_ngrams
+from kb_sqlite import SqliteKnowledgeBase, is_sqlite_path
+from kb_store import KnowledgeStore, final_answer
+
+# 索引快照格式版本，快照结构变化时递增以使旧快照失效
+INDEX_FORMAT_VERSION = 4
+
+# 可选的检索引擎：matrix为稀疏矩阵乘法，inverted为带MaxScore剪枝的倒排索引，
+# lsa为截断SVD降维后的稠密向量点积（近似检索）
+SEARCH_ENGINES = ('matrix', 'inverted', 'lsa')
+
+# 证据行按块投影到LSA潜在空间，限制中间结果的内存占用
+LSA_PROJECT_CHUNK_ROWS = 65536
+
+# 非零元素不超过该数量的矩阵（查询向量）直接按词取投影行求和
+LSA_GATHER_MAX_NNZ = 16384
+
+# 索引权重的存储精度：float64为拟合结果原样保存；float32每个非零元素少4字节；
+# uint8保存词频（每行一个float32缩放系数，权重 = 词频 * IDF * 缩放系数），检索直接在这种形式上进行
+INDEX_PRECISIONS = ('float64', 'float32', 'uint8')
+
+# uint8存储的词频上限，一条证据中出现更多次的词按该值计算
+_QUANT_MAX = 255
+
+# 可选的文本特征：jieba为jieba分词，char为字符一元/二元组（不需要加载jieba词典）
+ANALYZERS = ('jieba', 'char')
+
+# 检索各阶段的耗时统计：阶段名 -> 显示名称。answer包含exact_match和search，
+# search包含分词到排序选取的各阶段；inverted和lsa引擎的打分和Top-k选择是一起完成的，都计入score；
+# build_results是search_knowledge把结果组装成字典的耗时，精简结果和generate_answer没有这一步；
+# pinyin是拼音检索的耗时，只在主检索没有结果或得分太低时才有，也计入search
+TIMING_STAGES = {
+    'answer': '生成答案',
+    'exact_match': '问题精确匹配',
+    'search': '检索',
+    'tokenize': '分词',
+    'vectorize': '向量化',
+    'score': '打分',
+    'select': '排序选取',
+    'build_results': '组装结果',
+    'index_refresh': '落实增量修改',
+    'reload': '重新加载',
+    'dedup': '近似重复检测',
+    'pinyin': '拼音检索',
+}
+
+# 预分词语料文件的格式版本
+TOKEN_STORE_FORMAT_VERSION = 1
+
+# 需要分词的证据少于该数量时不启用多进程，进程启动的开销抵不过收益
+PARALLEL_BUILD_MIN_DOCS = 2000
+
+# 知识库文件超过该大小时默认使用流式加载
+STREAMING_MIN_BYTES = 256 * 1024 * 1024
+
+# SQLite知识库加载时重放的修改超过证据数的该比例时，重新保存索引快照
+SNAPSHOT_RESAVE_RATIO = 0.1
+
+# 监视知识库文件时检查修改时间的间隔（秒）
+WATCH_INTERVAL = 2.0
+
+# 拼音检索：主检索没有结果或最高得分低于PINYIN_FALLBACK_SCORE时按拼音音节二元组再检索一次，
+# 证据覆盖查询中（按IDF加权）至少PINYIN_MIN_COVERAGE的音节二元组才作为结果
+PINYIN_FALLBACK_SCORE = 0.3
+PINYIN_MIN_COVERAGE = 0.5
+
+# 出现在超过该比例证据中的音节二元组倒排表太长，查询中还有其他音节二元组时不参与拼音检索
+PINYIN_MAX_DF_RATIO = 0.2
+
+_NON_WHITESPACE = re.compile(r'\S')
+
+# 字符特征的切分：标点和空白处断开，连续的字母数字作为一个单位，其余每个字符一个单位
+_NON_WORD = re.compile(r'[\W_]+')
+_CHAR_UNIT = re.compile(r'[0-9a-zA-Z]+|\w')
+
+_jieba = None
+
+
+def _normalize_rows(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    """按行L2归一化，全零行保持不变（与sklearn.preprocessing.normalize相同，不必为此导入sklearn）"""
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64, copy=True)
+    row_lengths = np.diff(matrix.indptr)
+    squares = np.add.reduceat(matrix.data ** 2, matrix.indptr[:-1][row_lengths > 0]) if matrix.nnz else []
+    norms = np.ones(matrix.shape[0])
+    norms[row_lengths > 0] = np.sqrt(squares)
+    norms[norms == 0] = 1
+    matrix.data /= np.repeat(norms, row_lengths)
+    return matrix
+
+
+def _widen(matrix: sparse.csr_matrix, n_terms: int) -> sparse.csr_matrix:
+    """把行向量矩阵的列数扩展到n_terms，新增的列为空"""
+    return sparse.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], n_terms))
+
+
+def _replace_rows(matrix: sparse.csr_matrix, rows: Sequence[int], block: sparse.csr_matrix) -> sparse.csr_matrix:
+    """把矩阵中rows各行（升序）依次换成block的各行，其余行和行号不变"""
+    pieces = []
+    previous = 0
+    for i, row in enumerate(rows):
+        pieces.extend([matrix[previous:row], block[i]])
+        previous = row + 1
+    pieces.append(matrix[previous:])
+    return sparse.vstack(pieces, format='csr')
+
+
+def _binary_rows(rows: List[np.ndarray], n_columns: int) -> sparse.csr_matrix:
+    """由每行的列号（升序）组成元素为1的uint8稀疏矩阵"""
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(columns) for columns in rows], out=indptr[1:])
+    indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.uint8), indices, indptr),
+                             shape=(len(rows), n_columns))
+
+
+def _save_array(path: str, array: np.ndarray) -> None:
+    """
+    把数组保存为.npy文件
+
+    先写临时文件再替换：正在内存映射旧文件的实例（例如热重载时仍在服务的旧索引）不受影响
+    """
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(path + '.tmp', path)
+
+
+def _load_jieba():
+    """第一次需要分词时才导入jieba，只用字符特征时不必承担它的导入和词典开销"""
+    global _jieba
+    if _jieba is None:
+        import jieba
+        _jieba = jieba
+    return _jieba
+
+
+def _char_ngrams(text: str) -> List[str]:
+    """
+    字符一元组和二元组
+
+    例如 "一天有24小时" -> ['一', '天', '有', '24', '小', '时', '一天', '天有', '有24', '24小', '小时']，
+    二元组不跨越标点和空白。
+    """
+    tokens = []
+    for segment in _NON_WORD.split(text):
+        units = _CHAR_UNIT.findall(segment)
+        tokens.extend(units)
+        tokens.extend(a + b for a, b in zip(units, units[1:]))
+    return tokens
+
+
+def _pretokenized(tokens: List[str]) -> List[str]:
+    """拟合时文档已经分好词，直接作为分析结果"""
+    return tokens
+
+
+def _analyze_chunk(texts: List[str]) -> List[List[str]]:
+    """多进程构建索引时在子进程中执行的jieba分词，与LocalKnowledgeBaseQA._analyze一致"""
+    jieba = _load_jieba()
+    return [list(jieba.cut(text.lower())) for text in texts]
+
+
+def _pinyin_chunk(texts: List[str]) -> List[Tuple[str, ...]]:
+    """多进程构建拼音索引时在子进程中执行的拼音转换"""
+    return [text_ngrams(text) for text in texts]
+
+
+class _JsonStream:
+    """按块读取JSON文件并逐个解码其中的值，同时记录每个值在文件中的字节位置"""
+
+    def __init__(self, f, hasher=None, chunk_size: int = 1 << 20):
+        self._f = f
+        self._hasher = hasher
+        self._chunk_size = chunk_size
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._offset = 0  # _buf[_pos]在文件中的字节偏移
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """再读入一块数据，文件已读完时返回False"""
+        if self._eof:
+            return False
+        raw = self._f.read(self._chunk_size)
+        if self._hasher is not None:
+            self._hasher.update(raw)
+        self._eof = not raw
+        self._buf = self._buf[self._pos:] + self._utf8.decode(raw, final=self._eof)
+        self._pos = 0
+        return True
+
+    def _advance(self, end: int) -> None:
+        self._offset += len(self._buf[self._pos:end].encode('utf-8'))
+        self._pos = end
+
+    def peek(self) -> str:
+        """跳过空白，返回下一个字符但不消费，文件结束时返回空字符串"""
+        while True:
+            match = _NON_WHITESPACE.search(self._buf, self._pos)
+            if match:
+                self._advance(match.start())
+                return self._buf[self._pos]
+            self._advance(len(self._buf))
+            if not self._fill():
+                return ''
+
+    def expect(self, ch: str) -> None:
+        """消费一个指定的结构字符"""
+        if self.peek() != ch:
+            raise ValueError(f"JSON格式错误：字节偏移 {self._offset} 处应为 '{ch}'")
+        self._advance(self._pos + 1)
+
+    def decode(self) -> Tuple[Any, int, int]:
+        """解码下一个值，返回(值, 字节偏移, 字节长度)"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # 值恰好结束在缓冲区末尾时可能被截断（例如数字），读入更多数据再确认
+                if end < len(self._buf) or self._eof:
+                    start = self._offset
+                    self._advance(end)
+                    return value, start, self._offset - start
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def drain(self) -> None:
+        """读完文件剩余部分，保证哈希覆盖整个文件"""
+        while self._fill():
+            self._buf = ''
+
+
+def iter_knowledge_json(file_path: str, hasher=None) -> Iterator[Tuple[str, Dict, int, int]]:
+    """
+    流式解析知识库JSON文件，每次只解码一个问题
+
+    Args:
+        file_path: 知识库JSON文件路径
+        hasher: 可选的hashlib对象，读取的原始字节会依次送入其中
+
+    Yields:
+        (问题ID, 问题数据, 问题数据在文件中的字节偏移, 字节长度)
+    """
+    with open(file_path, 'rb') as f:
+        stream = _JsonStream(f, hasher)
+        stream.expect('{')
+        if stream.peek() == '}':
+            stream.expect('}')
+        else:
+            while True:
+                question_id, _, _ = stream.decode()
+                stream.expect(':')
+                question_data, offset, length = stream.decode()
+                yield question_id, question_data, offset, length
+                if stream.peek() == ',':
+                    stream.expect(',')
+                else:
+                    stream.expect('}')
+                    break
+        stream.drain()
+
+
+def normalize_query(text: str) -> str:
+    """
+    归一化查询文本，用作缓存和精确匹配的键
+
+    全角/半角统一（NFKC）、转小写，并去掉空白和标点，
+    例如"一天有多少小时？"和" 一天有多少小时 "得到相同的结果。
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    return ''.join(ch for ch in text
+                   if not ch.isspace() and not unicodedata.category(ch).startswith('P'))
+
+
+class IndexSnapshot(NamedTuple):
+    """
+    查询用到的全部索引状态，发布后不再修改
+
+    查询开始时取一次当前快照，之后只读这个快照，与同时进行的修改、重建或重新加载互不干扰。
+    存储和词表与修改中的索引共用，但它们只在末尾追加：快照只访问前n_rows行和前n_terms列，
+    看不到之后追加的内容。改写已有问题或行之前，已发布的存储先浅复制一份，被改写的列整体复制后再改
+    （写时复制，见KnowledgeStore.copy）；数组和其余结构在修改时整体替换，不会原地改动。
+    """
+    version: int  # 发布时的_index_version，结果缓存按它判断是否过期
+    engine: str
+    store: KnowledgeStore
+    vocabulary: Dict[str, int]
+    idf: Optional[np.ndarray]
+    kb_vectors: Optional[sparse.csr_matrix]
+    kb_vectors_t: Optional[sparse.csr_matrix]
+    row_scales: Optional[np.ndarray]
+    term_max_weight: Optional[np.ndarray]
+    lsa_projection: Optional[np.ndarray]
+    lsa_vectors: Optional[np.ndarray]
+    deleted: np.ndarray  # 已删除行的标记，长度即快照的行数
+    num_deleted: int
+    question_lookup: Dict[str, List[int]]
+    duplicates: Dict[int, Tuple[int, ...]]  # 代表行 -> 合并进来的近似重复行
+    # 拼音检索：音节二元组 -> 列号，按音节二元组组织的证据行（倒排表），以及各音节二元组的IDF权重；
+    # 没有启用时都为None
+    pinyin_vocabulary: Optional[Dict[str, int]]
+    pinyin_postings: Optional[sparse.csr_matrix]
+    pinyin_idf: Optional[np.ndarray]
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.deleted)
+
+    @property
+    def n_terms(self) -> int:
+        return len(self.idf) if self.idf is not None else 0
+
+
+class SearchHit:
+    """
+    精简的搜索结果，只保存行号和得分，其余字段在访问时才从快照的存储中读取
+
+    可以像search_knowledge返回的字典一样用hit['question']、hit.get('answer')访问，
+    需要完整的字典（例如JSON序列化）时调用as_dict。
+    """
+
+    __slots__ = ('row', 'score', '_snapshot')
+
+    _FIELDS = ('id', 'question', 'answer', 'evidence', 'score', 'duplicates')
+
+    def __init__(self, snapshot: IndexSnapshot, row: int, score: float):
+        self.row = row
+        self.score = score
+        self._snapshot = snapshot
+
+    @property
+    def id(self) -> str:
+        return self._snapshot.store.full_id(self.row)
+
+    @property
+    def question(self) -> str:
+        store = self._snapshot.store
+        return store.question_text(store.row_question[self.row])
+
+    @property
+    def answer(self) -> List[str]:
+        return self._snapshot.store.record(self.row)[3]
+
+    @property
+    def evidence(self) -> str:
+        return self._snapshot.store.evidence_text(self.row)
+
+    @property
+    def duplicates(self) -> List[str]:
+        """合并到这一行的近似重复证据的ID"""
+        store = self._snapshot.store
+        return [store.full_id(member) for member in self._snapshot.duplicates.get(self.row, ())]
+
+    def answer_payload(self) -> Tuple[str, bool]:
+        """构建存储时已确定的回答，以及答案中是否含no_answer，见KnowledgeStore.answer_payload"""
+        return self._snapshot.store.answer_payload(self.row)
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._FIELDS or (key == 'duplicates' and self.row not in self._snapshot.duplicates):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def as_dict(self) -> Dict:
+        """与search_knowledge返回格式相同的字典"""
+        return LocalKnowledgeBaseQA._build_result(self._snapshot, self.row, self.score)
+
+    def __repr__(self) -> str:
+        return f"SearchHit(row={self.row}, score={self.score:.4f})"
+
+
+def _exclusive(method):
+    """修改索引的方法互相排斥；查询不加锁，只读取已发布的IndexSnapshot"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._write_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class LocalKnowledgeBaseQA:
+    # 知识库条目和索引的全部状态，热重载时从新构建的实例整体换上
+    _INDEX_STATE = (
+        '_store', '_vocabulary', '_idf', 'kb_vectors', '_row_scales', '_kb_vectors_t',
+        '_term_max_weight', '_lsa_projection', '_lsa_vectors', '_streaming', '_source_path',
+        '_source_hash', '_source_signature', '_corpus_tokens_reused', '_corpus_tokens_computed',
+        '_question_lookup', '_question_keys', '_deleted', '_num_deleted', '_pending_rows',
+        '_mutations_since_idf', '_index_dirty', '_duplicates', '_representative',
+        '_pinyin_vocabulary', '_pinyin_vectors', '_pinyin_postings', '_pinyin_idf', '_pending_pinyin',
+    )
+
+    def __init__(self, knowledge_file: str = None, knowledge_dict: Dict = None,
+                 use_index_cache: bool = True, engine: str = 'matrix',
+                 idf_refresh_interval: Optional[int] = 100, compact_ratio: float = 0.25,
+                 token_cache_size: int = 1024, result_cache_size: int = 256,
+                 result_cache_ttl: Optional[float] = None, build_workers: Optional[int] = 1,
+                 streaming: Optional[bool] = None, analyzer: str = 'jieba',
+                 lsa_components: int = 128, precision: str = 'float64',
+                 dedup_threshold: Optional[float] = None, pinyin_fallback: bool = False,
+                 message_handler: Optional[Callable[[str], None]] = None):
+        """
+        初始化本地知识库问答系统
+
+        Args:
+            knowledge_file: 知识库JSON文件或SQLite数据库（.db/.sqlite/.sqlite3）路径
+            knowledge_dict: 直接传入的知识库字典数据
+            use_index_cache: 是否使用磁盘上的索引快照（仅对knowledge_file生效）
+            engine: 检索引擎，'matrix'、'inverted'或'lsa'，返回格式相同
+            idf_refresh_interval: 增量修改累计多少次后自动重算IDF权重，None表示只在调用refresh_idf时重算
+            compact_ratio: 已删除的证据行超过该比例时自动压缩索引
+            token_cache_size: 查询分词LRU缓存的容量，0表示不缓存
+            result_cache_size: 查询结果LRU缓存的容量，0表示不缓存
+            result_cache_ttl: 查询结果缓存的有效期（秒），None表示不过期
+            build_workers: 构建索引时分词的进程数，None表示使用全部CPU核心
+            streaming: 是否流式加载知识库文件，None表示文件超过STREAMING_MIN_BYTES时自动启用
+            analyzer: 文本特征，'jieba'为jieba分词，'char'为字符一元/二元组，不需要jieba
+            lsa_components: lsa引擎的潜在空间维数
+            precision: 索引权重的存储精度，'float64'、'float32'或'uint8'（按行缩放的8位量化）
+            dedup_threshold: 构建索引时合并近似重复证据的相似度阈值（字符三元组的Jaccard相似度），
+                None表示不合并
+            pinyin_fallback: 是否建立拼音索引，主检索没有结果或得分太低时按拼音再检索一次，
+                容忍语音识别的同音错字；需要安装pypinyin
+            message_handler: 加载、重新加载知识库时提示信息的处理函数，None表示直接打印；
+                后台加载时由BackgroundLoader收集，交互界面在两次输入之间打印
+        """
+        if engine not in SEARCH_ENGINES:
+            raise ValueError(f"未知的检索引擎: {engine}，可选: {', '.join(SEARCH_ENGINES)}")
+        if analyzer not in ANALYZERS:
+            raise ValueError(f"未知的文本特征: {analyzer}，可选: {', '.join(ANALYZERS)}")
+        if precision not in INDEX_PRECISIONS:
+            raise ValueError(f"未知的存储精度: {precision}，可选: {', '.join(INDEX_PRECISIONS)}")
+        if dedup_threshold is not None and not 0 < dedup_threshold <= 1:
+            raise ValueError(f"近似重复的相似度阈值应在0到1之间: {dedup_threshold}")
+
+        self._message_handler = message_handler
+        self._store = KnowledgeStore()  # 列式存储的知识库条目，行号与kb_vectors的行一一对应
+        self._vocabulary = {}  # 词 -> 列号，增量修改时会在末尾追加新词
+        self._idf = None  # 各列的IDF权重
+        # 作为分片共用全局IDF时：其他分片的证据数，以及全局的词 -> IDF权重（新增证据的词优先取这里的权重），
+        # 见set_external_idf
+        self._idf_extra_documents = 0
+        self._shared_idf = None
+        self.kb_vectors = None  # 知识库的向量表示（按行L2归一化），元素类型由precision决定
+        self.precision = precision
+        self._row_scales = None  # uint8存储时每行的缩放系数（行向量模长的倒数），权重 = 词频 * IDF * 缩放系数
+        self._kb_vectors_t = None  # kb_vectors的转置（词 -> 证据行），查询只需访问查询词所在的行
+        self._term_max_weight = None  # 每个词在所有证据中的最大权重，倒排引擎剪枝用的得分上界
+        # lsa引擎：词 -> 潜在空间的投影矩阵（拟合时的词数 x 维数），以及投影后按行归一化的证据向量
+        self.lsa_components = lsa_components
+        self._lsa_projection = None
+        self._lsa_vectors = None
+        self.engine = engine
+        self.analyzer = analyzer
+        self.use_index_cache = use_index_cache
+        self._source_path = None  # 知识库文件路径，预分词语料保存在它旁边
+        self.build_workers = build_workers
+
+        # 流式模式：问题数据留在文件中，存储里只记录每个问题的字节位置，命中时再按需读取
+        self.streaming = streaming
+        self._streaming = False
+
+        # SQLite知识库：条目数据按需从数据库读取，修改同步写入数据库
+        self._backend = None
+        self._snapshot_revision = None  # 最近加载或保存的索引快照对应的数据库修改序号
+
+        # 查询分词的LRU缓存，语音识别结果经常重复相同的短句
+        self.token_cache_size = token_cache_size
+        self._token_cache = OrderedDict()
+        self._token_cache_hits = 0
+        self._token_cache_misses = 0
+        # 最近一次构建索引时复用/重新分词的证据数
+        self._corpus_tokens_reused = 0
+        self._corpus_tokens_computed = 0
+
+        # 查询结果缓存，键为归一化的查询文本；索引或知识库每次变化都会递增版本号并清空缓存
+        self.result_cache_size = result_cache_size
+        self.result_cache_ttl = result_cache_ttl
+        self._result_cache = OrderedDict()
+        self._result_cache_hits = 0
+        self._result_cache_misses = 0
+        self._index_version = 0
+
+        # 问题精确匹配：归一化的问题文本 -> 问题编号列表，命中时不必做TF-IDF检索
+        self._question_lookup = {}
+        self._question_keys = {}  # 问题编号 -> 归一化的问题文本
+        self._question_match_hits = 0
+        self._question_match_misses = 0
+
+        # 检索各阶段的耗时直方图，见TIMING_STAGES
+        self._timings = StageTimings()
+
+        # 增量修改的状态：新增行先暂存，下次查询前统一并入矩阵；删除的行只做标记，之后再压缩
+        self.idf_refresh_interval = idf_refresh_interval
+        self.compact_ratio = compact_ratio
+        self._deleted = np.zeros(0, dtype=bool)  # 已删除（墓碑）行的标记
+        self._num_deleted = 0
+        self._pending_rows = []  # 尚未并入kb_vectors的新增行的词频
+        self._mutations_since_idf = 0  # 上次重算IDF之后的修改次数
+        self._index_dirty = False  # kb_vectors有变化，派生结构需要重建
+
+        # 近似重复合并：每簇只有代表行有向量，其余行的向量为空，查询结果中列出代表行合并了哪些证据。
+        # 两个字典在修改时整体替换，已发布的快照不受影响
+        self.dedup_threshold = dedup_threshold
+        self._duplicates = {}  # 代表行 -> 合并进来的行（升序）
+        self._representative = {}  # 被合并的行 -> 代表行
+
+        # 拼音检索：每行为问题和证据文本的拼音音节二元组（元素为1），结构与kb_vectors和它的转置相同。
+        # 没有安装pypinyin时不启用
+        if pinyin_fallback and not pinyin_available():
+            self._report("警告：未安装pypinyin，拼音检索不可用")
+            pinyin_fallback = False
+        self.pinyin_fallback = pinyin_fallback
+        self._pinyin_vocabulary = {}  # 音节二元组 -> 列号，只在末尾追加
+        self._pinyin_vectors = None
+        self._pinyin_postings = None  # _pinyin_vectors的转置
+        self._pinyin_idf = None
+        self._pending_pinyin = []  # 与_pending_rows对应的新增行的列号
+        self._pinyin_searches = 0
+        self._pinyin_hits = 0
+
+        # 查询读取的索引快照，见IndexSnapshot；修改索引的方法持有写锁，
+        # 查询只在发现有尚未发布的修改时才等待写锁，在其中发布新快照
+        self._snapshot = None
+        self._write_lock = threading.RLock()
+
+        # 重新加载知识库文件时按相同的参数构建新索引
+        self._options = {
+            "use_index_cache": use_index_cache, "engine": engine,
+            "idf_refresh_interval": idf_refresh_interval, "compact_ratio": compact_ratio,
+            "build_workers": build_workers, "streaming": streaming, "analyzer": analyzer,
+            "lsa_components": lsa_components, "precision": precision,
+            "dedup_threshold": dedup_threshold, "pinyin_fallback": pinyin_fallback,
+            "message_handler": message_handler,
+        }
+        # 热重载：文件内容的SHA-256和(修改时间, 大小)，用于判断文件是否变化；每换上一次新索引generation加1
+        self._source_hash = None
+        self._source_signature = None
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self._watch_stop = None
+        self._generation = 0
+        self._reloads = 0
+        self._reload_failures = 0
+        self._last_reload_seconds = None
+        self._last_reload_error = None
+
+        if knowledge_file:
+            if is_sqlite_path(knowledge_file):
+                self.load_from_sqlite(knowledge_file)
+            else:
+                self.load_from_json(knowledge_file)
+        elif knowledge_dict:
+            self._store = KnowledgeStore.from_dict(knowledge_dict)
+            self._build_index()
+
+    def _report(self, message: str) -> None:
+        """输出加载和重新加载过程中的提示信息，见message_handler"""
+        if self._message_handler is None:
+            print(message)
+        else:
+            self._message_handler(message)
+
+    def _tokenize(self, text: str) -> List[str]:
+        """分词函数，按analyzer使用jieba分词或字符一元/二元组"""
+        if self.analyzer == 'char':
+            return _char_ngrams(text)
+        return list(_load_jieba().cut(text))
+
+    def _analyze(self, text: str) -> List[str]:
+        """小写化后分词，与TfidfVectorizer默认的预处理一致"""
+        return self._tokenize(text.lower())
+
+    def prewarm(self) -> None:
+        """预先加载分词词典（jieba词典加载需要一两秒，树莓派上更久），避免第一次提问时才等待"""
+        self._analyze("预热")
+        if self.pinyin_fallback:
+            load_pypinyin()
+
+    def _analyze_query(self, text: str) -> Tuple[str, ...]:
+        """查询分词，结果缓存在有界LRU中"""
+        if self.token_cache_size <= 0:
+            return tuple(self._analyze(text))
+
+        # 多个查询线程同时使用缓存时，条目可能刚被其他线程淘汰，这时忽略KeyError即可；
+        # 命中次数等统计在并发时可能少计几次
+        cache = self._token_cache
+        tokens = cache.get(text)
+        if tokens is not None:
+            try:
+                cache.move_to_end(text)
+            except KeyError:
+                pass
+            self._token_cache_hits += 1
+            return tokens
+
+        self._token_cache_misses += 1
+        tokens = tuple(self._analyze(text))
+        cache[text] = tokens
+        while len(cache) > self.token_cache_size:
+            try:
+                cache.popitem(last=False)
+            except KeyError:
+                break
+        return tokens
+
+    def query_terms(self, text: str) -> Tuple[str, ...]:
+        """查询的分词结果（经过分词缓存），分片知识库用它让各分片共用一次分词"""
+        return self._analyze_query(text)
+
+    def tokenization_stats(self) -> Dict:
+        """查询分词缓存的命中情况，以及最近一次构建索引时预分词语料的复用情况"""
+        lookups = self._token_cache_hits + self._token_cache_misses
+        return {
+            "cache_size": len(self._token_cache),
+            "cache_capacity": self.token_cache_size,
+            "hits": self._token_cache_hits,
+            "misses": self._token_cache_misses,
+            "hit_rate": self._token_cache_hits / lookups if lookups else 0.0,
+            "corpus_reused": self._corpus_tokens_reused,
+            "corpus_tokenized": self._corpus_tokens_computed,
+        }
+
+    def _bump_version(self) -> None:
+        """索引或知识库内容发生变化，使已缓存的查询结果失效"""
+        self._index_version += 1
+        self._result_cache.clear()
+
+    def _cache_get(self, key: Tuple) -> Any:
+        """
+        从结果缓存中取值，未命中或已过期时返回None；归一化后为空的查询不缓存
+
+        键的最后一项是计算结果所用快照的版本号，读旧快照的查询写入的结果不会被读新快照的查询取到。
+        并发时的KeyError见_analyze_query。
+        """
+        if self.result_cache_size <= 0 or not key[1]:
+            return None
+
+        entry = self._result_cache.get(key)
+        if entry is not None:
+            stored_at, value = entry
+            if self.result_cache_ttl is None or time.monotonic() - stored_at <= self.result_cache_ttl:
+                try:
+                    self._result_cache.move_to_end(key)
+                except KeyError:
+                    pass
+                self._result_cache_hits += 1
+                return value
+            self._result_cache.pop(key, None)
+        self._result_cache_misses += 1
+        return None
+
+    def _cache_put(self, key: Tuple, value: Any) -> None:
+        """写入结果缓存，超出容量时淘汰最久未使用的条目"""
+        if self.result_cache_size <= 0 or not key[1]:
+            return
+        self._result_cache[key] = (time.monotonic(), value)
+        try:
+            self._result_cache.move_to_end(key)
+        except KeyError:
+            pass
+        while len(self._result_cache) > self.result_cache_size:
+            try:
+                self._result_cache.popitem(last=False)
+            except KeyError:
+                break
+
+    def result_cache_stats(self) -> Dict:
+        """查询结果缓存的命中情况"""
+        lookups = self._result_cache_hits + self._result_cache_misses
+        return {
+            "size": len(self._result_cache),
+            "capacity": self.result_cache_size,
+            "ttl": self.result_cache_ttl,
+            "hits": self._result_cache_hits,
+            "misses": self._result_cache_misses,
+            "hit_rate": self._result_cache_hits / lookups if lookups else 0.0,
+            "index_version": self._index_version,
+        }
+
+    def question_match_stats(self) -> Dict:
+        """问题精确匹配快速路径的命中情况，只统计没有命中结果缓存的提问"""
+        lookups = self._question_match_hits + self._question_match_misses
+        return {
+            "size": len(self._question_lookup),
+            "hits": self._question_match_hits,
+            "misses": self._question_match_misses,
+            "hit_rate": self._question_match_hits / lookups if lookups else 0.0,
+        }
+
+    def duplicate_stats(self) -> Dict:
+        """近似重复合并的概况：阈值、簇数和被合并的证据数"""
+        duplicates = self._duplicates
+        return {
+            "threshold": self.dedup_threshold,
+            "clusters": len(duplicates),
+            "collapsed": sum(len(members) for members in duplicates.values()),
+        }
+
+    def duplicate_report(self) -> Dict:
+        """
+        近似重复合并的详细报告
+
+        被合并的证据如果单独建立索引，每个不同的词在行矩阵和转置矩阵中各占一个非零元素，
+        据此估计节省的索引大小；需要对这些证据重新分词，只在查看报告时计算。
+
+        Returns:
+            包含簇列表（按成员数降序）、被合并的证据数、索引非零元素数和节省的非零元素数、字节数的字典
+        """
+        snapshot = self._current_snapshot()
+        store = snapshot.store
+        clusters = sorted(snapshot.duplicates.items(), key=lambda item: (-len(item[1]), item[0]))
+        collapsed = sum(len(members) for _, members in clusters)
+        saved_nnz = sum(len(set(self._analyze(store.evidence_text(member))))
+                        for _, members in clusters for member in members)
+        kb_vectors = snapshot.kb_vectors
+        index_nnz = kb_vectors.nnz if kb_vectors is not None else 0
+        bytes_per_nnz = kb_vectors.data.itemsize + kb_vectors.indices.itemsize if kb_vectors is not None else 0
+        return {
+            "threshold": self.dedup_threshold,
+            "evidences": snapshot.n_rows - snapshot.num_deleted,
+            "collapsed": collapsed,
+            "index_nnz": index_nnz,
+            "saved_nnz": saved_nnz,
+            "saved_bytes": saved_nnz * bytes_per_nnz * 2,
+            "clusters": [{
+                "representative": store.full_id(representative),
+                "evidence": store.evidence_text(representative),
+                "members": [store.full_id(member) for member in members],
+            } for representative, members in clusters],
+        }
+
+    def pinyin_stats(self) -> Dict:
+        """拼音检索的概况：音节二元组数，以及主检索结果不足而改用拼音检索的次数和其中找到结果的次数"""
+        return {
+            "enabled": self.pinyin_fallback,
+            "terms": len(self._pinyin_vocabulary),
+            "searches": self._pinyin_searches,
+            "hits": self._pinyin_hits,
+            "hit_rate": self._pinyin_hits / self._pinyin_searches if self._pinyin_searches else 0.0,
+        }
+
+    def add_timing_hook(self, hook: TimingHook) -> None:
+        """
+        注册耗时回调，用于把各阶段耗时导出到外部的监控系统
+
+        Args:
+            hook: 每记录一次耗时调用一次hook(阶段名, 耗时秒数, 条目数)，在检索线程中同步调用，应尽量轻量
+        """
+        self._timings.add_hook(hook)
+
+    def remove_timing_hook(self, hook: TimingHook) -> None:
+        """注销耗时回调"""
+        self._timings.remove_hook(hook)
+
+    def reset_timings(self) -> None:
+        """清空已记录的各阶段耗时"""
+        self._timings.reset()
+
+    def stats(self) -> Dict:
+        """
+        问答系统的运行统计：知识库规模、各缓存的命中情况、近似重复合并、拼音检索、热重载状态和检索各阶段的耗时
+
+        timings按阶段名给出次数、条目数和耗时分位数（毫秒），阶段见TIMING_STAGES。
+        每次记录对应一次调用，批量接口的一批查询记为一次，items为其中的查询数。
+        """
+        return {
+            "questions": self.question_count,
+            "evidences": self.evidence_count,
+            "engine": self.engine,
+            "analyzer": self.analyzer,
+            "precision": self.precision,
+            "result_cache": self.result_cache_stats(),
+            "token_cache": self.tokenization_stats(),
+            "question_match": self.question_match_stats(),
+            "dedup": self.duplicate_stats(),
+            "pinyin": self.pinyin_stats(),
+            "reload": self.reload_stats(),
+            "timings": self._timings.summary(),
+        }
+
+    @_exclusive
+    def load_from_json(self, file_path: str) -> None:
+        """从JSON文件加载知识库"""
+        if not os.path.exists(file_path):
+            self._report(f"错误：文件 {file_path} 不存在")
+            return
+
+        self._report(f"正在从文件 {file_path} 加载知识库...")
+        try:
+            self._load_json(file_path)
+            self._report(f"成功加载知识库，包含 {len(self.kb_ids)} 个知识条目")
+        except Exception as e:
+            self._report(f"加载失败: {e}")
+
+    def _load_json(self, file_path: str, unchanged_hash: Optional[str] = None) -> bool:
+        """
+        读取JSON知识库文件并构建或恢复索引，出错时抛出异常
+
+        Args:
+            file_path: 知识库文件路径
+            unchanged_hash: 文件内容的SHA-256与它相同时不构建索引
+
+        Returns:
+            是否加载了文件；内容与unchanged_hash相同时返回False
+        """
+        # 先取修改时间再读取，读取期间文件又被修改时，下一次检查仍会发现变化
+        stat = os.stat(file_path)
+        streaming = self.streaming
+        if streaming is None:
+            streaming = stat.st_size >= STREAMING_MIN_BYTES
+
+        self._source_path = file_path
+        self._backend = None
+        # 索引快照以源文件内容哈希为键，内容不变时跳过分词和拟合
+        if streaming:
+            source_hash = self._scan_json(file_path)
+        else:
+            with open(file_path, 'rb') as f:
+                raw = f.read()
+            source_hash = hashlib.sha256(raw).hexdigest()
+            if source_hash != unchanged_hash:
+                self._store = KnowledgeStore.from_dict(json.loads(raw.decode('utf-8')))
+                self._streaming = False
+        if source_hash == unchanged_hash:
+            return False
+
+        index_dir = self._index_dir(file_path)
+        if self.use_index_cache and self._load_index_snapshot(index_dir, source_hash):
+            self._report(f"已从索引快照 {index_dir} 恢复索引")
+        else:
+            self._build_index()
+            if self.use_index_cache:
+                self._save_index_snapshot(index_dir, source_hash)
+        self._source_hash = source_hash
+        self._source_signature = (stat.st_mtime_ns, stat.st_size)
+        return True
+
+    def watch(self, interval: float = WATCH_INTERVAL) -> None:
+        """
+        在后台线程中监视JSON知识库文件，文件变化后自动调用reload
+
+        修改时间或大小变化后，等到连续两次检查都相同（文件已写完）才重新加载。
+        流式模式下旧索引命中时要从文件中读取问题数据，文件被原地改写后到换上新索引之前，
+        这部分读取可能出错；写文件时先写临时文件再替换可以避免。
+
+        Args:
+            interval: 检查文件的间隔（秒）
+        """
+        if self._source_path is None or self._backend is not None:
+            raise ValueError("只能监视从JSON文件加载的知识库")
+        if self._watcher is not None:
+            return
+        self._watch_stop = threading.Event()
+        self._watcher = threading.Thread(target=self._watch_source, args=(interval, self._watch_stop),
+                                         name='kb-watch', daemon=True)
+        self._watcher.start()
+
+    def unwatch(self) -> None:
+        """停止监视知识库文件，正在进行的重新加载会继续完成"""
+        if self._watcher is None:
+            return
+        self._watch_stop.set()
+        self._watcher = self._watch_stop = None
+
+    def _watch_source(self, interval: float, stop: threading.Event) -> None:
+        """监视线程：轮询文件的修改时间和大小"""
+        checked = self._source_signature
+        while not stop.wait(interval):
+            signature = self._stat_source()
+            # 文件暂时不存在（正在被替换）或没有变化
+            if signature is None or signature == checked:
+                continue
+            if stop.wait(interval):
+                break
+            if self._stat_source() != signature:
+                continue
+            checked = signature
+            try:
+                self.reload()
+            except Exception as e:
+                self._report(f"重新加载知识库失败，继续使用原来的索引: {e}")
+
+    def _stat_source(self) -> Optional[Tuple[int, int]]:
+        """知识库文件的(修改时间, 大小)，文件不存在时返回None"""
+        try:
+            stat = os.stat(self._source_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self) -> bool:
+        """
+        按知识库文件的当前内容构建新索引，构建期间查询照常使用原来的索引
+
+        新索引在调用线程中构建，完成后换上并发布为新的IndexSnapshot：已经开始的查询读完旧快照，
+        之后的查询读新快照。之前通过add_evidence等接口做的修改没有写入文件，换上新索引后不再保留。
+
+        Returns:
+            是否换上了新索引；文件内容没有变化时返回False
+
+        Raises:
+            文件不存在或无法解析时抛出异常，原来的索引保持不变
+        """
+        if self._source_path is None or self._backend is not None:
+            raise ValueError("只能重新加载从JSON文件加载的知识库")
+
+        with self._reload_lock:
+            start = time.perf_counter()
+            fresh = type(self)(token_cache_size=0, result_cache_size=0, **self._options)
+            try:
+                loaded = fresh._load_json(self._source_path, unchanged_hash=self._source_hash)
+            except Exception as e:
+                self._reload_failures += 1
+                self._last_reload_error = str(e)
+                raise
+            if not loaded:
+                return False
+            with self._write_lock:
+                for name in self._INDEX_STATE:
+                    setattr(self, name, getattr(fresh, name))
+                if fresh.engine != self.engine:
+                    self._prepare_engine()
+                self._bump_version()
+                self._ensure_index()
+                seconds = time.perf_counter() - start
+                self._generation += 1
+                self._reloads += 1
+                self._last_reload_seconds = seconds
+                self._last_reload_error = None
+            self._timings.record('reload', seconds, fresh.evidence_count)
+            self._report(f"知识库文件已更新，换上了新索引，包含 {fresh.evidence_count} 个知识条目")
+            return True
+
+    def reload_stats(self) -> Dict:
+        """热重载的状态：当前索引的代数（初次加载为0，每换上一次新索引加1）和最近一次重新加载的耗时"""
+        return {
+            "generation": self._generation,
+            "reloads": self._reloads,
+            "failures": self._reload_failures,
+            "last_seconds": self._last_reload_seconds,
+            "last_error": self._last_reload_error,
+            "watching": self._watcher is not None,
+        }
+
+    @_exclusive
+    def load_from_sqlite(self, db_path: str) -> None:
+        """
+        从SQLite知识库加载
+
+        有索引快照时只重放快照之后的修改；证据文本和答案只在命中时从数据库读取。
+        """
+        if not os.path.exists(db_path):
+            self._report(f"错误：文件 {db_path} 不存在")
+            return
+
+        self._report(f"正在从数据库 {db_path} 加载知识库...")
+        self._source_path = db_path
+        self._streaming = False
+
+        try:
+            self._backend = backend = SqliteKnowledgeBase(db_path)
+            index_dir = self._index_dir(db_path)
+            if self.use_index_cache and self._load_index_snapshot(index_dir, backend.uuid):
+                revision = backend.revision()
+                replayed = self._replay_changes(self._snapshot_revision, revision)
+                self._report(f"已从索引快照 {index_dir} 恢复索引，同步了 {replayed} 处修改")
+                if replayed > SNAPSHOT_RESAVE_RATIO * max(self.evidence_count, 1):
+                    # 修改积累较多时重新保存快照，下次加载不必再重放
+                    self.compact()
+                    self._rebuild_term_index()
+                    self._save_index_snapshot(index_dir, backend.uuid, revision)
+            else:
+                self._store, texts, revision = backend.build_store()
+                self._build_index(texts)
+                if self.use_index_cache:
+                    self._save_index_snapshot(index_dir, backend.uuid, revision)
+            self._report(f"成功加载知识库，包含 {self.evidence_count} 个知识条目")
+        except Exception as e:
+            self._report(f"加载失败: {e}")
+
+    def _replay_changes(self, since: int, until: int) -> int:
+        """
+        把索引快照之后数据库中的修改同步到索引上
+
+        Returns:
+            同步的修改处数
+        """
+        changes = self._backend.changes_since(since, until)
+        whole_questions = {question_id for question_id, evidence_id in changes if evidence_id is None}
+        for question_id in whole_questions:
+            self._resync_question(question_id)
+        for question_id, evidence_id in changes:
+            if evidence_id is not None and question_id not in whole_questions:
+                self._resync_evidence(question_id, evidence_id)
+
+        if changes:
+            self.refresh_idf()
+        return len(changes)
+
+    def _resync_question(self, question_id: str) -> None:
+        """按数据库中的当前内容重新建立一个问题的全部索引行"""
+        store = self._store
+        question_number = store.question_index(question_id)
+        if question_number is not None:
+            for row in store.rows_of_question(question_number):
+                self._delete_row(int(row))
+            self._unindex_question(question_number)
+            store = self._writable_store()
+            store.remove_question(question_number)
+
+        question_data = self._backend.get_question(question_id)
+        if question_data is not None:
+            question_number = store.add_question(question_id, question_data.get('question', ''))
+            self._index_question(question_number)
+            for evidence_id, evidence_data in question_data.get('evidences', {}).items():
+                if evidence_data.get('evidence', ''):
+                    self._append_row(question_number, evidence_id, evidence_data['evidence'],
+                                     evidence_data.get('answer', []))
+
+    def _resync_evidence(self, question_id: str, evidence_id: str) -> None:
+        """按数据库中的当前内容重新建立一条证据的索引行"""
+        store = self._store
+        question_data = self._backend.get_question(question_id)
+        question_number = store.question_index(question_id)
+        if question_number is not None:
+            row = self._find_row(question_number, evidence_id)
+            if row is not None:
+                self._delete_row(row)
+        if question_data is None:
+            return
+
+        evidence_data = question_data.get('evidences', {}).get(evidence_id, {})
+        if evidence_data.get('evidence', ''):
+            if question_number is None:
+                question_number = store.add_question(question_id, question_data.get('question', ''))
+                self._index_question(question_number)
+            self._append_row(question_number, evidence_id, evidence_data['evidence'],
+                             evidence_data.get('answer', []))
+
+    def _scan_json(self, file_path: str) -> str:
+        """
+        流式扫描知识库文件，只记录每个问题的字节位置和需要建立索引的证据ID
+
+        Returns:
+            文件内容的SHA-256
+        """
+        hasher = hashlib.sha256()
+        questions = []
+        rows = []
+        for question_id, question_data, offset, length in iter_knowledge_json(file_path, hasher):
+            for evidence_id, evidence_data in question_data.get('evidences', {}).items():
+                if evidence_data.get('evidence', ''):
+                    rows.append((len(questions), evidence_id))
+            questions.append((question_id, offset, length))
+        self._store = KnowledgeStore.from_ids(questions, rows, self._read_source)
+        self._streaming = True
+        return hasher.hexdigest()
+
+    def _read_source(self, offset: int, length: int) -> Dict:
+        """流式模式下从知识库文件中读取一个问题的数据"""
+        with open(self._source_path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length).decode('utf-8'))
+
+    @property
+    def kb_ids(self) -> Sequence[str]:
+        """知识库条目的ID（"问题ID#证据ID"），按索引行号排列，包括已删除的行"""
+        return self._store.full_ids
+
+    @property
+    @_exclusive
+    def knowledge_base(self) -> Dict:
+        """导出当前知识库（不含已删除的证据），格式与knowledge_base.json相同"""
+        self._flush_pending_rows()
+        return self._store.to_dict(np.flatnonzero(~self._deleted))
+
+    @property
+    def question_count(self) -> int:
+        """知识库中的问题数量"""
+        return self._store.question_count
+
+    @property
+    def question_ids(self) -> Sequence[str]:
+        """问题ID，按问题编号排列，包括已删除的问题"""
+        return self._store.question_ids
+
+    def has_question(self, question_id: str) -> bool:
+        """知识库中是否有这个问题"""
+        return self._store.question_index(question_id) is not None
+
+    @property
+    def vocabulary_size(self) -> int:
+        """词表中的词数，包括增量修改追加的新词"""
+        return len(self._vocabulary)
+
+    @staticmethod
+    def _index_dir(file_path: str) -> str:
+        """
+        知识库文件对应的索引快照目录
+
+        例如 knowledge_base.json -> knowledge_base.index，
+        knowledge_base.db -> knowledge_base.db.index（与同名JSON文件的快照区分开）
+        """
+        if is_sqlite_path(file_path):
+            return file_path + '.index'
+        return os.path.splitext(file_path)[0] + '.index'
+
+    def _save_index_snapshot(self, index_dir: str, source_hash: str,
+                             revision: Optional[int] = None) -> None:
+        """
+        将拟合好的索引写入磁盘快照
+
+        矩阵和IDF权重保存为.npy文件以便加载时内存映射，词表和条目ID保存为JSON。
+        meta.json最后写入，它的存在即表示快照完整。
+
+        Args:
+            index_dir: 快照目录
+            source_hash: 知识库的标识，JSON文件为内容的SHA-256，SQLite数据库为其uuid
+            revision: SQLite数据库的修改序号，快照包含该序号及之前的全部修改
+        """
+        if self.kb_vectors is None:
+            return
+
+        try:
+            os.makedirs(index_dir, exist_ok=True)
+            meta_path = os.path.join(index_dir, 'meta.json')
+            for path in (meta_path, os.path.join(index_dir, 'lsa.json')):
+                if os.path.exists(path):
+                    os.remove(path)
+
+            kb_vectors = self.kb_vectors.tocsr()
+            self._save_csr(index_dir, '', kb_vectors)
+            self._save_csr(index_dir, 't_', self._kb_vectors_t)
+            if self._row_scales is not None:
+                _save_array(os.path.join(index_dir, 'row_scales.npy'), self._row_scales)
+            _save_array(os.path.join(index_dir, 'idf.npy'), self._idf)
+            if self.dedup_threshold:
+                _save_array(os.path.join(index_dir, 'duplicates.npy'), self._duplicate_array())
+            if self.pinyin_fallback:
+                self._save_csr(index_dir, 'pinyin_', self._pinyin_vectors)
+                pinyin_vocabulary = sorted(self._pinyin_vocabulary, key=self._pinyin_vocabulary.get)
+                with open(os.path.join(index_dir, 'pinyin_vocabulary.json'), 'w', encoding='utf-8') as f:
+                    json.dump(pinyin_vocabulary, f, ensure_ascii=False)
+
+            # 按列号排列的词表
+            vocabulary = sorted(self._vocabulary, key=self._vocabulary.get)
+            with open(os.path.join(index_dir, 'vocabulary.json'), 'w', encoding='utf-8') as f:
+                json.dump(vocabulary, f, ensure_ascii=False)
+            with open(os.path.join(index_dir, 'kb_ids.json'), 'w', encoding='utf-8') as f:
+                json.dump(list(self.kb_ids), f, ensure_ascii=False)
+            question_ids = self._store.question_ids
+            with open(os.path.join(index_dir, 'questions.json'), 'w', encoding='utf-8') as f:
+                json.dump([[key, [question_ids[q] for q in question_numbers]]
+                           for key, question_numbers in self._question_lookup.items()],
+                          f, ensure_ascii=False)
+
+            meta = {
+                "format": INDEX_FORMAT_VERSION,
+                "source_sha256": source_hash,
+                "shape": list(kb_vectors.shape),
+                "revision": revision,
+                "analyzer": self.analyzer,
+                "precision": self.precision,
+                "dedup_threshold": self.dedup_threshold,
+                "pinyin": self.pinyin_fallback,
+            }
+            tmp_path = meta_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+            if revision is not None:
+                self._snapshot_revision = revision
+                self._backend.prune_changes(revision)
+        except Exception as e:
+            self._report(f"警告：索引快照保存失败: {e}")
+            return
+        if self._lsa_vectors is not None and not self._index_dirty:
+            self._save_lsa(index_dir)
+
+    def _save_lsa(self, index_dir: str) -> None:
+        """
+        把LSA投影和投影后的证据向量写入快照目录
+
+        lsa.json记录拟合时的维数设置和快照矩阵的形状，最后写入。
+        """
+        try:
+            _save_array(os.path.join(index_dir, 'lsa_projection.npy'), self._lsa_projection)
+            _save_array(os.path.join(index_dir, 'lsa_vectors.npy'), self._lsa_vectors)
+            lsa_meta = {"components": self.lsa_components, "shape": list(self.kb_vectors.shape)}
+            tmp_path = os.path.join(index_dir, 'lsa.json.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(lsa_meta, f)
+            os.replace(tmp_path, os.path.join(index_dir, 'lsa.json'))
+        except Exception as e:
+            self._report(f"警告：LSA投影保存失败: {e}")
+
+    def _load_lsa(self, index_dir: str) -> bool:
+        """从快照目录加载与当前索引和维数设置一致的LSA投影，证据向量以内存映射方式打开"""
+        lsa_meta_path = os.path.join(index_dir, 'lsa.json')
+        if not os.path.exists(lsa_meta_path):
+            return False
+        try:
+            with open(lsa_meta_path, 'r', encoding='utf-8') as f:
+                lsa_meta = json.load(f)
+            if (lsa_meta.get("components") != self.lsa_components
+                    or lsa_meta.get("shape") != list(self.kb_vectors.shape)):
+                return False
+            projection = np.load(os.path.join(index_dir, 'lsa_projection.npy'))
+            vectors = np.load(os.path.join(index_dir, 'lsa_vectors.npy'), mmap_mode='r')
+            if vectors.shape != (self.kb_vectors.shape[0], projection.shape[1]):
+                raise ValueError("LSA向量与投影的尺寸不一致")
+        except Exception as e:
+            self._report(f"LSA投影损坏，重新拟合: {e}")
+            return False
+        self._lsa_projection = projection
+        self._lsa_vectors = vectors
+        return True
+
+    def _load_index_snapshot(self, index_dir: str, source_hash: str) -> bool:
+        """
+        从磁盘快照恢复索引
+
+        Returns:
+            快照有效并已恢复时返回True；快照不存在、过期或损坏时返回False，由调用方重建索引
+        """
+        meta_path = os.path.join(index_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get("format") != INDEX_FORMAT_VERSION or meta.get("source_sha256") != source_hash:
+                self._report("索引快照已过期，重新构建索引...")
+                return False
+            if meta.get("analyzer") != self.analyzer:
+                self._report("索引快照的文本特征不同，重新构建索引...")
+                return False
+            if meta.get("precision", 'float64') != self.precision:
+                self._report("索引快照的存储精度不同，重新构建索引...")
+                return False
+            if meta.get("dedup_threshold") != self.dedup_threshold:
+                self._report("索引快照的近似重复合并设置不同，重新构建索引...")
+                return False
+            if meta.get("pinyin", False) != self.pinyin_fallback:
+                self._report("索引快照的拼音检索设置不同，重新构建索引...")
+                return False
+
+            idf = np.load(os.path.join(index_dir, 'idf.npy'), mmap_mode='r')
+            with open(os.path.join(index_dir, 'vocabulary.json'), 'r', encoding='utf-8') as f:
+                vocabulary = json.load(f)
+            with open(os.path.join(index_dir, 'kb_ids.json'), 'r', encoding='utf-8') as f:
+                kb_ids = json.load(f)
+            with open(os.path.join(index_dir, 'questions.json'), 'r', encoding='utf-8') as f:
+                question_lookup = json.load(f)
+
+            n_rows, n_terms = meta["shape"]
+            if len(kb_ids) != n_rows or len(vocabulary) != n_terms or len(idf) != n_terms:
+                raise ValueError("快照各部分尺寸不一致")
+            if self._backend is not None:
+                # SQLite知识库的条目顺序以快照为准，之后的修改再重放
+                self._store = self._backend.store_for(kb_ids)
+            elif kb_ids != list(self.kb_ids):
+                raise ValueError("快照的条目与知识库不一致")
+            kb_vectors = self._load_csr(index_dir, '', (n_rows, n_terms))
+            kb_vectors_t = self._load_csr(index_dir, 't_', (n_terms, n_rows))
+            row_scales = None
+            if self.precision == 'uint8':
+                row_scales = np.load(os.path.join(index_dir, 'row_scales.npy'), mmap_mode='r')
+                if len(row_scales) != n_rows:
+                    raise ValueError("快照各部分尺寸不一致")
+            duplicate_of = np.full(n_rows, -1, dtype=np.int64)
+            if self.dedup_threshold:
+                duplicate_of = np.load(os.path.join(index_dir, 'duplicates.npy'))
+                if len(duplicate_of) != n_rows:
+                    raise ValueError("快照各部分尺寸不一致")
+            pinyin_vocabulary = []
+            pinyin_vectors = None
+            if self.pinyin_fallback:
+                with open(os.path.join(index_dir, 'pinyin_vocabulary.json'), 'r', encoding='utf-8') as f:
+                    pinyin_vocabulary = json.load(f)
+                pinyin_vectors = self._load_csr(index_dir, 'pinyin_', (n_rows, len(pinyin_vocabulary)))
+        except Exception as e:
+            self._report(f"索引快照损坏，重新构建索引: {e}")
+            return False
+
+        self._vocabulary = {term: i for i, term in enumerate(vocabulary)}
+        self._idf = np.asarray(idf)
+        self.kb_vectors = kb_vectors
+        self._kb_vectors_t = kb_vectors_t
+        self._row_scales = row_scales
+        self._set_duplicates(duplicate_of)
+        self._pinyin_vocabulary = {term: i for i, term in enumerate(pinyin_vocabulary)}
+        self._pinyin_vectors = pinyin_vectors
+        self._snapshot_revision = meta.get("revision")
+        self._question_lookup = {}
+        self._question_keys = {}
+        for key, question_ids in question_lookup:
+            question_numbers = [self._store.question_index(q) for q in question_ids]
+            self._question_lookup[key] = [q for q in question_numbers if q is not None]
+            for question_number in self._question_lookup[key]:
+                self._question_keys[question_number] = key
+        self._reset_incremental_state()
+        self._rebuild_pinyin_postings()
+        self._lsa_projection = self._lsa_vectors = None
+        lsa_loaded = self.engine == 'lsa' and self._load_lsa(index_dir)
+        self._prepare_engine()
+        if self.engine == 'lsa' and not lsa_loaded:
+            self._save_lsa(index_dir)
+        return True
+
+    @staticmethod
+    def _save_csr(index_dir: str, prefix: str, matrix: sparse.csr_matrix) -> None:
+        """把CSR矩阵的三个数组分别保存为.npy文件"""
+        for name in ('data', 'indices', 'indptr'):
+            _save_array(os.path.join(index_dir, prefix + name + '.npy'), getattr(matrix, name))
+
+    @staticmethod
+    def _load_csr(index_dir: str, prefix: str, shape: Tuple[int, int]) -> sparse.csr_matrix:
+        """以内存映射方式加载_save_csr保存的CSR矩阵"""
+        data = np.load(os.path.join(index_dir, prefix + 'data.npy'), mmap_mode='r')
+        indices = np.load(os.path.join(index_dir, prefix + 'indices.npy'), mmap_mode='r')
+        indptr = np.load(os.path.join(index_dir, prefix + 'indptr.npy'), mmap_mode='r')
+        return sparse.csr_matrix((data, indices, indptr), shape=shape)
+
+    def _build_index(self, texts: Optional[List[str]] = None) -> None:
+        """
+        构建知识库的向量索引
+
+        Args:
+            texts: 各行的证据文本，已经读出时直接传入，否则从存储中读取
+        """
+        store = self._store
+        if not self._streaming and texts is None:
+            texts = [store.evidence_text(row) for row in range(store.row_count)]
+        # 被合并的行按空文档参与拟合，不贡献词频，但仍计入文档总数，与之后refresh_idf的算法一致
+        collapsed = self._find_duplicates(texts)
+        if self._streaming:
+            # 流式模式下证据文本边读边分词，不在内存中保留
+            documents = ([] if collapsed[row] else self._analyze(store.evidence_text(row))
+                         for row in range(store.row_count))
+            first = next(documents, None)
+            documents = itertools.chain([first], documents) if first is not None else []
+        else:
+            documents = self._tokenize_corpus(self.kb_ids, texts)
+            if self._representative:
+                documents = [[] if is_collapsed else tokens for tokens, is_collapsed in zip(documents, collapsed)]
+
+        if documents:
+            from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+
+            # 与TfidfVectorizer相同的两步（它内部就是这样实现的），词频另外留给uint8存储；
+            # 默认按行L2归一化，查询时的点积即为余弦相似度。
+            # 拟合器只在这里使用，取出词表和IDF权重后即丢弃，不再重复占用一份词表的内存
+            counter = CountVectorizer(analyzer=_pretokenized, dtype=np.float64)
+            counts = counter.fit_transform(documents)
+            transformer = TfidfTransformer().fit(counts)
+            self._vocabulary = counter.vocabulary_
+            self._idf = transformer.idf_
+            self._set_vectors(counts, None if self.precision == 'uint8' else transformer.transform(counts))
+        else:
+            self.kb_vectors = self._row_scales = None
+        self._build_pinyin_vectors(texts, collapsed)
+        self._lsa_projection = None  # 词表变了，LSA投影需要重新拟合
+        self._build_question_lookup()
+        self._reset_incremental_state()
+        self._rebuild_term_index()
+
+    def _build_pinyin_vectors(self, texts: Optional[List[str]], collapsed: np.ndarray) -> None:
+        """
+        整体构建拼音检索的行矩阵，被合并的近似重复行与kb_vectors一样为空
+
+        Args:
+            texts: 各行的证据文本，流式模式下为None，从存储中逐条读取
+            collapsed: 每行是否被合并到其他行
+        """
+        self._pinyin_vocabulary = {}
+        self._pinyin_vectors = None
+        if not self.pinyin_fallback:
+            return
+
+        store = self._store
+        if texts is None:
+            evidence_terms = (() if collapsed[row] else text_ngrams(store.evidence_text(row))
+                              for row in range(store.row_count))
+        else:
+            evidence_terms = self._pinyin_corpus([text for text, is_collapsed in zip(texts, collapsed)
+                                                  if not is_collapsed])
+            if self._representative:
+                evidence_terms = iter(evidence_terms)
+                evidence_terms = [() if is_collapsed else next(evidence_terms) for is_collapsed in collapsed]
+        row_question = store.row_question
+        rows = [np.zeros(0, dtype=np.int32) if collapsed[row]
+                else self._pinyin_columns(store.question_text(row_question[row]), terms)
+                for row, terms in enumerate(evidence_terms)]
+        self._pinyin_vectors = _binary_rows(rows, len(self._pinyin_vocabulary))
+
+    def _pinyin_corpus(self, texts: List[str]) -> List[Tuple[str, ...]]:
+        """
+        一批证据的拼音音节二元组，数量较多且build_workers大于1时使用多进程，见_analyze_corpus
+
+        拼音转换比jieba分词还慢（每秒约十万字），是启用拼音检索后构建索引的主要开销。
+        """
+        workers = self.build_workers or os.cpu_count() or 1
+        if workers <= 1 or len(texts) < PARALLEL_BUILD_MIN_DOCS:
+            return [text_ngrams(text) for text in texts]
+
+        # 先在主进程导入pypinyin，fork出的子进程可直接复用
+        load_pypinyin()
+        chunk_size = -(-len(texts) // (workers * 4))
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return [terms for chunk in executor.map(_pinyin_chunk, chunks) for terms in chunk]
+
+    def _pinyin_columns(self, question: str, evidence_terms: Sequence[str]) -> np.ndarray:
+        """
+        一行证据在拼音检索中的列号（升序），即问题文本和证据文本的音节二元组，新的音节二元组追加到词表末尾
+
+        同一问题的各条证据共用问题文本，问题的转换结果经过query_ngrams的LRU缓存。
+        """
+        vocabulary = self._pinyin_vocabulary
+        columns = {vocabulary.setdefault(term, len(vocabulary))
+                   for term in query_ngrams(question) + tuple(evidence_terms)}
+        return np.array(sorted(columns), dtype=np.int32)
+
+    def _find_duplicates(self, texts: Optional[List[str]]) -> np.ndarray:
+        """
+        按dedup_threshold把近似重复的证据聚成簇，记录各簇的代表行和成员
+
+        Args:
+            texts: 各行的证据文本，流式模式下为None，从存储中逐条读取
+
+        Returns:
+            每行是否被合并到其他行
+        """
+        store = self._store
+        if not self.dedup_threshold or not store.row_count:
+            self._set_duplicates(np.full(store.row_count, -1, dtype=np.int64))
+            return np.zeros(store.row_count, dtype=bool)
+
+        start = time.perf_counter()
+        if texts is None:
+            texts = (store.evidence_text(row) for row in range(store.row_count))
+        signatures, valid = minhash_signatures(texts)
+        duplicate_of = find_near_duplicates(signatures, valid, self.dedup_threshold)
+        self._set_duplicates(duplicate_of)
+        self._timings.record('dedup', time.perf_counter() - start, store.row_count)
+        return duplicate_of >= 0
+
+    def _set_duplicates(self, duplicate_of: np.ndarray) -> None:
+        """按每行的代表行号（未被合并为-1）设置近似重复的簇"""
+        members = np.flatnonzero(duplicate_of >= 0)
+        duplicates = defaultdict(list)
+        for member, representative in zip(members.tolist(), duplicate_of[members].tolist()):
+            duplicates[representative].append(member)
+        self._duplicates = {representative: tuple(rows) for representative, rows in duplicates.items()}
+        self._representative = dict(zip(members.tolist(), duplicate_of[members].tolist()))
+
+    def _duplicate_array(self) -> np.ndarray:
+        """每行的代表行号，未被合并的行为-1，保存索引快照用"""
+        duplicate_of = np.full(self.kb_vectors.shape[0], -1, dtype=np.int64)
+        for member, representative in self._representative.items():
+            duplicate_of[member] = representative
+        return duplicate_of
+
+    def _compress_rows(self, counts: sparse.csr_matrix,
+                       matrix: Optional[sparse.csr_matrix] = None) -> Tuple[sparse.csr_matrix, Optional[np.ndarray]]:
+        """
+        把词频行转换为precision指定的存储形式
+
+        浮点精度保存按当前IDF加权并L2归一化的行向量；uint8保存词频本身（超过_QUANT_MAX的截断）
+        和每行的缩放系数，权重在使用时才乘上IDF。IDF变化时只需重算缩放系数（见apply_idf），
+        词频不变，增量修改再重算IDF的结果与整体重建一致，不会因反复量化积累误差。
+
+        Args:
+            counts: 各行的词频，列数不超过当前的词表大小
+            matrix: 已经算好的归一化行向量（整体构建时由TfidfTransformer给出），None表示按词频计算
 
+        Returns:
+            (转换后的矩阵, 每行的缩放系数)，浮点精度时缩放系数为None
+        """
+        if self.precision == 'uint8':
+            counts = sparse.csr_matrix(counts)
+            data = np.minimum(counts.data, _QUANT_MAX).astype(np.uint8)
+            quantized = sparse.csr_matrix((data, counts.indices, counts.indptr), shape=counts.shape)
+            return quantized, self._count_scales(quantized)
 
-class LocalKnowledgeBaseQA:
-    def __init__(self, knowledge_file: str = None, knowledge_dict: Dict = None):
+        if matrix is None:
+            matrix = sparse.csr_matrix(counts, dtype=np.float64, copy=True)
+            matrix.data *= self._idf[matrix.indices]
+            matrix = _normalize_rows(matrix)
+        if self.precision == 'float32':
+            return matrix.astype(np.float32, copy=False), None
+        return matrix.astype(np.float64, copy=False), None
+
+    def _count_scales(self, counts: sparse.csr_matrix) -> np.ndarray:
+        """uint8存储时每行的缩放系数：按当前IDF加权后行向量模长的倒数，全零行为0"""
+        n_rows = counts.shape[0]
+        row_ids = np.repeat(np.arange(n_rows), np.diff(counts.indptr))
+        weights = counts.data * self._idf[counts.indices]
+        norms = np.sqrt(np.bincount(row_ids, weights=weights ** 2, minlength=n_rows))
+        return np.divide(1.0, norms, out=np.zeros(n_rows), where=norms > 0).astype(np.float32)
+
+    def _set_vectors(self, counts: sparse.csr_matrix, matrix: Optional[sparse.csr_matrix] = None) -> None:
+        """以precision指定的形式保存整个知识库的行向量，参数见_compress_rows"""
+        self.kb_vectors, self._row_scales = self._compress_rows(counts, matrix)
+
+    def _float_vectors(self) -> sparse.csr_matrix:
+        """kb_vectors的浮点形式；uint8存储时由词频、IDF和缩放系数还原，返回的是临时副本"""
+        kb_vectors = self.kb_vectors
+        if self._row_scales is None:
+            return kb_vectors
+        row_ids = np.repeat(np.arange(kb_vectors.shape[0]), np.diff(kb_vectors.indptr))
+        data = kb_vectors.data * self._idf[kb_vectors.indices] * self._row_scales[row_ids]
+        return sparse.csr_matrix((data, kb_vectors.indices, kb_vectors.indptr), shape=kb_vectors.shape)
+
+    def _build_question_lookup(self) -> None:
+        """建立归一化问题文本到问题编号的哈希索引"""
+        self._question_lookup = {}
+        self._question_keys = {}
+        for question_number in self._store.live_questions():
+            self._index_question(question_number)
+
+    def _writable_question_lookup(self) -> Dict[str, List[int]]:
         """
-        初始化本地知识库问答系统
+        可以修改的精确匹配索引
+
+        已发布给查询的字典先复制一份再改；各键的问题编号列表修改时整体替换，不原地改动。
+        """
+        if self._snapshot is not None and self._question_lookup is self._snapshot.question_lookup:
+            self._question_lookup = dict(self._question_lookup)
+        return self._question_lookup
+
+    def _writable_store(self) -> KnowledgeStore:
+        """
+        可以修改已有问题和行的存储
+
+        已发布给查询的存储先浅复制一份，被改写的列在第一次修改时才复制，见KnowledgeStore.copy。
+        """
+        if self._snapshot is not None and self._store is self._snapshot.store:
+            self._store = self._store.copy()
+        return self._store
+
+    def _index_question(self, question_number: int) -> None:
+        """把问题加入精确匹配索引"""
+        key = normalize_query(self._store.question_text(question_number))
+        if key:
+            lookup = self._writable_question_lookup()
+            lookup[key] = lookup.get(key, []) + [question_number]
+            self._question_keys[question_number] = key
+
+    def _unindex_question(self, question_number: int) -> None:
+        """把问题从精确匹配索引中去掉"""
+        key = self._question_keys.pop(question_number, None)
+        if key is not None:
+            lookup = self._writable_question_lookup()
+            question_numbers = [q for q in lookup[key] if q != question_number]
+            if question_numbers:
+                lookup[key] = question_numbers
+            else:
+                del lookup[key]
+
+    def _tokenize_corpus(self, kb_ids: Sequence[str], documents: List[str]) -> List[List[str]]:
+        """
+        对全部证据分词，复用预分词语料中ID和文本哈希都没变的条目
+
+        预分词语料保存在索引快照目录下的tokens.json（字符特征为tokens.char.json）中，
+        只包含当前知识库的条目，有新分词的条目时整体重写。
+        """
+        store_path = None
+        store = {}
+        if self.use_index_cache and self._source_path:
+            file_name = 'tokens.json' if self.analyzer == 'jieba' else f'tokens.{self.analyzer}.json'
+            store_path = os.path.join(self._index_dir(self._source_path), file_name)
+            store = self._load_token_store(store_path)
+
+        tokenized = []
+        new_store = {}
+        missing = []  # (位置, 文本哈希)
+        for full_id, text in zip(kb_ids, documents):
+            text_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            entry = store.get(full_id)
+            if entry is None or entry[0] != text_hash:
+                missing.append((len(tokenized), text_hash))
+                tokenized.append(None)
+            else:
+                new_store[full_id] = entry
+                tokenized.append(entry[1])
+
+        computed = len(missing)
+        new_tokens = self._analyze_corpus([documents[position] for position, _ in missing])
+        for (position, text_hash), tokens in zip(missing, new_tokens):
+            tokenized[position] = tokens
+            new_store[kb_ids[position]] = [text_hash, tokens]
+
+        self._corpus_tokens_reused = len(documents) - computed
+        self._corpus_tokens_computed = computed
+        if store_path and (computed or len(new_store) != len(store)):
+            self._save_token_store(store_path, new_store)
+        return tokenized
+
+    def _analyze_corpus(self, texts: List[str]) -> List[List[str]]:
+        """
+        对一批证据分词，jieba分词数量较多且build_workers大于1时使用多进程
+
+        文本按顺序切块交给进程池，map保证结果顺序与输入一致，
+        因此与串行分词的结果完全相同。
+        """
+        workers = self.build_workers or os.cpu_count() or 1
+        # 子类重写了分词函数时子进程无从得知，只能串行
+        custom_tokenizer = type(self)._tokenize is not LocalKnowledgeBaseQA._tokenize
+        # 字符特征足够快，进程间传输结果反而更慢
+        if (workers <= 1 or len(texts) < PARALLEL_BUILD_MIN_DOCS or custom_tokenizer
+                or self.analyzer != 'jieba'):
+            return [self._analyze(text) for text in texts]
+
+        # 先在主进程加载词典，fork出的子进程可直接复用
+        _load_jieba().initialize()
+        chunk_size = -(-len(texts) // (workers * 4))
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return [tokens for chunk in executor.map(_analyze_chunk, chunks) for tokens in chunk]
+
+    def _load_token_store(self, store_path: str) -> Dict:
+        """读取预分词语料，不存在或损坏时返回空字典"""
+        if not os.path.exists(store_path):
+            return {}
+        try:
+            with open(store_path, 'r', encoding='utf-8') as f:
+                store = json.load(f)
+            if store.get("format") != TOKEN_STORE_FORMAT_VERSION:
+                return {}
+            return store["entries"]
+        except Exception as e:
+            self._report(f"预分词语料损坏，重新分词: {e}")
+            return {}
+
+    def _save_token_store(self, store_path: str, entries: Dict) -> None:
+        """写入预分词语料，先写临时文件再替换"""
+        try:
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+            tmp_path = store_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"format": TOKEN_STORE_FORMAT_VERSION, "entries": entries},
+                          f, ensure_ascii=False)
+            os.replace(tmp_path, store_path)
+        except Exception as e:
+            self._report(f"警告：预分词语料保存失败: {e}")
+
+    def _rebuild_term_index(self) -> None:
+        """根据kb_vectors重建按词组织的转置矩阵和检索引擎的辅助结构"""
+        if self.kb_vectors is not None:
+            self._kb_vectors_t = self.kb_vectors.T.tocsr()
+            # 倒排表内的证据行号保持升序，倒排引擎依赖它做二分查找
+            self._kb_vectors_t.sort_indices()
+        else:
+            self._kb_vectors_t = None
+        self._rebuild_pinyin_postings()
+        self._lsa_vectors = None
+        self._prepare_engine()
+        self._index_dirty = False
+
+    def _rebuild_pinyin_postings(self) -> None:
+        """
+        根据_pinyin_vectors重建拼音检索的倒排表，按未删除的证据计算各音节二元组的IDF权重
+
+        IDF与TfidfVectorizer默认的smooth_idf公式相同；只出现在已删除证据中的音节二元组权重也不为0，
+        它们的倒排表在查询时按删除标记过滤。
+        """
+        pinyin_vectors = self._pinyin_vectors
+        if pinyin_vectors is None:
+            self._pinyin_postings = self._pinyin_idf = None
+            return
+        self._pinyin_postings = pinyin_vectors.T.tocsr()
+        self._pinyin_postings.sort_indices()
+        live_indices = pinyin_vectors[~self._deleted].indices if self._num_deleted else pinyin_vectors.indices
+        doc_freq = np.bincount(live_indices, minlength=pinyin_vectors.shape[1])
+        self._pinyin_idf = np.log((1 + self.evidence_count) / (1 + doc_freq)) + 1
+
+    def _reset_incremental_state(self) -> None:
+        """整体构建或恢复索引后，清空增量修改的状态"""
+        self._deleted = np.zeros(self._store.row_count, dtype=bool)
+        self._num_deleted = 0
+        self._pending_rows = []
+        self._pending_pinyin = []
+        self._mutations_since_idf = 0
+        self._index_dirty = False
+        self._bump_version()
+
+    @property
+    def evidence_count(self) -> int:
+        """已建立索引且未被删除的证据数量"""
+        return self._store.row_count - self._num_deleted
+
+    @_exclusive
+    def add_evidence(self, question_id: str, evidence_id: str, evidence: str,
+                     answer: Optional[List[str]] = None, question: Optional[str] = None) -> None:
+        """
+        增加一条证据，不重新拟合整个索引
+
+        新证据只做一次分词，其中的新词追加到词表末尾；已有词沿用当前的IDF权重，
+        直到按idf_refresh_interval或调用refresh_idf重算。
 
         Args:
-            knowledge_file: 知识库JSON文件路径
-            knowledge_dict: 直接传入的知识库字典数据
+            question_id: 问题ID，不存在时新建该问题
+            evidence_id: 证据ID
+            evidence: 证据文本
+            answer: 答案列表
+            question: 问题文本，新建问题时使用；对已有问题会覆盖原问题文本
         """
-        self.knowledge_base = {}  # 知识库
-        self.vectorizer = TfidfVectorizer(tokenizer=self._tokenize)
-        self.kb_vectors = None  # 知识库的向量表示
-        self.kb_ids = []  # 知识库条目的ID
+        if not evidence:
+            raise ValueError("证据文本不能为空")
 
-        if knowledge_file:
-            self.load_from_json(knowledge_file)
-        elif knowledge_dict:
-            self.knowledge_base = knowledge_dict
-            self._build_index()
+        store = self._store
+        question_number = store.question_index(question_id)
+        if question_number is not None and self._find_row(question_number, evidence_id) is not None:
+            raise ValueError(f"证据 {question_id}#{evidence_id} 已存在，请使用update_evidence")
+
+        if self._backend is not None:
+            self._backend.put_evidence(question_id, evidence_id, evidence, list(answer or []), question)
+        if question_number is None:
+            question_number = store.add_question(question_id, question or '')
+            self._index_question(question_number)
+        elif question is not None:
+            self._unindex_question(question_number)
+            self._writable_store().set_question(question_number, question)
+            self._index_question(question_number)
+            self._refresh_pinyin_rows(question_number)
+        self._append_row(question_number, evidence_id, evidence, answer)
+        self._bump_version()
+
+    @_exclusive
+    def update_evidence(self, question_id: str, evidence_id: str, evidence: Optional[str] = None,
+                        answer: Optional[List[str]] = None) -> None:
+        """
+        修改一条已有证据的文本或答案
+
+        把旧行标记为删除，并按add_evidence的方式追加新行；只改答案时也一样，
+        已发布给查询的行不原地修改（见IndexSnapshot）。
+        """
+        store = self._store
+        question_number = store.question_index(question_id)
+        row = None if question_number is None else self._find_row(question_number, evidence_id)
+        if row is None:
+            raise KeyError(f"证据 {question_id}#{evidence_id} 不存在")
+        if evidence is not None and not evidence:
+            raise ValueError("证据文本不能为空")
+
+        # SQLite知识库中未修改过的条目从数据库读取，要在写入数据库之前取出旧内容
+        _, _, _, old_answers, old_evidence = store.record(row)
+        if self._backend is not None:
+            self._backend.update_evidence(question_id, evidence_id, evidence, answer)
+        if (evidence is not None and evidence != old_evidence) or answer is not None:
+            answers = list(answer) if answer is not None else old_answers
+            self._delete_row(row)
+            self._append_row(question_number, evidence_id, evidence or old_evidence, answers)
+        self._bump_version()
+
+    @_exclusive
+    def remove_question(self, question_id: str) -> None:
+        """删除一个问题及其全部证据，对应的索引行标记为删除，之后统一压缩"""
+        question_number = self._store.question_index(question_id)
+        if question_number is None:
+            raise KeyError(f"问题 {question_id} 不存在")
+
+        if self._backend is not None:
+            self._backend.remove_question(question_id)
+        for row in self._store.rows_of_question(question_number):
+            self._delete_row(int(row))
+        self._unindex_question(question_number)
+        self._writable_store().remove_question(question_number)
+        self._bump_version()
+
+    def _find_row(self, question_number: int, evidence_id: str) -> Optional[int]:
+        """查找问题下指定证据ID的未删除行"""
+        self._flush_pending_rows()
+        for row in self._store.rows_of_question(question_number):
+            if not self._deleted[row] and self._store.evidence_id(row) == evidence_id:
+                return int(row)
+        return None
+
+    @_exclusive
+    def refresh_idf(self) -> None:
+        """按当前未删除的证据重算IDF权重"""
+        self._flush_pending_rows()
+        if self.kb_vectors is None:
+            return
+
+        doc_freq = self.document_frequencies()
+        n_docs = self.evidence_count
+        # 与TfidfVectorizer默认的smooth_idf公式一致；只出现在已删除证据中的词权重置零，
+        # 查询时等同于不在词表中，与整体重建的结果保持一致
+        new_idf = np.log((1 + n_docs) / (1 + doc_freq)) + 1
+        new_idf[doc_freq == 0] = 0
+        self.apply_idf(new_idf)
+
+    @_exclusive
+    def document_frequencies(self) -> np.ndarray:
+        """词表中每一列出现在多少条未删除的证据中"""
+        self._flush_pending_rows()
+        if self.kb_vectors is None:
+            return np.zeros(len(self._vocabulary), dtype=np.int64)
+        kb_vectors = self.kb_vectors
+        if self._num_deleted:
+            live_indices = kb_vectors[~self._deleted].indices
         else:
-            # 默认使用空知识库
-            self.knowledge_base = {}
+            live_indices = kb_vectors.indices
+        return np.bincount(live_indices, minlength=kb_vectors.shape[1])
 
-    def _tokenize(self, text: str) -> List[str]:
-        """分词函数，使用jieba分词"""
-        return list(jieba.cut(text))
+    @_exclusive
+    def apply_idf(self, new_idf: np.ndarray) -> None:
+        """
+        换用给定的IDF权重（按列号排列），分片知识库用它让各分片共用全局的IDF
 
-    def load_from_json(self, file_path: str) -> None:
-        """从JSON文件加载知识库"""
-        if not os.path.exists(file_path):
-            print(f"错误：文件 {file_path} 不存在")
+        Args:
+            new_idf: 新的IDF权重，0表示该词不参与打分
+        """
+        self._flush_pending_rows()
+        if self.kb_vectors is None:
             return
+        if self._row_scales is not None:
+            # uint8存储的是词频，只需按新IDF重算各行的缩放系数
+            self._idf = new_idf
+            self._row_scales = self._count_scales(self.kb_vectors)
+        else:
+            # 行向量是tf*idf归一化的结果，按新旧IDF之比缩放各列再归一化，就等于用新IDF重新拟合
+            kb_vectors = self.kb_vectors
+            ratio = np.divide(new_idf, self._idf, out=np.zeros_like(new_idf), where=self._idf > 0)
+            data = kb_vectors.data * ratio[kb_vectors.indices]
+            self._set_vectors(None, _normalize_rows(sparse.csr_matrix(
+                (data, kb_vectors.indices, kb_vectors.indptr), shape=kb_vectors.shape)))
+            self._idf = new_idf
+        self._mutations_since_idf = 0
+        self._index_dirty = True
+        self._bump_version()
 
-        print(f"正在从文件 {file_path} 加载知识库...")
+    @_exclusive
+    def term_idf(self, start: int = 0) -> Dict[str, float]:
+        """
+        词表中列号从start开始的词及其当前的IDF权重，按列号排列
 
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                self.knowledge_base = json.load(f)
+        包括尚未并入索引的新增证据带来的新词；与apply_idf配合，由调用方按词重算权重。
+        """
+        if self._idf is None:
+            return {}
+        # TfidfVectorizer给出的词表不按列号排列，只有之后追加的新词在末尾
+        idf = self._idf
+        columns = sorted((column, term) for term, column in self._vocabulary.items() if column >= start)
+        return {term: float(idf[column]) for column, term in columns}
+
+    @_exclusive
+    def set_external_idf(self, extra_documents: int, shared_idf: Optional[Dict[str, float]]) -> None:
+        """
+        作为分片共用全局IDF时，告知其余分片的证据数和全局的词 -> IDF权重
+
+        之后新增证据中的词优先取shared_idf中的权重，没有时按加上extra_documents的证据数计算。
+
+        Args:
+            extra_documents: 其余分片的未删除证据数
+            shared_idf: 全局的词 -> IDF权重，None表示不共用
+        """
+        self._idf_extra_documents = extra_documents
+        self._shared_idf = shared_idf
+
+    @_exclusive
+    def rebuild_index(self) -> None:
+        """去掉已删除的证据行，按当前内容重新分词并整体构建索引"""
+        self.compact()
+        self._build_index()
+
+    @_exclusive
+    def compact(self) -> None:
+        """去掉已删除的证据行，重新编排行号"""
+        self._flush_pending_rows()
+        if not self._num_deleted:
+            return
+
+        live = np.flatnonzero(~self._deleted)
+        if self._duplicates:
+            # 已删除的行不在簇中，其余行按压缩后的行号重新编号
+            new_rows = np.cumsum(~self._deleted) - 1
+            self._duplicates = {int(new_rows[r]): tuple(int(new_rows[m]) for m in members)
+                                for r, members in self._duplicates.items()}
+            self._representative = {int(new_rows[m]): int(new_rows[r]) for m, r in self._representative.items()}
+        self._store = self._store.take(live)
+        self.kb_vectors = self.kb_vectors[live] if len(live) else None
+        if self._row_scales is not None:
+            self._row_scales = self._row_scales[live] if len(live) else None
+        if self._pinyin_vectors is not None:
+            self._pinyin_vectors = self._pinyin_vectors[live] if len(live) else None
+        self._deleted = np.zeros(len(live), dtype=bool)
+        self._num_deleted = 0
+        self._index_dirty = True
+        self._bump_version()
+
+    def _append_row(self, question_number: int, evidence_id: str, evidence: str,
+                    answers: Optional[List[str]]) -> None:
+        """把新证据写入存储，生成向量并追加到待并入的行中"""
+        if self._idf is None:
+            # 还没有拟合过的空知识库，直接整体构建
+            self._store.append_row(question_number, evidence_id, evidence, answers)
             self._build_index()
-            print(f"成功加载知识库，包含 {len(self.kb_ids)} 个知识条目")
-        except Exception as e:
-            print(f"加载失败: {e}")
+            return
 
-    def _build_index(self) -> None:
-        """构建知识库的向量索引"""
-        documents = []
-        self.kb_ids = []
+        row = self._count_evidence(evidence)
+        if self.pinyin_fallback:
+            self._pending_pinyin.append(
+                self._pinyin_columns(self._store.question_text(question_number), text_ngrams(evidence)))
+        # 流式模式下外部问题的证据行会在追加前读入内存，改写已发布的行
+        self._writable_store().append_row(question_number, evidence_id, evidence, answers)
+        self._pending_rows.append(row)
+        self._mutations_since_idf += 1
 
-        for question_id, question_data in self.knowledge_base.items():
-            for evidence_id, evidence_data in question_data.get('evidences', {}).items():
-                # 使用证据文本构建索引
-                evidence_text = evidence_data.get('evidence', '')
-                if evidence_text:
-                    documents.append(evidence_text)
-                    self.kb_ids.append(f"{question_id}#{evidence_id}")
+    def _count_evidence(self, evidence: str) -> sparse.csr_matrix:
+        """
+        按当前的词表生成一条证据的词频行，由_compress_rows按IDF权重转换为存储形式
 
-        if documents:
-            self.kb_vectors = self.vectorizer.fit_transform(documents)
+        新词追加到词表末尾；新词以及权重已被置零的词按只出现在这一条证据中取IDF权重。
+        """
+        vocabulary = self._vocabulary
+        counts = defaultdict(int)
+        terms = {}  # 列号 -> 词
+        new_terms = []
+        for term in self._analyze(evidence):
+            if term not in vocabulary:
+                vocabulary[term] = len(vocabulary)
+                new_terms.append(term)
+            column = vocabulary[term]
+            counts[column] += 1
+            terms[column] = term
+
+        # 新词以及权重已被置零的词目前只出现在这一条证据中
+        n_docs = self.evidence_count + self._idf_extra_documents + 1
+        single_doc_idf = np.log((1 + n_docs) / 2) + 1
+        shared_idf = self._shared_idf or {}
+        if new_terms:
+            self._idf = np.append(self._idf, [shared_idf.get(term, single_doc_idf) for term in new_terms])
+        idf = self._idf
+        revived = [column for column in counts if idf[column] == 0]
+        if revived:
+            idf = self._idf = np.array(idf)
+            idf[revived] = [shared_idf.get(terms[column], single_doc_idf) for column in revived]
+
+        columns = np.array(sorted(counts), dtype=np.int32)
+        frequencies = np.array([counts[c] for c in columns], dtype=float)
+        return sparse.csr_matrix((frequencies, columns, [0, len(columns)]), shape=(1, len(idf)))
+
+    def _delete_row(self, row: int) -> None:
+        """把索引行标记为删除"""
+        self._flush_pending_rows()
+        if self._deleted[row]:
+            return
+        self._deleted[row] = True
+        self._num_deleted += 1
+        self._mutations_since_idf += 1
+        if row in self._duplicates:
+            self._expand_duplicates(row)
+        elif row in self._representative:
+            representative = self._representative[row]
+            self._representative = {m: r for m, r in self._representative.items() if m != row}
+            members = tuple(m for m in self._duplicates[representative] if m != row)
+            self._duplicates = dict(self._duplicates)
+            if members:
+                self._duplicates[representative] = members
+            else:
+                del self._duplicates[representative]
+
+    def _expand_duplicates(self, representative: int) -> None:
+        """
+        代表行被删除后解散它的簇，其余成员按当前的IDF权重重新生成各自的向量
+
+        成员原来的向量为空，直接换成新向量，行号不变。
+        """
+        members = self._duplicates[representative]
+        self._duplicates = {r: rows for r, rows in self._duplicates.items() if r != representative}
+        self._representative = {m: r for m, r in self._representative.items() if r != representative}
+
+        store = self._store
+        texts = [store.evidence_text(member) for member in members]
+        vectors = [self._count_evidence(text) for text in texts]
+        n_terms = len(self._idf)
+        block, scales = self._compress_rows(sparse.vstack([_widen(v, n_terms) for v in vectors], format='csr'))
+        self.kb_vectors = _replace_rows(_widen(self.kb_vectors, n_terms), members, block)
+        if scales is not None:
+            row_scales = np.array(self._row_scales)
+            row_scales[list(members)] = scales
+            self._row_scales = row_scales
+        if self._pinyin_vectors is not None:
+            rows = [self._pinyin_columns(store.question_text(store.row_question[member]), text_ngrams(text))
+                    for member, text in zip(members, texts)]
+            n_columns = len(self._pinyin_vocabulary)
+            self._pinyin_vectors = _replace_rows(_widen(self._pinyin_vectors, n_columns), members,
+                                                 _binary_rows(rows, n_columns))
+        self._mutations_since_idf += len(members)
+        self._index_dirty = True
+
+    def _refresh_pinyin_rows(self, question_number: int) -> None:
+        """问题文本修改后重新生成该问题各条证据的拼音行，被合并的近似重复行仍然为空"""
+        if self._pinyin_vectors is None:
+            return
+        store = self._store
+        question = store.question_text(question_number)
+        rows = sorted(int(row) for row in store.rows_of_question(question_number)
+                      if row < self._pinyin_vectors.shape[0] and not self._deleted[row]
+                      and row not in self._representative)
+        if not rows:
+            return
+        columns = [self._pinyin_columns(question, text_ngrams(store.evidence_text(row))) for row in rows]
+        n_columns = len(self._pinyin_vocabulary)
+        self._pinyin_vectors = _replace_rows(_widen(self._pinyin_vectors, n_columns), rows,
+                                             _binary_rows(columns, n_columns))
+        self._index_dirty = True
+
+    def _flush_pending_rows(self) -> None:
+        """把暂存的新增行并入kb_vectors，新词对应的列一并扩展"""
+        if not self._pending_rows:
+            return
+
+        n_terms = len(self._vocabulary)
+        pending, scales = self._compress_rows(
+            sparse.vstack([_widen(m, n_terms) for m in self._pending_rows], format='csr'))
+        blocks = ([_widen(self.kb_vectors, n_terms)] if self.kb_vectors is not None else []) + [pending]
+        self.kb_vectors = sparse.vstack(blocks, format='csr')
+        if scales is not None:
+            self._row_scales = (scales if self._row_scales is None
+                                else np.concatenate([self._row_scales, scales]))
+        if self._pending_pinyin:
+            n_columns = len(self._pinyin_vocabulary)
+            pending = _binary_rows(self._pending_pinyin, n_columns)
+            self._pinyin_vectors = (pending if self._pinyin_vectors is None else sparse.vstack(
+                [_widen(self._pinyin_vectors, n_columns), pending], format='csr'))
+            self._pending_pinyin = []
+        self._deleted = np.append(self._deleted, np.zeros(len(self._pending_rows), dtype=bool))
+        self._pending_rows = []
+        self._index_dirty = True
+
+    def _ensure_index(self) -> None:
+        """把积压的增量修改落实到索引上，并发布新的查询快照；调用方持有写锁"""
+        start = time.perf_counter()
+        n_pending = len(self._pending_rows)
+        self._flush_pending_rows()
+        if self.idf_refresh_interval is not None and self._mutations_since_idf >= self.idf_refresh_interval:
+            self.refresh_idf()
+        n_rows = self._store.row_count
+        if n_rows and self._num_deleted > self.compact_ratio * n_rows:
+            self.compact()
+        if self._index_dirty:
+            self._rebuild_term_index()
+            self._timings.record('index_refresh', time.perf_counter() - start, n_pending)
+        if self._snapshot is None or self._snapshot.version != self._index_version:
+            self._publish_snapshot()
+
+    def _publish_snapshot(self) -> None:
+        """把当前的索引状态发布为查询读取的快照，一次引用赋值完成切换"""
+        self._snapshot = IndexSnapshot(
+            version=self._index_version,
+            engine=self.engine,
+            store=self._store,
+            vocabulary=self._vocabulary,
+            idf=self._idf,
+            kb_vectors=self.kb_vectors,
+            kb_vectors_t=self._kb_vectors_t,
+            row_scales=self._row_scales,
+            term_max_weight=self._term_max_weight,
+            lsa_projection=self._lsa_projection,
+            lsa_vectors=self._lsa_vectors,
+            # 删除标记会被原地修改，复制一份；精确匹配索引在下次修改时才复制，见_writable_question_lookup
+            deleted=self._deleted.copy(),
+            num_deleted=self._num_deleted,
+            question_lookup=self._question_lookup,
+            duplicates=self._duplicates,
+            pinyin_vocabulary=self._pinyin_vocabulary if self._pinyin_postings is not None else None,
+            pinyin_postings=self._pinyin_postings,
+            pinyin_idf=self._pinyin_idf,
+        )
+
+    def snapshot(self) -> IndexSnapshot:
+        """
+        当前的索引快照，见IndexSnapshot
+
+        需要在同一份索引状态上做多步读取的调用方（例如分片知识库按分片词表计算模长后再检索）
+        先取一次快照，再把它传给search_knowledge_batch或match_question。
+        """
+        return self._current_snapshot()
+
+    def _current_snapshot(self) -> IndexSnapshot:
+        """
+        查询开始时取得的索引快照，一次查询只读这一个快照
+
+        已发布的快照是最新的时直接返回，不加锁；有尚未发布的修改时等待写锁，落实修改后发布新快照。
+        """
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != self._index_version:
+            with self._write_lock:
+                self._ensure_index()
+                snapshot = self._snapshot
+        return snapshot
+
+    @staticmethod
+    def _drop_deleted(snapshot: IndexSnapshot, indices: np.ndarray,
+                      scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """从打分结果中去掉已删除的行"""
+        if not snapshot.num_deleted:
+            return indices, scores
+        live = ~snapshot.deleted[indices]
+        return indices[live], scores[live]
+
+    @_exclusive
+    def set_engine(self, engine: str) -> None:
+        """切换检索引擎，复用已构建的索引"""
+        if engine not in SEARCH_ENGINES:
+            raise ValueError(f"未知的检索引擎: {engine}，可选: {', '.join(SEARCH_ENGINES)}")
+        self.engine = engine
+        self._prepare_engine()
+        self._bump_version()
+
+    def _prepare_engine(self) -> None:
+        """索引就绪后计算当前检索引擎需要的辅助结构"""
+        self._term_max_weight = None
+        if self.engine == 'inverted' and self._kb_vectors_t is not None:
+            kb_vectors_t = self._kb_vectors_t
+            self._term_max_weight = np.zeros(kb_vectors_t.shape[0])
+            weights = kb_vectors_t.data
+            if self._row_scales is not None:
+                # uint8存储的是词频，权重 = 词频 * IDF * 行缩放系数
+                term_ids = np.repeat(np.arange(kb_vectors_t.shape[0]), np.diff(kb_vectors_t.indptr))
+                weights = weights * self._idf[term_ids] * self._row_scales[kb_vectors_t.indices]
+            non_empty = np.flatnonzero(np.diff(kb_vectors_t.indptr))
+            if len(non_empty):
+                self._term_max_weight[non_empty] = np.maximum.reduceat(
+                    weights, kb_vectors_t.indptr[non_empty])
+        elif self.engine == 'lsa' and self.kb_vectors is not None:
+            if self._lsa_projection is None:
+                self._fit_lsa()
+            if self._lsa_vectors is None:
+                self._lsa_vectors = self._lsa_project(self._float_vectors(), self._lsa_projection)
+
+    def _fit_lsa(self) -> None:
+        """
+        用截断SVD拟合LSA投影（词 -> 潜在空间）
+
+        只在整体构建索引或第一次切换到lsa引擎时拟合；之后的增量修改沿用这个投影，
+        新证据直接投影到已有的潜在空间中，拟合之后出现的新词不参与投影。
+        """
+        kb_vectors = self._float_vectors()
+        if self._num_deleted:
+            kb_vectors = kb_vectors[~self._deleted]
+        if min(kb_vectors.shape) <= self.lsa_components:
+            # 矩阵很小时直接做完整SVD，维数不超过矩阵的秩
+            _, _, vt = np.linalg.svd(kb_vectors.toarray(), full_matrices=False)
+            vt = vt[:self.lsa_components]
+        else:
+            from sklearn.utils.extmath import randomized_svd
+
+            # 固定随机种子，同一份索引每次拟合的结果相同
+            _, _, vt = randomized_svd(kb_vectors, self.lsa_components, random_state=0)
+        self._lsa_projection = np.ascontiguousarray(vt.T, dtype=np.float32)
+
+    @staticmethod
+    def _lsa_project(matrix: sparse.csr_matrix, projection: np.ndarray) -> np.ndarray:
+        """把TF-IDF行向量投影到LSA潜在空间并按行归一化，返回连续存储的float32数组"""
+        n_terms, n_components = projection.shape
+        if matrix.nnz <= LSA_GATHER_MAX_NNZ:
+            # 查询向量只有少数几个词，直接取出这些词的投影行加权求和，省去稀疏矩阵运算的固定开销
+            indices = matrix.indices
+            weights = matrix.data.astype(np.float32)
+            if len(indices) and indices.max() >= n_terms:
+                # 拟合之后新增的词不在潜在空间中
+                weights[indices >= n_terms] = 0
+                indices = np.minimum(indices, n_terms - 1)
+            weighted = weights[:, None] * projection[indices]
+            latent = np.zeros((matrix.shape[0], n_components), dtype=np.float32)
+            non_empty = np.flatnonzero(np.diff(matrix.indptr))
+            if len(non_empty):
+                latent[non_empty] = np.add.reduceat(weighted, matrix.indptr[non_empty], axis=0)
         else:
-            self.kb_vectors = None
+            if matrix.shape[1] > n_terms:
+                matrix = matrix[:, :n_terms]
+            latent = np.empty((matrix.shape[0], n_components), dtype=np.float32)
+            for start in range(0, matrix.shape[0], LSA_PROJECT_CHUNK_ROWS):
+                end = start + LSA_PROJECT_CHUNK_ROWS
+                # 与投影矩阵同为float32，避免每次乘法都把整个投影矩阵转换为float64
+                latent[start:end] = matrix[start:end].astype(np.float32) @ projection
+        norms = np.sqrt(np.einsum('ij,ij->i', latent, latent))
+        np.divide(latent, norms[:, None], out=latent, where=norms[:, None] > 0)
+        return latent
+
+    def _search_lsa(self, snapshot: IndexSnapshot, query_latent: np.ndarray,
+                    top_n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        LSA检索，一次BLAS矩阵-向量乘法给全部证据打分
+
+        Returns:
+            (行号, 得分)，按得分降序排列
+        """
+        scores = snapshot.lsa_vectors @ query_latent
+        if snapshot.num_deleted:
+            scores[snapshot.deleted] = 0
+        return self._select_top_k(np.arange(len(scores)), scores, top_n)
+
+    def _transform(self, snapshot: IndexSnapshot, texts: List[str]) -> sparse.csr_matrix:
+        """把文本转换为L2归一化的TF-IDF行向量，与TfidfVectorizer.transform的结果一致"""
+        start = time.perf_counter()
+        token_lists = [self._analyze_query(text) for text in texts]
+        tokenized = time.perf_counter()
 
-    def search_knowledge(self, query: str, top_n: int = 3) -> List[Dict]:
+        # 词表只在末尾追加新词，快照发布之后追加的词不在快照的列范围内
+        vocabulary = snapshot.vocabulary
+        n_terms = snapshot.n_terms
+        indices = []
+        data = []
+        indptr = [0]
+        for tokens in token_lists:
+            counts = defaultdict(int)
+            for term in tokens:
+                column = vocabulary.get(term)
+                if column is not None and column < n_terms:
+                    counts[column] += 1
+            indices.extend(counts)
+            data.extend(counts.values())
+            indptr.append(len(indices))
+
+        matrix = sparse.csr_matrix(
+            (np.array(data, dtype=float), np.array(indices, dtype=np.int32), np.array(indptr)),
+            shape=(len(texts), n_terms))
+        matrix.data *= snapshot.idf[matrix.indices]
+        matrix.eliminate_zeros()
+        # 直接按行归一化：查询向量很小，sklearn.normalize的参数检查反而是主要开销
+        row_ids = np.repeat(np.arange(len(texts)), np.diff(matrix.indptr))
+        row_norms = np.sqrt(np.bincount(row_ids, weights=matrix.data ** 2, minlength=len(texts)))
+        matrix.data /= row_norms[row_ids]
+        self._timings.record('tokenize', tokenized - start, len(texts))
+        self._timings.record('vectorize', time.perf_counter() - tokenized, len(texts))
+        return matrix
+
+    def search_knowledge(self, query: str, top_n: int = 3, slim: bool = False) -> List[Dict]:
         """
         在知识库中搜索与查询相关的知识条目
 
+        可以在多个线程中同时调用，见IndexSnapshot。
+
         Args:
             query: 查询文本
             top_n: 返回的结果数量
+            slim: 返回SearchHit而不是字典，只带行号和得分，问题、答案和证据文本在访问时才读取
+
+        Returns:
+            相关知识条目的列表，每个条目包含id、question、answer、evidence和相似度得分
+        """
+        snapshot = self._current_snapshot()
+        hits = self._search_hits(snapshot, query, top_n)
+        return hits if slim else self._result_dicts([hits])[0]
+
+    def _search_hits(self, snapshot: IndexSnapshot, query: str, top_n: int) -> List[SearchHit]:
+        """在给定的快照上检索一条查询，结果经过结果缓存"""
+        key = ('search', normalize_query(query), top_n, snapshot.version)
+        found = self._cache_get(key)
+        if found is None:
+            found = self._search_rows(snapshot, [query], top_n)[0]
+            self._cache_put(key, found)
+        return self._hits(snapshot, *found)
+
+    @staticmethod
+    def _hits(snapshot: IndexSnapshot, rows: np.ndarray, scores: np.ndarray) -> List[SearchHit]:
+        """把一条查询的(行号, 得分)包装为SearchHit"""
+        return [SearchHit(snapshot, row, score) for row, score in zip(rows.tolist(), scores.tolist())]
+
+    def _result_dicts(self, all_hits: List[List[SearchHit]]) -> List[List[Dict]]:
+        """把各查询的SearchHit组装成字典"""
+        start = time.perf_counter()
+        all_results = [[hit.as_dict() for hit in hits] for hits in all_hits]
+        self._timings.record('build_results', time.perf_counter() - start, len(all_hits))
+        return all_results
+
+    def search_knowledge_batch(self, queries: List[str], top_n: int = 3, batch_size: int = 256,
+                               slim: bool = False, snapshot: Optional[IndexSnapshot] = None) -> List[List[Dict]]:
+        """
+        批量搜索知识库，结果与逐条调用search_knowledge一致
+
+        所有查询一起分词和向量化，每批查询只做一次稀疏矩阵乘法。
+        乘积只包含与查询有公共词的证据，之后的筛选和排序开销随命中数增长，而不是随知识库规模增长。
+
+        Args:
+            queries: 查询文本列表
+            top_n: 每个查询返回的结果数量
+            batch_size: 每批参与打分的查询数，用于限制中间结果的内存占用
+            slim: 返回SearchHit而不是字典，见search_knowledge
+            snapshot: 在调用方已取得的快照上检索，None表示取当前快照
+
+        Returns:
+            与queries一一对应的结果列表
+        """
+        if snapshot is None:
+            snapshot = self._current_snapshot()
+        all_hits = [self._hits(snapshot, rows, scores)
+                    for rows, scores in self._search_rows(snapshot, queries, top_n, batch_size)]
+        return all_hits if slim else self._result_dicts(all_hits)
+
+    def _search_rows(self, snapshot: IndexSnapshot, queries: List[str], top_n: int,
+                     batch_size: int = 256) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        在给定的快照上批量检索，见search_knowledge_batch
 
         Returns:
-            相关知识条目的列表，每个条目包含id、content、source和相似度得分
+            与queries一一对应的(行号, 得分)，按得分降序排列
         """
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0))
+        all_results = [empty] * len(queries)
         # 修复矩阵判断逻辑
-        if self.kb_vectors is None or self.kb_vectors.size == 0 or not query.strip():
-            return []
+        if snapshot.kb_vectors is None or snapshot.kb_vectors.size == 0 or top_n <= 0:
+            return all_results
 
-        query_vector = self.vectorizer.transform([query])
-        similarities = cosine_similarity(query_vector, self.kb_vectors).flatten()
+        timings = self._timings
+        engine = snapshot.engine
+        search_start = time.perf_counter()
+        positions = [i for i, query in enumerate(queries) if query.strip()]
+        for start in range(0, len(positions), batch_size):
+            chunk = positions[start:start + batch_size]
+            query_vectors = self._transform(snapshot, [queries[i] for i in chunk])
+            scoring = time.perf_counter()
+            if engine == 'matrix':
+                similarities = self._score_matrix(snapshot, query_vectors)
+            elif engine == 'lsa':
+                query_latent = self._lsa_project(query_vectors, snapshot.lsa_projection)
+            score_seconds = time.perf_counter() - scoring
 
-        # 获取相似度最高的top_n个索引
-        top_indices = similarities.argsort()[::-1][:top_n]
-        results = []
+            selecting = time.perf_counter()
+            for row, position in enumerate(chunk):
+                if engine == 'inverted':
+                    all_results[position] = self._search_inverted(snapshot, query_vectors[row], top_n)
+                elif engine == 'lsa':
+                    all_results[position] = self._search_lsa(snapshot, query_latent[row], top_n)
+                else:
+                    row_slice = slice(similarities.indptr[row], similarities.indptr[row + 1])
+                    indices, scores = self._drop_deleted(
+                        snapshot, similarities.indices[row_slice], similarities.data[row_slice])
+                    all_results[position] = self._select_top_k(indices, scores, top_n)
+            select_seconds = time.perf_counter() - selecting
 
-        for idx in top_indices:
-            if similarities[idx] > 0:  # 只返回有一定相似度的结果
-                full_id = self.kb_ids[idx]
-                question_id, evidence_id = full_id.split('#', 1)
+            if engine == 'matrix':
+                timings.record('score', score_seconds, len(chunk))
+                timings.record('select', select_seconds, len(chunk))
+            else:
+                timings.record('score', score_seconds + select_seconds, len(chunk))
 
-                # 获取问题和证据信息
-                question_data = self.knowledge_base.get(question_id, {})
-                evidence_data = question_data.get('evidences', {}).get(evidence_id, {})
+        if snapshot.pinyin_postings is not None:
+            self._pinyin_fallback(snapshot, queries, positions, top_n, all_results)
+        timings.record('search', time.perf_counter() - search_start, len(positions))
+        return all_results
 
-                results.append({
-                    "id": full_id,
-                    "question": question_data.get('question', ''),
-                    "answer": evidence_data.get('answer', []),
-                    "evidence": evidence_data.get('evidence', ''),
-                    "score": float(similarities[idx])  # 转换为普通float以便JSON序列化
-                })
+    def _pinyin_fallback(self, snapshot: IndexSnapshot, queries: List[str], positions: List[int], top_n: int,
+                         all_results: List[Tuple[np.ndarray, np.ndarray]]) -> None:
+        """
+        主检索没有结果或最高得分低于PINYIN_FALLBACK_SCORE的查询改用拼音检索，找到结果时替换all_results中的对应项
 
-        return results
+        语音识别的同音错字使分词或字符特征对不上，主检索的得分偏低；拼音检索的得分为覆盖率，
+        只要达到PINYIN_MIN_COVERAGE就比主检索的低分结果更可信。
+        """
+        start = time.perf_counter()
+        fallback = [position for position in positions
+                    if not len(all_results[position][1]) or all_results[position][1][0] < PINYIN_FALLBACK_SCORE]
+        if not fallback:
+            return
+        for position in fallback:
+            rows, scores = self._search_pinyin(snapshot, queries[position], top_n)
+            if len(rows):
+                all_results[position] = (rows, scores)
+                self._pinyin_hits += 1
+        self._pinyin_searches += len(fallback)
+        self._timings.record('pinyin', time.perf_counter() - start, len(fallback))
+
+    def _search_pinyin(self, snapshot: IndexSnapshot, query: str, top_n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        拼音检索，合并查询中各音节二元组的倒排表
+
+        每条证据的得分为它包含的查询音节二元组的IDF权重之和占查询全部音节二元组权重的比例（覆盖率），
+        不在索引中的音节二元组按文档频率为0计权重。出现在大部分证据中的音节二元组
+        （见PINYIN_MAX_DF_RATIO）倒排表很长，区分度又低，查询中还有其他音节二元组时跳过它们。
+
+        Returns:
+            (行号, 覆盖率)，按覆盖率降序排列，只包含覆盖率不低于PINYIN_MIN_COVERAGE的证据
+        """
+        postings = snapshot.pinyin_postings
+        n_columns = postings.shape[0]
+        # 快照发布之后追加的音节二元组不在快照的倒排表范围内，与没见过的一样处理
+        columns = [snapshot.pinyin_vocabulary.get(term, n_columns) for term in query_ngrams(query)]
+        known = np.array([column for column in columns if column < n_columns], dtype=np.int64)
+        unseen = len(columns) - len(known)
+        starts, ends = postings.indptr[known], postings.indptr[known + 1]
+        common = ends - starts > PINYIN_MAX_DF_RATIO * snapshot.n_rows
+        if common.any() and not common.all():
+            known, starts, ends = known[~common], starts[~common], ends[~common]
+        if not len(known):
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        weights = snapshot.pinyin_idf[known]
+        total = weights.sum() + unseen * (np.log(1 + snapshot.n_rows - snapshot.num_deleted) + 1)
+
+        rows = np.concatenate([postings.indices[start:end] for start, end in zip(starts, ends)])
+        candidates, inverse = np.unique(rows, return_inverse=True)
+        scores = np.bincount(inverse.ravel(), weights=np.repeat(weights, ends - starts),
+                             minlength=len(candidates)) / total
+        candidates, scores = self._drop_deleted(snapshot, candidates, scores)
+        keep = scores >= PINYIN_MIN_COVERAGE
+        return self._select_top_k(candidates[keep], scores[keep], top_n)
+
+    @staticmethod
+    def _score_matrix(snapshot: IndexSnapshot, query_vectors: sparse.csr_matrix) -> sparse.csr_matrix:
+        """
+        一批查询与全部证据的相似度（稀疏矩阵，只包含与查询有公共词的证据）
+
+        查询向量和证据向量都已归一化，点积即余弦相似度。
+        """
+        kb_vectors_t = snapshot.kb_vectors_t
+        if snapshot.row_scales is None:
+            # 查询向量转换为与索引相同的类型，否则scipy每次都会把整个索引转换一遍
+            return (query_vectors.astype(kb_vectors_t.dtype, copy=False) @ kb_vectors_t).tocsr()
+
+        # uint8存储：只取出查询词的倒排表（词频）转换为浮点数，查询向量先乘上IDF，相乘后再按证据行缩放
+        terms, columns = np.unique(query_vectors.indices, return_inverse=True)
+        postings = kb_vectors_t[terms]
+        postings = sparse.csr_matrix(
+            (postings.data.astype(np.float32), postings.indices, postings.indptr), shape=postings.shape)
+        query_weights = query_vectors.data * snapshot.idf[query_vectors.indices]
+        queries = sparse.csr_matrix(
+            (query_weights.astype(np.float32), columns.ravel(), query_vectors.indptr),
+            shape=(query_vectors.shape[0], len(terms)))
+        similarities = (queries @ postings).tocsr()
+        similarities.data *= snapshot.row_scales[similarities.indices]
+        return similarities
+
+    def _search_inverted(self, snapshot: IndexSnapshot, query_vector: sparse.csr_matrix,
+                         top_n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        倒排索引检索，只给与查询有公共词的证据打分
+
+        按词的得分上界从高到低逐个合并倒排表（MaxScore思路）：一旦当前第top_n名的
+        得分已超过剩余词的上界之和，没出现过的证据不可能再进入前top_n，
+        之后的词只给已有候选累加得分，并丢弃追不上门槛的候选。
+
+        Returns:
+            (行号, 得分)，按得分降序排列
+        """
+        kb_vectors_t = snapshot.kb_vectors_t
+        row_scales = snapshot.row_scales
+        idf = snapshot.idf
+        terms = query_vector.indices
+        weights = query_vector.data
+        upper_bounds = weights * snapshot.term_max_weight[terms]
+        order = np.argsort(-upper_bounds, kind='stable')
+        terms, weights, upper_bounds = terms[order], weights[order], upper_bounds[order]
+        # remaining[j]为第j个词之后所有词的上界之和
+        remaining = np.append(np.cumsum(upper_bounds[::-1])[::-1][1:], 0.0)
+
+        candidates = np.empty(0, dtype=kb_vectors_t.indices.dtype)
+        scores = np.empty(0)
+        accept_new = True
+        for term, weight, rest in zip(terms, weights, remaining):
+            start, end = kb_vectors_t.indptr[term], kb_vectors_t.indptr[term + 1]
+            postings = kb_vectors_t.indices[start:end]
+            if row_scales is not None:
+                # uint8存储的是词频，权重 = 词频 * IDF * 行缩放系数
+                contributions = kb_vectors_t.data[start:end] * (weight * idf[term])
+                contributions *= row_scales[postings]
+            else:
+                contributions = kb_vectors_t.data[start:end] * weight
+
+            if accept_new:
+                postings_alive, contributions_alive = self._drop_deleted(snapshot, postings, contributions)
+                merged, inverse = np.unique(np.concatenate([candidates, postings_alive]),
+                                            return_inverse=True)
+                scores = np.bincount(inverse, weights=np.concatenate([scores, contributions_alive]),
+                                     minlength=len(merged))
+                candidates = merged
+            elif len(candidates) and len(postings):
+                positions = np.minimum(np.searchsorted(postings, candidates), len(postings) - 1)
+                hit = postings[positions] == candidates
+                scores[hit] += contributions[positions[hit]]
+
+            if len(scores) >= top_n > 0:
+                kth = len(scores) - top_n
+                threshold = np.partition(scores, kth)[kth]
+                if threshold > rest:
+                    accept_new = False
+                    keep = scores + rest >= threshold
+                    candidates, scores = candidates[keep], scores[keep]
+
+        return self._select_top_k(candidates, scores, top_n)
+
+    @staticmethod
+    def _select_top_k(indices: np.ndarray, scores: np.ndarray,
+                      top_n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        从稀疏打分结果中选出得分最高的top_n个证据
+
+        先过滤零分，再用argpartition做部分选择，只对选中的元素排序。
+        相同得分按行号升序排列，保证任何打分路径下结果顺序一致。
+
+        Args:
+            indices: 证据行号
+            scores: 对应的相似度得分
+
+        Returns:
+            (行号, 得分)，按得分降序排列
+        """
+        # 只返回有一定相似度的结果
+        positive = scores > 0
+        indices, scores = indices[positive], scores[positive]
+
+        if len(scores) > top_n:
+            # 第top_n大的得分作为门槛，门槛上的并列项按行号取够top_n个
+            kth = len(scores) - top_n
+            threshold = np.partition(scores, kth)[kth]
+            above = np.flatnonzero(scores > threshold)
+            tied = np.flatnonzero(scores == threshold)
+            tied = tied[np.argsort(indices[tied], kind='stable')][:top_n - len(above)]
+            keep = np.concatenate([above, tied])
+            indices, scores = indices[keep], scores[keep]
+
+        order = np.lexsort((indices, -scores))
+        return indices[order], scores[order]
+
+    @staticmethod
+    def _build_result(snapshot: IndexSnapshot, idx: int, score: float) -> Dict:
+        """根据索引行号组装一个搜索结果"""
+        question_id, evidence_id, question, answers, evidence = snapshot.store.record(idx)
+        result = {
+            "id": f"{question_id}#{evidence_id}",
+            "question": question,
+            "answer": answers,
+            "evidence": evidence,
+            "score": float(score)  # 转换为普通float以便JSON序列化
+        }
+        members = snapshot.duplicates.get(idx)
+        if members:
+            # 合并到这一行的近似重复证据，它们的向量为空，不会单独出现在结果中
+            result["duplicates"] = [snapshot.store.full_id(member) for member in members]
+        return result
 
     def generate_answer(self, query: str, top_n: int = 3) -> Dict:
         """
         基于知识库生成问题的答案
 
+        可以在多个线程中同时调用，见IndexSnapshot。
+
         Args:
             query: 用户问题
             top_n: 参考的知识条目数量
@@ -122,41 +2581,112 @@ class LocalKnowledgeBaseQA:
         Returns:
             包含答案和参考知识的字典
         """
-        results = self.search_knowledge(query, top_n)
+        start = time.perf_counter()
+        snapshot = self._current_snapshot()
+        normalized = normalize_query(query)
+        key = ('answer', normalized, top_n, snapshot.version)
+        answer = self._cache_get(key)
+        if answer is None:
+            hits = self._match_question(snapshot, normalized, top_n)
+            if hits is None:
+                hits = self._search_hits(snapshot, query, top_n)
+            answer = self.answer_from_results(hits)
+            self._cache_put(key, answer)
+        answer = dict(answer, references=[dict(ref) for ref in answer["references"]])
+        self._timings.record('answer', time.perf_counter() - start)
+        return answer
+
+    def generate_answer_batch(self, queries: List[str], top_n: int = 3) -> List[Dict]:
+        """
+        批量生成答案，结果与逐条调用generate_answer一致
+
+        Args:
+            queries: 用户问题列表
+            top_n: 参考的知识条目数量
+
+        Returns:
+            与queries一一对应的答案字典列表
+        """
+        start = time.perf_counter()
+        snapshot = self._current_snapshot()
+        all_hits = [self._match_question(snapshot, normalize_query(query), top_n) for query in queries]
+        pending = [i for i, hits in enumerate(all_hits) if hits is None]
+        searched = self._search_rows(snapshot, [queries[i] for i in pending], top_n)
+        for i, (rows, scores) in zip(pending, searched):
+            all_hits[i] = self._hits(snapshot, rows, scores)
+        answers = [self.answer_from_results(hits) for hits in all_hits]
+        self._timings.record('answer', time.perf_counter() - start, len(queries))
+        return answers
+
+    def match_question(self, query: str, top_n: int = 3,
+                       snapshot: Optional[IndexSnapshot] = None) -> Optional[List[SearchHit]]:
+        """
+        问题精确匹配，见_match_question
+
+        Args:
+            query: 用户问题，匹配前先归一化
+            top_n: 最多返回的证据数量
+            snapshot: 在调用方已取得的快照上匹配，None表示取当前快照
+
+        Returns:
+            得分为1.0的SearchHit列表，没有命中时为None
+        """
+        if snapshot is None:
+            snapshot = self._current_snapshot()
+        return self._match_question(snapshot, normalize_query(query), top_n)
+
+    def _match_question(self, snapshot: IndexSnapshot, normalized: str, top_n: int) -> Optional[List[SearchHit]]:
+        """
+        问题精确匹配的快速路径
+
+        归一化后的提问与问题文本相同时，直接按行号顺序取这些问题的证据作为结果，
+        得分记为1.0；没有命中或这些问题都没有证据时返回None，由调用方走TF-IDF检索。
+        """
+        if top_n <= 0:
+            return None
+        start = time.perf_counter()
+        rows = []
+        n_rows = snapshot.n_rows
+        for question_number in snapshot.question_lookup.get(normalized, ()):
+            # 存储中快照之后追加的行不属于这个快照
+            rows.extend(row for row in snapshot.store.rows_of_question(question_number)
+                        if row < n_rows and not snapshot.deleted[row])
+        rows = sorted(rows)[:top_n]
+        if not rows:
+            self._question_match_misses += 1
+            results = None
+        else:
+            self._question_match_hits += 1
+            results = [SearchHit(snapshot, int(row), 1.0) for row in rows]
+        self._timings.record('exact_match', time.perf_counter() - start)
+        return results
+
+    @staticmethod
+    def answer_from_results(results: Sequence) -> Dict:
+        """
+        根据搜索结果生成答案字典
 
+        results可以是字典或SearchHit；只用到第一个结果，SearchHit的回答在构建存储时已确定，
+        不必读出完整的答案列表再切分证据段落。
+        """
         if not results:
             return {
                 "answer": "抱歉，没有找到相关信息。",
                 "references": []
             }
 
-        # 提取第一个匹配结果的答案
+        # 提取第一个匹配结果的答案，优先使用第一个答案，否则使用证据的第一段落
         best_result = results[0]
-        answers = best_result.get('answer', [])
-
-        # 如果答案列表中包含"no_answer"，则返回默认提示
-        if "no_answer" in answers:
-            return {
-                "answer": "抱歉，没有找到相关答案。",
-                "references": [
-                    {
-                        "question": best_result.get('question', ''),
-                        "evidence": best_result.get('evidence', ''),
-                        "score": best_result.get('score', 0)
-                    }
-                ]
-            }
-
-        # 优先使用第一个答案，否则使用证据的第一段落
-        if answers:
-            final_answer = answers[0]
+        if isinstance(best_result, SearchHit):
+            answer, no_answer = best_result.answer_payload()
         else:
-            evidence = best_result.get('evidence', '')
-            paragraphs = re.split(r'\n\s*\n', evidence.strip())
-            final_answer = paragraphs[0] if paragraphs else evidence
+            answers = best_result.get('answer', [])
+            answer = final_answer(best_result.get('evidence', ''), answers)
+            no_answer = "no_answer" in answers
 
+        # 如果答案列表中包含"no_answer"，则返回默认提示
         return {
-            "answer": final_answer,
+            "answer": "抱歉，没有找到相关答案。" if no_answer else answer,
             "references": [
                 {
                     "question": best_result.get('question', ''),
@@ -167,28 +2697,139 @@ class LocalKnowledgeBaseQA:
         }
 
 
+class BackgroundLoader:
+    """
+    在后台线程中加载知识库、构建或恢复索引，然后预热分词词典
+
+    交互界面可以先显示菜单，第一次用到问答系统时get()只等待知识库和索引就绪；
+    分词词典如果还在预热，分词时jieba会等它完成，命中问题精确匹配的提问则完全不必等待。
+    加载和之后热重载的提示信息不直接打印（主线程可能正等在input()），而是暂存起来，
+    由交互界面在两次输入之间调用print_messages()打印。
+    """
+
+    def __init__(self, watch_interval: Optional[float] = None, **options):
+        """
+        Args:
+            watch_interval: 不为None时，加载完成后按该间隔监视知识库文件，见LocalKnowledgeBaseQA.watch
+            options: 传给LocalKnowledgeBaseQA的参数
+        """
+        # 各阶段完成时距程序启动的秒数：index为知识库和索引就绪，analyzer为分词词典预热完成
+        self.stage_times = {}
+        self._qa_system = None
+        self._error = None
+        self._ready = threading.Event()
+        self._messages = []
+        self._messages_lock = threading.Lock()
+        options.setdefault('message_handler', self._add_message)
+        self._thread = threading.Thread(target=self._run, args=(watch_interval, options),
+                                        name='kb-prewarm', daemon=True)
+        self._thread.start()
+
+    def _run(self, watch_interval: Optional[float], options: Dict) -> None:
+        try:
+            qa_system = LocalKnowledgeBaseQA(**options)
+            if watch_interval is not None:
+                qa_system.watch(watch_interval)
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self.stage_times['index'] = time.perf_counter() - _STARTED_AT
+        self._qa_system = qa_system
+        self._ready.set()
+        qa_system.prewarm()
+        self.stage_times['analyzer'] = time.perf_counter() - _STARTED_AT
+
+    def _add_message(self, message: str) -> None:
+        with self._messages_lock:
+            self._messages.append(message)
+
+    def print_messages(self) -> None:
+        """打印后台线程暂存的提示信息"""
+        with self._messages_lock:
+            messages, self._messages = self._messages, []
+        for message in messages:
+            print(message)
+
+    @property
+    def ready(self) -> bool:
+        """知识库和索引是否已经就绪"""
+        return self._ready.is_set()
+
+    def get(self) -> LocalKnowledgeBaseQA:
+        """等待知识库和索引就绪后返回问答系统，加载出错时抛出原来的异常"""
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self._qa_system
+
+
+def default_knowledge_file() -> str:
+    """脚本所在目录下的默认知识库；已转换为SQLite知识库时优先使用，启动时不必解析整个JSON文件"""
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    sqlite_file = os.path.join(current_dir, "knowledge_base.db")
+    if os.path.exists(sqlite_file):
+        return sqlite_file
+    return os.path.join(current_dir, "knowledge_base.json")
+
+
+def default_options() -> Dict:
+    """
+    交互界面和常驻服务（kb_server.py）共用的问答系统参数
+
+    两者读写同一个索引快照，参数不一致时一方启动会让另一方的快照失效而整体重建，
+    对同一个知识库的回答也会不同，因此都从这里取参数。
+    提问多来自语音识别，安装了pypinyin时用拼音检索容忍同音错字。
+    """
+    return {"pinyin_fallback": pinyin_available()}
+
+
+def _wait_for(loader: BackgroundLoader) -> LocalKnowledgeBaseQA:
+    """等待后台加载完成"""
+    if not loader.ready:
+        print("知识库仍在加载，请稍候...")
+    try:
+        return loader.get()
+    finally:
+        loader.print_messages()
+
+
 # 交互式命令行界面
-def main():
+def main(knowledge_file: Optional[str] = None, background: bool = True):
+    """
+    Args:
+        knowledge_file: 知识库文件，默认见default_knowledge_file
+        background: 是否在后台加载知识库，先显示菜单；第一次提问时只等待尚未完成的部分
+    """
     print("===== 本地知识库问答系统 =====")
 
-    # 获取当前脚本所在目录
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    knowledge_file = os.path.join(current_dir, "knowledge_base.json")
+    knowledge_file = knowledge_file or default_knowledge_file()
+    loader = None
+    qa_system = None
+    options = default_options()
 
     # 检查知识库文件是否存在
     if os.path.exists(knowledge_file):
         print(f"找到知识库文件: {knowledge_file}")
-        print("正在加载知识库...")
-        qa_system = LocalKnowledgeBaseQA(knowledge_file=knowledge_file)
+        # JSON知识库文件修改后（例如运行了knowledge_renumber.py）自动重新加载，不必重启
+        watch_interval = None if is_sqlite_path(knowledge_file) else WATCH_INTERVAL
+        if background:
+            print("正在后台加载知识库，可以先选择操作...")
+            loader = BackgroundLoader(watch_interval=watch_interval, knowledge_file=knowledge_file, **options)
+        else:
+            print("正在加载知识库...")
+            qa_system = LocalKnowledgeBaseQA(knowledge_file=knowledge_file, **options)
+            if watch_interval is not None:
+                qa_system.watch(watch_interval)
     else:
         print(f"未找到知识库文件: {knowledge_file}")
-        print("1. 从其他JSON文件加载知识库")
+        print("1. 从其他JSON文件或SQLite数据库加载知识库")
         print("2. 使用示例知识库")
         choice = input("请选择: ")
 
         if choice == '1':
-            file_path = input("请输入知识库JSON文件路径: ")
-            qa_system = LocalKnowledgeBaseQA(knowledge_file=file_path)
+            file_path = input("请输入知识库文件路径: ")
+            qa_system = LocalKnowledgeBaseQA(knowledge_file=file_path, **options)
         else:
             # 使用示例知识库
             sample_knowledge = {
@@ -220,15 +2861,22 @@ def main():
                     }
                 }
             }
-            qa_system = LocalKnowledgeBaseQA(knowledge_dict=sample_knowledge)
+            qa_system = LocalKnowledgeBaseQA(knowledge_dict=sample_knowledge, **options)
             print("已加载示例知识库")
 
+    menu_time = None  # 启动到显示菜单的秒数
+    first_answer_time = None  # 启动到给出第一个回答的秒数
     while True:
+        if loader is not None:
+            loader.print_messages()
         print("\n===== 操作菜单 =====")
         print("1. 提问")
         print("2. 搜索知识库")
         print("3. 查看知识库统计信息")
         print("q. 退出")
+        if menu_time is None:
+            menu_time = time.perf_counter() - _STARTED_AT
+            print(f"（启动后 {menu_time:.2f} 秒显示菜单）")
 
         cmd = input("请选择操作: ")
 
@@ -237,6 +2885,8 @@ def main():
             if not question.strip():
                 continue
 
+            if qa_system is None:
+                qa_system = _wait_for(loader)
             answer_data = qa_system.generate_answer(question)
 
             print("\n答案:")
@@ -247,11 +2897,17 @@ def main():
                 for i, ref in enumerate(answer_data["references"], 1):
                     print(f"{i}. [{ref['question']}] {ref['evidence'][:100]}... (相似度: {ref['score']:.2f})")
 
+            if first_answer_time is None:
+                first_answer_time = time.perf_counter() - _STARTED_AT
+                print(f"\n（启动后 {first_answer_time:.2f} 秒给出第一个回答）")
+
         elif cmd == '2':
             keyword = input("请输入搜索关键词: ")
             if not keyword.strip():
                 continue
 
+            if qa_system is None:
+                qa_system = _wait_for(loader)
             results = qa_system.search_knowledge(keyword, top_n=5)
 
             if results:
@@ -262,14 +2918,57 @@ def main():
                 print("没有找到相关知识")
 
         elif cmd == '3':
+            if qa_system is None:
+                qa_system = _wait_for(loader)
             # 统计信息
-            total_questions = len(qa_system.knowledge_base)
-            total_evidences = len(qa_system.kb_ids)
+            total_questions = qa_system.question_count
+            total_evidences = qa_system.evidence_count
 
             print("\n知识库统计信息:")
             print(f"- 问题数量: {total_questions}")
             print(f"- 证据数量: {total_evidences}")
 
+            stats = qa_system.stats()
+            match_stats = stats["question_match"]
+            print(f"- 问题精确匹配: 命中 {match_stats['hits']} 次，"
+                  f"未命中 {match_stats['misses']} 次 (命中率 {match_stats['hit_rate']:.0%})")
+            cache_stats = stats["result_cache"]
+            print(f"- 结果缓存: 命中 {cache_stats['hits']} 次，"
+                  f"未命中 {cache_stats['misses']} 次 (命中率 {cache_stats['hit_rate']:.0%})")
+            dedup_stats = stats["dedup"]
+            if dedup_stats["threshold"]:
+                print(f"- 近似重复合并: {dedup_stats['clusters']} 簇，合并了 {dedup_stats['collapsed']} 条证据")
+            pinyin_stats = stats["pinyin"]
+            if pinyin_stats["enabled"]:
+                print(f"- 拼音检索: 使用 {pinyin_stats['searches']} 次，找到结果 {pinyin_stats['hits']} 次")
+            reload_stats = stats["reload"]
+            if reload_stats["watching"] or reload_stats["reloads"]:
+                line = f"- 索引代数: {reload_stats['generation']}，重新加载 {reload_stats['reloads']} 次"
+                if reload_stats["last_seconds"] is not None:
+                    line += f"，最近一次用时 {reload_stats['last_seconds']:.2f} 秒"
+                print(line)
+
+            startup = [("显示菜单", menu_time)]
+            if loader is not None:
+                startup += [("知识库就绪", loader.stage_times.get('index')),
+                            ("分词预热完成", loader.stage_times.get('analyzer'))]
+            startup.append(("第一个回答", first_answer_time))
+            print("- 启动耗时: " + "，".join(f"{label} {seconds:.2f} 秒"
+                                          for label, seconds in startup if seconds is not None))
+
+            timings = stats["timings"]
+            if timings:
+                print("\n各阶段耗时（毫秒）:")
+                print(f"  {'阶段':<12} {'次数':>6} {'平均':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'最大':>8}")
+                for stage, label in TIMING_STAGES.items():
+                    timing = timings.get(stage)
+                    if timing is None:
+                        continue
+                    # 中文标签按两个字符宽度对齐
+                    print(f"  {label}{' ' * (14 - 2 * len(label))} {timing['count']:>6} "
+                          f"{timing['mean_ms']:>8.3f} {timing['p50_ms']:>8.3f} {timing['p95_ms']:>8.3f} "
+                          f"{timing['p99_ms']:>8.3f} {timing['max_ms']:>8.3f}")
+
         elif cmd.lower() == 'q':
             break
 
@@ -278,6 +2977,6 @@ def main():
 
 
 if __name__ == "__main__":
-    # 确保中文分词正常工作
-    jieba.setLogLevel(jieba.logging.INFO)
+    # 确保中文分词正常工作（与jieba.setLogLevel相同，但不必提前导入jieba）
+    logging.getLogger('jieba').setLevel(logging.INFO)
     main()
\ No newline at end of file
@@ -1,6 +1,9 @@
+import importlib.util
 import json
 import os
 import re
+import subprocess
+import sys
 from typing import Dict, List, Any, Optional, Tuple
 from collections import defaultdict
 import jieba
@@ -8,6 +11,11 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
 
+# 可选依赖：包名 -> 用途，没有安装时询问是否安装
+OPTIONAL_PACKAGES = {
+    "pypinyin": "拼音检索，容忍语音识别的同音错字",
+}
+
 
 class LocalKnowledgeBaseQA:
     def __init__(self, knowledge_file: str = None, knowledge_dict: Dict = None):
@@ -167,6 +175,20 @@ class LocalKnowledgeBaseQA:
         }
 
 
+def install_optional_packages() -> None:
+    """检查可选依赖，没有安装的询问后用pip安装"""
+    for package, purpose in OPTIONAL_PACKAGES.items():
+        if importlib.util.find_spec(package) is not None:
+            continue
+        choice = input(f"未安装可选依赖 {package}（{purpose}），是否现在安装？(y/n): ")
+        if choice.strip().lower() != 'y':
+            continue
+        try:
+            subprocess.check_call([sys.executable, "-m", "pip", "install", package])
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"安装 {package} 失败: {e}，可以稍后运行 pip3 install {package}")
+
+
 # 交互式命令行界面
 def main():
     print("===== 本地知识库问答系统 =====")
@@ -280,4 +302,5 @@ def main():
 if __name__ == "__main__":
     # 确保中文分词正常工作
     jieba.setLogLevel(jieba.logging.INFO)
+    install_optional_packages()
     main()